@@ -1,13 +1,46 @@
-﻿import os
-from typing import Dict, Optional
+﻿import json
+import os
+import threading
+from typing import Dict, FrozenSet, List, Optional
+import numpy as np
+import pandas as pd
 
 from PIL import Image
 from datasetinsights.datasets.unity_perception import AnnotationDefinitions, MetricDefinitions
 from datasetinsights.datasets.unity_perception.captures import Captures
+from datasetinsights.datasets.unity_perception.exceptions import DefinitionIDError
 
+from helpers.annotation_store import AnnotationTable
+import helpers.dataset_index as dataset_index
+import helpers.pyramid_store as pyramid_store
+import helpers.record_index as record_index
+import helpers.thumbnail_cache as thumbnail_cache
+from helpers.render_cache import render_cache
 import visualization.visualizers as v
 
 
+# column of the datasetinsights annotations table holding the annotation values, kept in the annotation tables
+VALUES_COLUMN = "values"
+# columns of the captures of a definition kept in the capture index, the only ones the visualizer reads
+CAPTURE_INDEX_COLUMNS = ("id", "filename", "sensor", "annotation.filename")
+
+# options of labelers_to_use that are not annotation definitions: the instance segmentation is drawn with the high
+# contrast colors of the instance color lookup table instead of the colors of the mask, optionally with its outlines
+INSTANCE_PSEUDO_COLORS = "instance segmentation pseudo colors"
+INSTANCE_CONTOURS = "instance segmentation contours"
+# segmentation labelers and the kind of their pyramid store
+SEGMENTATION_PYRAMIDS = (('semantic segmentation', pyramid_store.SEMANTIC_SEGMENTATION),
+                         ('instance segmentation', pyramid_store.INSTANCE_SEGMENTATION))
+
+INSTANCE_PALETTE = v.make_instance_palette()
+# number of datasets whose instance color lookup table (16 MB each) is kept in memory
+INSTANCE_LUT_CACHE_SIZE = 2
+# (data root, revision) -> lookup table, oldest first
+_instance_lut_cache = {}
+# held while a table is looked up, built and stored, the render threads would otherwise all build the same table
+_instance_lut_lock = threading.Lock()
+
+
 class Dataset:
     @staticmethod
     def check_folder_valid(base_dataset_dir: str):
@@ -25,36 +58,300 @@ class Dataset:
         except PermissionError:
             return False
 
-    def __init__(self, data_root: str):        
+    def __init__(self, data_root: str, use_index: bool = True):        
         if Dataset.check_folder_valid(data_root):
             try:                
-                self.ann_def = AnnotationDefinitions(data_root)                                
-                self.metric_def = MetricDefinitions(data_root)
-                self.cap = Captures(data_root)
+                self._load_tables(data_root, use_index)
                 self.data_root = data_root
+                self._build_lookups()
                 self.dataset_valid = True
             except Exception as e:
                 print(e)
-                self.ann_def = None
-                self.metric_def = None
-                self.cap = None
-                self.data_root = None
-                self.dataset_valid = False
+                self._clear()
         else:            
-            self.ann_def = None
-            self.metric_def = None
-            self.cap = None
-            self.data_root = None
-            self.dataset_valid = False
+            self._clear()
+
+    def _load_tables(self, data_root: str, use_index: bool):
+        """ Loads the definitions, the capture index and the annotation tables of the dataset, from the dataset index
+        when it is up to date with the dataset json files, otherwise by parsing them with datasetinsights and writing a
+        new index
+
+        :param data_root: Root directory of the dataset
+        :type data_root: str
+        :param use_index: if false the json files are always parsed and no index is written
+        :type use_index: bool
+        """
+        signature = dataset_index.compute_signature(data_root)
+        self.revision = dataset_index.get_revision(signature)
+        self.source_files = tuple(entry[0] for entry in signature)
+        self.use_index = use_index
+        tables = dataset_index.load_tables(data_root, signature) if use_index else None
+        if tables is not None:
+            self.annotation_records = tables["annotation_definitions"]
+            self.metric_records = tables["metric_definitions"]
+            self.num_frames = tables["num_frames"]
+            self.capture_index = Dataset._decode_capture_index(tables["capture_index"], tables["capture_values"])
+            self.annotation_tables = {definition_id: AnnotationTable.from_state(state)
+                                      for definition_id, state in tables["annotation_tables"].items()}
+            return
+
+        # only plain records and the columns the visualizer reads are kept from the datasetinsights tables
+        captures = Captures(data_root)
+        self.annotation_records = AnnotationDefinitions(data_root).table.to_dict('records')
+        self.metric_records = MetricDefinitions(data_root).table.to_dict('records')
+        self.num_frames = len(captures.captures)
+        self.capture_index = {}
+        self.annotation_tables = {}
+        for definition in self.annotation_records:
+            definition_captures = Dataset._get_sorted_captures(captures, definition["id"])
+            if definition_captures is None:
+                continue
+            if "annotation." + VALUES_COLUMN in definition_captures:
+                self.annotation_tables[definition["id"]] = AnnotationTable.from_values(
+                    definition_captures["annotation." + VALUES_COLUMN].tolist())
+            self.capture_index[definition["id"]] = definition_captures[
+                [column for column in CAPTURE_INDEX_COLUMNS if column in definition_captures]]
+        if use_index:
+            capture_index, capture_values = Dataset._encode_capture_index(self.capture_index)
+            dataset_index.save_tables(data_root, {
+                "annotation_definitions": self.annotation_records,
+                "metric_definitions": self.metric_records,
+                "num_frames": self.num_frames,
+                "capture_index": capture_index,
+                "capture_values": capture_values,
+                "annotation_tables": {definition_id: table.to_state()
+                                      for definition_id, table in self.annotation_tables.items()},
+            }, signature, num_frames=self.num_frames)
+
+    @staticmethod
+    def _encode_capture_index(capture_index: Dict[str, pd.DataFrame]):
+        """ Converts the capture index into arrays for the dataset index: every value of a column (e.g. a filename or a
+        sensor record) is stored once in a list of values and the captures of every definition hold codes into it
+
+        :param capture_index: see _load_tables
+        :type capture_index: Dict[str, pd.DataFrame]
+        :return: (definition id -> column -> codes, column -> values)
+        :rtype: Tuple[Dict[str, Dict[str, np.ndarray]], Dict[str, list]]
+        """
+        codes = {}
+        values = {}
+        for definition_id, captures in capture_index.items():
+            codes[definition_id] = {}
+            for column in captures.columns:
+                column_values = values.setdefault(column, [])
+                # the values are json records, their json text tells equal values apart
+                value_codes = values.setdefault((column,), {})
+                column_codes = np.empty(len(captures), dtype=np.int64)
+                for i, value in enumerate(captures[column].tolist()):
+                    key = json.dumps(value, sort_keys=True)
+                    code = value_codes.get(key)
+                    if code is None:
+                        code = value_codes[key] = len(column_values)
+                        column_values.append(value)
+                    column_codes[i] = code
+                codes[definition_id][column] = column_codes
+        return codes, {column: column_values for column, column_values in values.items() if isinstance(column, str)}
+
+    @staticmethod
+    def _decode_capture_index(codes: Dict[str, Dict[str, np.ndarray]],
+                              values: Dict[str, list]) -> Dict[str, pd.DataFrame]:
+        """ Rebuilds the capture index from the result of _encode_capture_index
+        """
+        value_arrays = {}
+        for column, column_values in values.items():
+            # filled one by one, numpy would otherwise read the sensor records of the same length as a second dimension
+            value_arrays[column] = np.empty(len(column_values), dtype=object)
+            for i, value in enumerate(column_values):
+                value_arrays[column][i] = value
+        return {definition_id: pd.DataFrame({column: value_arrays[column][column_codes]
+                                             for column, column_codes in columns.items()})
+                for definition_id, columns in codes.items()}
+
+    def _clear(self):
+        """ Resets every attribute to the state of an invalid dataset
+        """
+        self.annotation_tables = {}
+        self.data_root = None
+        self.revision = None
+        self.source_files = ()
+        self.use_index = False
+        self.capture_index = {}
+        self.num_frames = 0
+        self.annotation_records = []
+        self.annotation_ids = {}
+        self.annotation_indices = {}
+        self.annotation_specs = {}
+        self.label_mappings = {}
+        self.metric_records = []
+        self.metric_names = {}
+        self.dataset_valid = False
+
+    def _build_lookups(self):
+        """ Precomputes the annotation and metric definition lookups and the number of frames so that metadata queries
+        do not need to go over the definition tables again
+        """
+        self.annotation_ids = {}
+        self.annotation_indices = {}
+        self.annotation_specs = {}
+        self.label_mappings = {}
+        for idx, a in enumerate(self.annotation_records):
+            # keep the first definition with a given name, like the previous linear search did
+            if a["name"] in self.annotation_ids:
+                continue
+            self.annotation_ids[a["name"]] = a["id"]
+            self.annotation_indices[a["name"]] = idx
+            self.annotation_specs[a["name"]] = a["spec"]
+            if isinstance(a["spec"], list):
+                self.label_mappings[a["name"]] = {
+                    m["label_id"]: m["label_name"] for m in a["spec"] if "label_id" in m and "label_name" in m
+                }
+
+        self.metric_names = {m["id"]: m["name"] for m in self.metric_records}
+
+    @staticmethod
+    def _get_sorted_captures(captures: Captures, definition_id: str) -> Optional[pd.DataFrame]:
+        """ Filters the captures of an annotation definition and sorts them by filename, the index of a row is its frame
+        index
+        """
+        try:
+            definition_captures = captures.filter(def_id=definition_id)
+        except DefinitionIDError:
+            # definitions without any annotation records have no frames to look up
+            return None
+        definition_captures = definition_captures.sort_values(by='filename', key=Dataset.custom_compare_filenames)
+        return definition_captures.reset_index(drop=True)
+
+    def get_captures(self, definition_id: str) -> pd.DataFrame:
+        """ gets the captures of the specified annotation definition sorted by filename
+
+        :param definition_id: annotation definition id
+        :type definition_id: str
+        :return: captures of the definition, the index of a row is its frame index
+        :rtype: pd.DataFrame
+        """
+        return self.capture_index[definition_id]
+
+    def get_capture_value(self, definition_id: str, index: int, column: str):
+        """ gets a single value of the capture at the given frame index for the specified annotation definition
+
+        :param definition_id: annotation definition id
+        :type definition_id: str
+        :param index: The index of the frame
+        :type index: int
+        :param column: Name of the captures column (e.g. "filename", "annotation.values", "sensor")
+        :type column: str
+        :return: value stored in the captures table, the records rebuilt from the annotation table for
+                 "annotation.values"
+        """
+        if column == "annotation." + VALUES_COLUMN:
+            return self.get_annotation_values(definition_id, index)
+        return self.capture_index[definition_id].at[index, column]
+
+    def get_annotation_table(self, definition_id: str) -> Optional[AnnotationTable]:
+        """ gets the annotation values of every frame of the specified annotation definition, stored column by column
+
+        :param definition_id: annotation definition id
+        :type definition_id: str
+        :return: the annotation table, the frames are in the order of get_captures, None if the definition has no
+                 annotation values
+        :rtype: AnnotationTable
+        """
+        return self.annotation_tables.get(definition_id)
+
+    def get_annotation_values(self, definition_id: str, index: int) -> List[dict]:
+        """ gets the annotation values of the frame for the specified annotation definition, as they are stored in the
+        json files
+
+        :param definition_id: annotation definition id
+        :type definition_id: str
+        :param index: The index of the frame
+        :type index: int
+        :return: the annotation records of the frame
+        :rtype: List[dict]
+        """
+        table = self.annotation_tables.get(definition_id)
+        return [] if table is None else table.get_records(index)
+
+    def get_instance_lut(self) -> np.ndarray:
+        """ gets the lookup table from the colors of the instance segmentation masks to INSTANCE_PALETTE, built from the
+        instances of the instance segmentation annotation values and kept in memory for the last few datasets
+
+        :return: see visualizers.make_instance_lut
+        :rtype: np.ndarray
+        """
+        key = (os.path.abspath(self.data_root), self.revision)
+        with _instance_lut_lock:
+            lut = _instance_lut_cache.get(key)
+            if lut is None:
+                lut = self._build_instance_lut()
+                if len(_instance_lut_cache) >= INSTANCE_LUT_CACHE_SIZE:
+                    _instance_lut_cache.pop(next(iter(_instance_lut_cache)))
+                _instance_lut_cache[key] = lut
+        return lut
+
+    def _build_instance_lut(self) -> np.ndarray:
+        instance_ids = np.zeros(0, dtype=np.int64)
+        instance_colors = np.zeros((0, 3), dtype=np.int64)
+        table = self.get_annotation_table(self.get_annotation_id('instance segmentation'))
+        if table is not None and all(table.has_column(name) for name in ("instance_id", "color.r", "color.g",
+                                                                         "color.b")):
+            instance_ids = table.get_column("instance_id")
+            instance_colors = np.stack([table.get_column("color." + channel) for channel in "rgb"], axis=1)
+        return v.make_instance_lut(instance_ids, instance_colors, len(INSTANCE_PALETTE))
 
     def get_metrics_records(self):
-        return self.metric_def.table.to_dict('records')
+        return self.metric_records
+
+    def get_metric_name(self, metric_definition_id: str) -> Optional[str]:
+        """ gets the name of the specified metric definition
+
+        :param metric_definition_id: metric definition id
+        :type metric_definition_id: str
+        :return: name of the metric definition
+        :rtype: str
+        """
+        return self.metric_names.get(metric_definition_id)
+
+    def _get_record_locations(self) -> Dict[str, dict]:
+        return record_index.get_record_locations(os.path.abspath(self.data_root), self.revision, self.source_files,
+                                                 self.use_index)
+
+    def get_capture_metadata(self, index: int) -> Optional[dict]:
+        """ gets the capture record of the frame as it is stored in the captures json file
+
+        :param index: The index of the frame
+        :type index: int
+        :return: the raw capture record, None if it can not be found
+        :rtype: dict
+        """
+        capture_id = self.get_capture_value(self.annotation_records[0]["id"], index, "id")
+        location = self._get_record_locations()["captures"].get(capture_id)
+        if location is None:
+            return None
+        return record_index.read_record(os.path.abspath(self.data_root), location, "captures", self.revision)
+
+    def get_metrics_metadata(self, index: int) -> List[dict]:
+        """ gets the metric records of the frame (same sequence_id and step) as they are stored in the metrics json
+        files
+
+        :param index: The index of the frame
+        :type index: int
+        :return: the raw metric records
+        :rtype: List[dict]
+        """
+        capture = self.get_capture_metadata(index)
+        if capture is None:
+            return []
+        locations = self._get_record_locations()["metrics"].get((capture["sequence_id"], capture["step"]), [])
+        metrics = [record_index.read_record(os.path.abspath(self.data_root), location, "metrics", self.revision)
+                   for location in locations]
+        return [metric for metric in metrics if metric is not None]
 
     def get_available_labelers(self):
-        return [a["name"] for a in self.ann_def.table.to_dict('records')]
+        return [a["name"] for a in self.annotation_records]
 
     def length(self):
-        return len(self.cap.captures.to_dict('records'))
+        return self.num_frames
 
     def get_annotation_id(self, name: str) -> Optional[str]:
         """ gets annotation definition id of the specified annotation
@@ -64,11 +361,7 @@ class Dataset:
         :return: annotation definition id
         :rtype: str
         """
-
-        for idx, a in enumerate(self.ann_def.table.to_dict('records')):
-            if a["name"] == name:
-                return a["id"]
-        return None
+        return self.annotation_ids.get(name)
 
     def get_annotation_index(self, name: str) -> int:
         """ gets annotation definition index of the specified annotation
@@ -78,10 +371,26 @@ class Dataset:
         :return: index
         :rtype: int
         """
-        for idx, a in enumerate(self.ann_def.table.to_dict('records')):
-            if a["name"] == name:
-                return idx
-        return -1
+        return self.annotation_indices.get(name, -1)
+
+    def get_annotation_spec(self, name: str):
+        """ gets the spec of the specified annotation definition
+
+        :param name: Name of the annotation we want the spec of
+        :type name: str
+        :return: spec of the annotation definition, None if the annotation does not exist
+        """
+        return self.annotation_specs.get(name)
+
+    def get_label_mappings(self, name: str) -> Dict[int, str]:
+        """ gets the label_id -> label_name mapping of the specified annotation definition
+
+        :param name: Name of the annotation we want the label mappings of
+        :type name: str
+        :return: Dictionary where keys are label ids and values are label names
+        :rtype: Dict[int, str]
+        """
+        return self.label_mappings.get(name, {})
 
     @staticmethod
     def custom_compare_filenames(filenames):
@@ -89,11 +398,39 @@ class Dataset:
             filenames[i] = int(os.path.basename(filenames[i])[4:-4])
         return filenames
 
+    @staticmethod
+    def get_enabled_labelers(labelers_to_use: Dict[str, bool]) -> FrozenSet[str]:
+        """ gets the names of the labelers that are turned on
+
+        :param labelers_to_use: Dictionary of labeler name to whether or not to display it
+        :type labelers_to_use: Dict[str, bool]
+        :return: names of the labelers to display
+        :rtype: FrozenSet[str]
+        """
+        return frozenset(name for name, enabled in labelers_to_use.items() if enabled)
+
+    def get_render_cache_key(self, index: int, labelers_to_use: Dict[str, bool], max_size: int) -> tuple:
+        """ gets the key under which get_image_with_labelers caches a frame in the render cache
+
+        :param index: The index of the frame
+        :type index: int
+        :param labelers_to_use: Dictionary of labeler name to whether or not to display it
+        :type labelers_to_use: Dict[str, bool]
+        :param max_size: maximum size of width and height of the rendered image
+        :type max_size: int
+        :return: the cache key
+        :rtype: tuple
+        """
+        return (os.path.abspath(self.data_root), self.revision, index, Dataset.get_enabled_labelers(labelers_to_use),
+                max_size)
+
     def get_image_with_labelers(
             self,
             index: int,
             labelers_to_use: Dict[str, bool],
-            max_size: int = 500) -> Image:
+            max_size: int = 500,
+            use_cache: bool = True,
+            use_render_cache: bool = True) -> Image:
         """ Creates a PIL image of the capture at index that has all the labelers_to_use visualized
     
         :param index: The index of the frame we want
@@ -105,77 +442,121 @@ class Dataset:
                          Useful for optimizing. In the visualizer, if the images were full sized: the browser would take too
                          much time to display them
         :type max_size: int
+        :param use_cache: Optional (Default: True), if true the image is taken from and stored in the shared render
+                          cache and in the disk thumbnail cache when it is enabled, cached images must not be modified
+        :type use_cache: bool
+        :param use_render_cache: Optional (Default: True), if false only the disk thumbnail cache is used, e.g. by
+                                 processes that render every frame once
+        :type use_render_cache: bool
         :return: The image with the labelers
         :rtype: PIL.Image
         """
-        captures = self.cap.filter(def_id=self.ann_def.table.to_dict('records')[0]["id"])
-        captures = captures.sort_values(by='filename', key=Dataset.custom_compare_filenames).reset_index(drop=True)
-        capture = captures.loc[index, "filename"]
-        filename = os.path.join(self.data_root, capture)
-        image = Image.open(filename)
+        if not use_cache:
+            return self._render_image_with_labelers(index, labelers_to_use, max_size)
+
+        enabled_labelers = Dataset.get_enabled_labelers(labelers_to_use)
+        key = self.get_render_cache_key(index, labelers_to_use, max_size)
+        if use_render_cache:
+            image = render_cache.get(key)
+            if image is not None:
+                return image
+
+        disk_cache = thumbnail_cache.thumbnail_cache
+        if disk_cache is not None and disk_cache.accepts(max_size):
+            disk_key = disk_cache.make_key(self._get_render_sources(index, labelers_to_use), self.revision,
+                                           enabled_labelers, max_size)
+            image = disk_cache.get(disk_key)
+            if image is None:
+                image = self._render_image_with_labelers(index, labelers_to_use, max_size)
+                disk_cache.put(disk_key, image)
+        else:
+            image = self._render_image_with_labelers(index, labelers_to_use, max_size)
+        if use_render_cache:
+            render_cache.put(key, image)
+        return image
+
+    def _get_render_sources(self, index: int, labelers_to_use: Dict[str, bool]) -> List[str]:
+        """ Lists the files _render_image_with_labelers reads for the frame, the other labelers are drawn from the
+        json files covered by the revision of the dataset
+        """
+        sources = [os.path.join(self.data_root,
+                                self.get_capture_value(self.annotation_records[0]["id"], index, "filename")),
+                   pyramid_store.get_manifest_path(self.data_root, pyramid_store.RGB)]
+        for segmentation_name, pyramid_kind in SEGMENTATION_PYRAMIDS:
+            if segmentation_name in labelers_to_use and labelers_to_use[segmentation_name]:
+                segmentation_definition_id = self.get_annotation_id(segmentation_name)
+                seg_capture = self.get_capture_value(segmentation_definition_id, index, "annotation.filename")
+                sources += [os.path.join(self.data_root, seg_capture),
+                            pyramid_store.get_manifest_path(self.data_root, pyramid_kind)]
+        return sources
+
+    def _render_image_with_labelers(
+            self,
+            index: int,
+            labelers_to_use: Dict[str, bool],
+            max_size: int) -> Image:
+        """ Renders the image returned by get_image_with_labelers without going through the render cache
+        """
+        rgb_definition_id = self.annotation_records[0]["id"]
+        capture = self.get_capture_value(rgb_definition_id, index, "filename")
+        # Shrink the capture before drawing anything, the annotations are drawn in the coordinates of the thumbnail.
+        # The smallest big enough level of the pyramid store is used when the capture was preprocessed
+        stored = pyramid_store.load_thumbnail(self.data_root, capture, max_size)
+        if stored is not None:
+            image, (full_width, full_height) = stored
+        else:
+            image = Image.open(os.path.join(self.data_root, capture))
+            full_width, full_height = image.size
+            # draft lets the JPEG decoder skip most of the work of decoding a full size image
+            image.draft(None, (max_size, max_size))
+            image.thumbnail((max_size, max_size))
+        scale = image.width / full_width
 
         if 'bounding box' in labelers_to_use and labelers_to_use['bounding box']:
             bounding_box_definition_id = self.get_annotation_id('bounding box')
-            bb_captures = self.cap.filter(def_id=bounding_box_definition_id)
-            bb_captures = bb_captures.sort_values(by='filename', key=Dataset.custom_compare_filenames).reset_index(
-                drop=True)
-            init_definition = self.ann_def.get_definition(bounding_box_definition_id)
-            label_mappings = {
-                m["label_id"]: m["label_name"] for m in init_definition["spec"]
-            }
             image = v.draw_image_with_boxes(
                 image,
                 index,
-                bb_captures,
-                label_mappings,
+                self.get_annotation_table(bounding_box_definition_id),
+                self.get_label_mappings('bounding box'),
+                scale=scale,
+                full_height=full_height,
             )
 
         if 'keypoints' in labelers_to_use and labelers_to_use['keypoints']:
             keypoints_definition_id = self.get_annotation_id('keypoints')
-            kp_captures = self.cap.filter(def_id=keypoints_definition_id)
-            kp_captures = kp_captures.sort_values(by='filename', key=Dataset.custom_compare_filenames).reset_index(drop=True)
-            annotations = kp_captures.loc[index, "annotation.values"]
-            templates = self.ann_def.table.to_dict('records')[self.get_annotation_index('keypoints')]['spec']
-            v.draw_image_with_keypoints(image, annotations, templates)
+            annotations = self.get_annotation_values(keypoints_definition_id, index)
+            templates = self.get_annotation_spec('keypoints')
+            v.draw_image_with_keypoints(image, annotations, templates, scale=scale)
 
         if 'bounding box 3D' in labelers_to_use and labelers_to_use['bounding box 3D']:
             bounding_box_3d_definition_id = self.get_annotation_id('bounding box 3D')
-            box_captures = self.cap.filter(def_id=bounding_box_3d_definition_id)
-            box_captures = box_captures.sort_values(by='filename', key=Dataset.custom_compare_filenames).reset_index(drop=True)
-            annotations = box_captures.loc[index, "annotation.values"]
-            sensor = box_captures.loc[index, "sensor"]
-            image = v.draw_image_with_box_3d(image, sensor, annotations, None)
-
-        # bounding boxes and keypoints are depend on pixel coordinates so for now the thumbnail optimization applies only to
-        # segmentation
-        # TODO Make it so that bounding boxes and keypoints can be visualized at a lower resolution
-
-        image.thumbnail((max_size, max_size))
-        if 'semantic segmentation' in labelers_to_use and labelers_to_use['semantic segmentation']:
-            semantic_segmentation_definition_id = self.get_annotation_id('semantic segmentation')
-
-            seg_captures = self.cap.filter(def_id=semantic_segmentation_definition_id)
-            seg_captures = seg_captures.sort_values(by='filename', key=Dataset.custom_compare_filenames).reset_index(drop=True)
-            seg_filename = os.path.join(self.data_root, seg_captures.loc[index, "annotation.filename"])
-            seg = Image.open(seg_filename)
-            seg.thumbnail((max_size, max_size))
-
-            image = v.draw_image_with_segmentation(
-                image, seg
-            )
-
-        if 'instance segmentation' in labelers_to_use and labelers_to_use['instance segmentation']:
-            instance_segmentation_definition_id = self.get_annotation_id('instance segmentation')
+            annotations = self.get_annotation_values(bounding_box_3d_definition_id, index)
+            sensor = self.get_capture_value(bounding_box_3d_definition_id, index, "sensor")
+            image = v.draw_image_with_box_3d(image, sensor, annotations, None, scale=scale)
 
-            inst_captures = self.cap.filter(def_id=instance_segmentation_definition_id)
-            inst_captures = inst_captures.sort_values(by='filename', key=Dataset.custom_compare_filenames).reset_index(
-                drop=True)
-            inst_filename = os.path.join(self.data_root, inst_captures.loc[index, "annotation.filename"])
-            inst = Image.open(inst_filename)
-            inst.thumbnail((max_size, max_size))
-
-            image = v.draw_image_with_segmentation(
-                image, inst
-            )
+        # both segmentations are blended into the frame in a single pass
+        segmentations = []
+        outlines = None
+        pseudo_colors = labelers_to_use.get(INSTANCE_PSEUDO_COLORS, False)
+        for segmentation_name, pyramid_kind in SEGMENTATION_PYRAMIDS:
+            if segmentation_name in labelers_to_use and labelers_to_use[segmentation_name]:
+                segmentation_definition_id = self.get_annotation_id(segmentation_name)
+                seg_capture = self.get_capture_value(segmentation_definition_id, index, "annotation.filename")
+                # masks in the pyramid store are read at the size of the frame without decoding the PNG
+                seg = pyramid_store.load_label_map(self.data_root, pyramid_kind, seg_capture, image.size)
+                recolor = pseudo_colors and segmentation_name == 'instance segmentation'
+                if seg is None:
+                    seg = Image.open(os.path.join(self.data_root, seg_capture))
+                    # the mask colors are looked up when recoloring, they must not be blended by the resampling
+                    seg.thumbnail((max_size, max_size), Image.NEAREST if recolor else Image.BICUBIC)
+                if recolor:
+                    seg, outlines = v.pseudo_color_instances(seg, self.get_instance_lut(), INSTANCE_PALETTE,
+                                                             labelers_to_use.get(INSTANCE_CONTOURS, False))
+                segmentations.append(seg)
+        if len(segmentations) > 0:
+            image = v.composite_segmentations(image, segmentations)
+        if outlines is not None:
+            image = v.draw_instance_contours(image, outlines)
 
         return image
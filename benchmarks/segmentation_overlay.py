@@ -0,0 +1,86 @@
+""" Micro-benchmark of the segmentation overlay compositing
+
+Compares the previous PIL based draw_image_with_segmentation with the NumPy composite_segmentations at grid, zoom
+and full resolution, with one label map (semantic or instance segmentation) and with two.
+
+Run from the repository root:
+    python benchmarks/segmentation_overlay.py
+"""
+import argparse
+import os
+import sys
+import timeit
+
+import numpy as np
+import PIL.Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import visualization.visualizers as v
+
+SIZES = {
+    "500px": (500, 281),
+    "2000px": (2000, 1125),
+    "full (3840x2160)": (3840, 2160),
+}
+
+
+def legacy_draw_image_with_segmentation(image, segmentation):
+    """ draw_image_with_segmentation before composite_segmentations """
+    rgba = np.array(segmentation.copy().convert("RGBA"))
+    r, g, b, a = rgba.T
+    black_areas = (r == 0) & (b == 0) & (g == 0) & (a == 255)
+    other_areas = (r != 0) | (b != 0) | (g != 0)
+    rgba[..., 0:4][black_areas.T] = (0, 0, 0, 0)
+    rgba[..., -1][other_areas.T] = int(0.6 * 255)
+
+    foreground = PIL.Image.fromarray(rgba)
+    image = image.copy()
+    image.paste(foreground, (0, 0), foreground)
+    return image
+
+
+def make_frame(width, height, seed):
+    rng = np.random.default_rng(seed)
+    image = PIL.Image.fromarray(rng.integers(0, 256, (height, width, 3), dtype=np.uint8))
+    labels = np.zeros((height, width, 4), dtype=np.uint8)
+    labels[..., 3] = 255
+    # about a third of the frame is covered by objects
+    for _ in range(40):
+        x, y = rng.integers(0, width), rng.integers(0, height)
+        w, h = rng.integers(width // 20, width // 5), rng.integers(height // 20, height // 5)
+        labels[y:y + h, x:x + w, :3] = rng.integers(1, 256, 3, dtype=np.uint8)
+    return image, PIL.Image.fromarray(labels)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5, help="best of this many runs is reported")
+    args = parser.parse_args()
+
+    print(f"{'size':<18}{'masks':>6}{'legacy (ms)':>14}{'composite (ms)':>17}{'speedup':>10}")
+    for name, (width, height) in SIZES.items():
+        image, semantic = make_frame(width, height, 0)
+        _, instance = make_frame(width, height, 1)
+        for masks in ([semantic], [semantic, instance]):
+            legacy_result = image
+            for mask in masks:
+                legacy_result = legacy_draw_image_with_segmentation(legacy_result, mask)
+            assert np.array_equal(np.asarray(legacy_result), np.asarray(v.composite_segmentations(image, masks)))
+
+            def legacy():
+                result = image
+                for mask in masks:
+                    result = legacy_draw_image_with_segmentation(result, mask)
+
+            def composite():
+                v.composite_segmentations(image, masks)
+
+            legacy_time = min(timeit.repeat(legacy, number=1, repeat=args.repeat)) * 1000
+            composite_time = min(timeit.repeat(composite, number=1, repeat=args.repeat)) * 1000
+            print(f"{name:<18}{len(masks):>6}{legacy_time:>14.1f}{composite_time:>17.1f}"
+                  f"{legacy_time / composite_time:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,264 @@
 import argparse
 import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-import streamlit.bootstrap
+import helpers.datamaker_loader as datamaker_loader
+import helpers.thumbnail_cache as thumbnail_cache
 
 cli = argparse.ArgumentParser()
 cli.add_argument('--data', type=str,
                  help='path to dataset', default="")
+cli.add_argument('--thumbnail-cache', type=str,
+                 help='directory of the rendered thumbnails shared by every session and the render command', default="")
+cli.add_argument('--thumbnail-cache-size', type=int,
+                 help='size of the thumbnail cache in megabytes', default=2048)
+cli.add_argument('--lazy-instances-mb', type=int,
+                 help='parse the instances of a Datamaker dataset only when they are displayed, keeping at most this '
+                      'many megabytes of parsed instances in memory', default=0)
+
+# without a command the preview app is started
+subcommands = cli.add_subparsers(dest="command")
+
+render_cli = subcommands.add_parser('render', help='render annotated frames to image files without the app')
+render_cli.add_argument('data', type=str, help='path to dataset')
+render_cli.add_argument('output', type=str, help='directory where the images are written')
+render_cli.add_argument('--labelers', type=str, default="",
+                        help='comma separated names of the labelers to draw, all of them by default')
+render_cli.add_argument('--size', type=int, default=500, help='maximum width and height of a frame')
+render_cli.add_argument('--start', type=int, default=0, help='first frame index')
+render_cli.add_argument('--end', type=int, default=None, help='frame index after the last one')
+render_cli.add_argument('--sample', type=int, default=None,
+                        help='render this many frames picked at random between start and end')
+render_cli.add_argument('--seed', type=int, default=0, help='seed of the random sampling')
+render_cli.add_argument('--grid', type=str, default="",
+                        help='write contact sheets of COLSxROWS frames (e.g. 4x3) instead of one image per frame')
+render_cli.add_argument('--format', type=str, default="png", choices=["png", "jpg"], help='image format')
+render_cli.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='number of rendering processes')
+render_cli.add_argument('--pseudo-colors', action='store_true',
+                        help='draw the instance segmentation with high contrast colors instead of the mask colors')
+render_cli.add_argument('--contours', action='store_true', help='with --pseudo-colors, outline the instances')
+# also accepted after the command, SUPPRESS keeps the values given before it
+render_cli.add_argument('--thumbnail-cache', type=str, default=argparse.SUPPRESS,
+                        help='directory of the thumbnail cache of the app, the frames rendered with it are reused')
+render_cli.add_argument('--thumbnail-cache-size', type=int, default=argparse.SUPPRESS,
+                        help='size of the thumbnail cache in megabytes')
+
+convert_cli = subcommands.add_parser('convert', help='convert the labels of a dataset without the app')
+convert_cli.add_argument('data', type=str, help='path to a Perception or Datamaker dataset')
+convert_cli.add_argument('output', type=str,
+                         help='directory where the labels are written, Datamaker instances get a sub folder each')
+convert_cli.add_argument('--format', type=str, default="yolo",
+                         help='comma separated formats among yolo, coco and voc, or shards for tar shards of images '
+                              'and yolo labels')
+convert_cli.add_argument('--definition', type=str, default="",
+                         help='name of the annotation definition to convert, "bounding box" by default')
+convert_cli.add_argument('--image-size', type=str, default="auto",
+                         help='"auto" to read the size of every image, or WIDTHxHEIGHT')
+convert_cli.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                         help='number of writing threads of the yolo and shards formats, coco and voc are written '
+                              'from one thread per format')
+convert_cli.add_argument('--chunk-size', type=int, default=1000,
+                         help='number of captures converted at once (frames per shard for shards)')
+convert_cli.add_argument('--incremental', action='store_true',
+                         help='yolo only, skip unchanged frames and delete the labels of removed frames')
+
+pyramid_cli = subcommands.add_parser('pyramid',
+                                     help='store the segmentation masks at several resolutions for faster grids')
+pyramid_cli.add_argument('data', type=str, help='path to a Perception or Datamaker dataset')
+pyramid_cli.add_argument('--rgb', action='store_true', help='also store the RGB captures')
+pyramid_cli.add_argument('--max-size', type=int, default=512,
+                         help='resolutions wider or taller than this are not stored, bigger frames decode the PNG. '
+                              'Every resolution is stored uncompressed with 4 bytes per pixel: about 0.7 MB per '
+                              'frame and image kind for 1920x1080 frames at 512, 2.7 MB at 1024')
+pyramid_cli.add_argument('--min-size', type=int, default=64, help='smallest stored resolution')
+pyramid_cli.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='number of decoding threads')
 
 
 def preview(args):
     """Previews the dataset in a streamlit app."""
+    import streamlit.bootstrap
+
     dirname = os.path.dirname(__file__)
     filename = os.path.join(dirname, "preview.py")
+    if args.thumbnail_cache:
+        thumbnail_cache.configure(os.path.abspath(args.thumbnail_cache), args.thumbnail_cache_size)
+    if args.lazy_instances_mb > 0:
+        os.environ[datamaker_loader.LAZY_INSTANCES_ENV] = str(args.lazy_instances_mb)
     args = [args.data]
     streamlit.bootstrap.run(filename, "", args, None)
 
 
+def render(args):
+    """Renders annotated frames of the dataset to image files."""
+    import helpers.batch_render as batch_render
+    from Dataset import Dataset, INSTANCE_CONTOURS, INSTANCE_PSEUDO_COLORS
+
+    ds = Dataset(args.data)
+    if not ds.dataset_valid:
+        sys.exit("The provided Dataset folder \"" + args.data + "\" is not considered valid")
+    if args.thumbnail_cache:
+        # the worker processes read the cache directory from the environment
+        thumbnail_cache.configure(os.path.abspath(args.thumbnail_cache), args.thumbnail_cache_size)
+
+    available_labelers = ds.get_available_labelers()
+    enabled = [name.strip() for name in args.labelers.split(",") if name.strip()] or available_labelers
+    unknown = [name for name in enabled if name not in available_labelers]
+    if unknown:
+        sys.exit("Unknown labelers: " + ", ".join(unknown) + ". Available: " + ", ".join(available_labelers))
+    labelers = {name: name in enabled for name in available_labelers}
+    labelers[INSTANCE_PSEUDO_COLORS] = args.pseudo_colors
+    labelers[INSTANCE_CONTOURS] = args.pseudo_colors and args.contours
+
+    grid = None
+    if args.grid:
+        try:
+            grid = tuple(int(value) for value in args.grid.lower().split("x"))
+        except ValueError:
+            grid = ()
+        if len(grid) != 2 or min(grid) <= 0:
+            sys.exit("--grid must be COLSxROWS, e.g. 4x3")
+
+    indices = batch_render.select_indices(ds.length(), args.start, args.end, args.sample, args.seed)
+    num_frames, num_files, seconds = batch_render.render(args.data, indices, labelers, args.output, args.size,
+                                                        args.format, grid, args.workers)
+    print(f"Rendered {num_frames} frames to {num_files} files in {seconds:.1f} s "
+          f"({num_frames / seconds if seconds > 0 else 0:.1f} frames/s)")
+
+
+def print_progress(done: int, total: int, start_time: float, width: int = 30):
+    """Prints a progress bar with the throughput and the estimated remaining time on a single line"""
+    elapsed = time.perf_counter() - start_time
+    rate = done / elapsed if elapsed > 0 else 0
+    fraction = min(1.0, done / total) if total > 0 else 1.0
+    eta = (total - done) / rate if rate > 0 and total > done else 0
+    bar = "#" * int(fraction * width)
+    sys.stdout.write(f"\r[{bar:<{width}}] {fraction * 100:5.1f}% {done}/{total} "
+                     f"{rate:.0f} frames/s ETA {time.strftime('%H:%M:%S', time.gmtime(eta))}")
+    sys.stdout.flush()
+
+
+def find_datasets(data: str, num_workers: int = datamaker_loader.DEFAULT_NUM_WORKERS):
+    """Lists (path, name, number of captures) of the Perception datasets in data, the last valid attempt of every
+    instance of a Datamaker dataset named after the instance or data itself with an empty name."""
+    attempts = datamaker_loader.find_attempts(data)
+    if not attempts:
+        return [(data, "", datamaker_loader.count_attempt(data))]
+    # every attempt is counted once, the counts are the progress totals of the commands
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        counts = list(executor.map(datamaker_loader.count_attempt, [attempt_path for _, attempt_path in attempts]))
+    latest = {}
+    for (instance_num, attempt_path), count in zip(attempts, counts):
+        if count > 0:
+            latest[instance_num] = (attempt_path, count)
+    return [(latest[key][0], "instance_" + str(key), latest[key][1]) for key in sorted(latest)]
+
+
+def convert(args):
+    """Converts the labels of the dataset, or of every instance of a Datamaker dataset."""
+    import converter
+    import exporters
+
+    formats = [name.strip() for name in args.format.split(",") if name.strip()]
+    unknown = [name for name in formats if name != "shards" and name not in exporters.WRITERS]
+    if not formats or unknown or ("shards" in formats and len(formats) > 1):
+        sys.exit("--format must be shards or a comma separated list of " + ", ".join(exporters.WRITERS))
+    if args.incremental and formats != ["yolo"]:
+        sys.exit("--incremental is only supported for the yolo format")
+    definition_name = args.definition or converter.DEFAULT_DEFINITION_NAME
+
+    auto_mode = args.image_size == "auto"
+    manual_img_size = (0, 0)
+    if not auto_mode:
+        try:
+            manual_img_size = tuple(int(value) for value in args.image_size.lower().split("x"))
+        except ValueError:
+            manual_img_size = ()
+        if len(manual_img_size) != 2 or min(manual_img_size) <= 0:
+            sys.exit("--image-size must be auto or WIDTHxHEIGHT, e.g. 1920x1080")
+
+    # (path to the dataset, output folder) of every dataset to convert
+    datasets = find_datasets(args.data, args.workers)
+    jobs = [(data_root, os.path.join(args.output, name)) for data_root, name, _ in datasets]
+
+    total = sum(count for _, _, count in datasets)
+    start_time = time.perf_counter()
+    done = 0
+    for data_root, output_dir in jobs:
+        os.makedirs(output_dir, exist_ok=True)
+
+        def on_progress(stats):
+            print_progress(done + stats.frames, total, start_time)
+
+        try:
+            if formats == ["shards"]:
+                stats = converter.convert_sharded(data_root, output_dir, auto_mode, manual_img_size,
+                                                  samples_per_shard=args.chunk_size, num_workers=args.workers,
+                                                  on_progress=on_progress, definition_name=definition_name)
+            elif formats == ["yolo"]:
+                stats = converter.convert_streaming(data_root, output_dir, auto_mode, manual_img_size,
+                                                    chunk_size=args.chunk_size, num_workers=args.workers,
+                                                    on_progress=on_progress, incremental=args.incremental,
+                                                    definition_name=definition_name)
+            else:
+                writers = [exporters.WRITERS[name](output_dir, args.workers) for name in formats] \
+                    if len(formats) == 1 else exporters.create_writers(formats, output_dir, args.workers)
+                stats = exporters.export(data_root, writers, definition_name, auto_mode, manual_img_size,
+                                         chunk_size=args.chunk_size, on_progress=on_progress)
+        except converter.DefinitionNotFoundError as e:
+            sys.exit("\n" + str(e))
+        if stats is None:
+            sys.exit("\nFailed to convert " + data_root)
+        done += stats.frames
+        print_progress(done, total, start_time)
+        print("\n" + data_root + ": " + str(stats))
+
+    seconds = time.perf_counter() - start_time
+    print(f"Converted {done} frames of {len(jobs)} dataset(s) in {seconds:.1f} s "
+          f"({done / seconds if seconds > 0 else 0:.0f} frames/s)")
+
+
+def pyramid(args):
+    """Stores the segmentation masks, and optionally the RGB captures, of the dataset in pyramid stores."""
+    import helpers.pyramid_store as pyramid_store
+    from Dataset import Dataset
+
+    if args.min_size <= 0 or args.max_size < args.min_size:
+        sys.exit("--min-size must be positive and at most --max-size")
+    start_time = time.perf_counter()
+    done = 0
+    for data_root, _, _ in find_datasets(args.data, args.workers):
+        ds = Dataset(data_root)
+        if not ds.dataset_valid:
+            sys.exit("The provided Dataset folder \"" + data_root + "\" is not considered valid")
+        sources = pyramid_store.get_pyramid_sources(ds)
+        if not args.rgb:
+            sources.pop(pyramid_store.RGB)
+        if not sources:
+            print(data_root + ": no segmentation masks")
+        for kind, relative_paths in sources.items():
+            kind_start = time.perf_counter()
+            stored = pyramid_store.build_pyramid(
+                data_root, kind, relative_paths, max_size=args.max_size, min_size=args.min_size,
+                num_workers=args.workers, on_progress=lambda frames, total: print_progress(frames, total, kind_start))
+            done += len(relative_paths)
+            print(f"\n{data_root}: stored {stored} of {len(relative_paths)} {kind} images")
+
+    seconds = time.perf_counter() - start_time
+    print(f"Stored {done} images in {seconds:.1f} s ({done / seconds if seconds > 0 else 0:.0f} images/s)")
+
+
 def main():
-    preview(cli.parse_args())
+    args = cli.parse_args()
+    if args.command == 'render':
+        render(args)
+    elif args.command == 'convert':
+        convert(args)
+    elif args.command == 'pyramid':
+        pyramid(args)
+    else:
+        preview(args)
 
 
 if __name__ == "__main__":
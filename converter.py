@@ -1,15 +1,34 @@
 from math import floor
-import pandas as pd
+import numpy as np
 import os
+import hashlib
+import io
+import json
+import pathlib
+import tarfile
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Iterator, List, Optional, Tuple
 
 from datasetinsights.datasets.unity_perception import AnnotationDefinitions, MetricDefinitions
 from datasetinsights.datasets.unity_perception.captures import Captures
 
 from PIL import Image
 
+import helpers.dataset_index as dataset_index
+from helpers.image_size import ImageSizeCache, get_metadata_size
+
+# name of the annotation definition converted to Yolo labels
+DEFAULT_DEFINITION_NAME = "bounding box"
+
+
 class FileFormatError(Exception):
     pass
 
+
+class DefinitionNotFoundError(Exception):
+    pass
+
 def compute_yolo_param(x_abs_raw: int, y_abs_raw: int, width_abs_raw: int,
                     height_abs_raw: int, image_width: int,
                     image_height: int) -> list:
@@ -44,28 +63,6 @@ def compute_yolo_param(x_abs_raw: int, y_abs_raw: int, width_abs_raw: int,
     return [x_rel_prep, y_rel_prep, width_rel_prep, height_rel_prep]
 
 
-def convent_to_yolo_format(raw_labels: list, image_size:tuple)->list:
-    """The function generates files for labels in Yolo format
-
-    Args:
-        raw_labels (list): list of raw labels boxes
-        image_params (tuple): image size (width, height)
-
-    Returns:
-        list: list of yolo labels <object-class> <x_center> <y_center> <width> <height>
-    """
-    labels = []
-    image_width, image_height = image_size
-    for raw_label in raw_labels:
-        label_id = raw_label.get("label_id")
-        x_abs_raw = raw_label.get('x')
-        y_abs_raw = raw_label.get('y')
-        width_abs_raw = raw_label.get('width')
-        height_abs_raw = raw_label.get('height')
-        labels.append([label_id] + compute_yolo_param(x_abs_raw, y_abs_raw, width_abs_raw, height_abs_raw, image_width, image_height))
-
-    return labels
-
 def save_to_file(content: list, file_name: str, path_to_save_dir: str) -> bool:
     """The function saves labels to the file
 
@@ -110,70 +107,534 @@ def save_to_file_labels_name(labels_names: list, file_name: str,path_to_save_dir
         return False
     return True
 
-def prepare_ds_info(base_dataset_dir: str, auto_mode = True, manual_img_size = (0,0)) -> tuple[pd.DataFrame, list]:
-    """The functions prepare all information about dataset 
+
+# captures files pattern, the same as the one used by datasetinsights
+CAPTURES_FILE_PATTERN = "**/captures_*.json"
+DEFAULT_CHUNK_SIZE = 1000
+DEFAULT_NUM_WRITERS = min(8, os.cpu_count() or 1)
+# manifest of the incremental conversion, stored in the folder of the labels
+YOLO_MANIFEST_FILE = ".yolo_manifest.json"
+YOLO_MANIFEST_VERSION = 1
+# sharded conversion
+DEFAULT_SAMPLES_PER_SHARD = 1000
+SHARD_NAME_FORMAT = "shard-{:06d}.tar"
+# matches the names of SHARD_NAME_FORMAT, the shards of a previous conversion that are not in the new index are deleted
+SHARD_NAME_PATTERN = "shard-*.tar"
+SHARD_INDEX_FILE = "index.json"
+SHARD_INDEX_VERSION = 1
+
+
+class ConvertStats:
+    """Statistics of a streaming conversion
+
+    Attributes:
+        frames (int): number of frames converted
+        seconds (float): duration of the conversion
+        incremental (bool): whether unchanged frames were skipped
+        written (int): number of label files written
+        unchanged (int): number of label files left as they were, incremental conversion only
+        deleted (int): number of label files of frames that no longer exist that were deleted, incremental only
+        shards (int): number of shards written, sharded conversion only
+    """
+
+    def __init__(self, frames: int = 0, seconds: float = 0.0, incremental: bool = False):
+        self.frames = frames
+        self.seconds = seconds
+        self.incremental = incremental
+        self.written = 0
+        self.unchanged = 0
+        self.deleted = 0
+        self.shards = 0
+
+    @property
+    def frames_per_second(self) -> float:
+        return self.frames / self.seconds if self.seconds > 0 else 0.0
+
+    def __str__(self):
+        text = f"{self.frames} frames in {self.seconds:.1f} s ({self.frames_per_second:.0f} frames/s)"
+        if self.incremental:
+            text += f", {self.written} written, {self.unchanged} unchanged, {self.deleted} deleted"
+        if self.shards > 0:
+            text += f", {self.shards} shards"
+        return text
+
+
+def get_checksum(content: str) -> str:
+    return hashlib.sha1(content.encode("utf8")).hexdigest()
+
+
+class YoloManifest:
+    """Manifest of an incremental conversion: for every label file, the hash of the capture data it was computed from
+    and the checksum of its content
+
+    Attributes:
+        path_to_save_dir (str): folder of the labels
+        previous (dict): entries of the previous conversion, file name -> [source hash, output checksum]
+        current (dict): entries of the current conversion
+    """
+
+    def __init__(self, path_to_save_dir: str):
+        self.path_to_save_dir = path_to_save_dir
+        self.previous = {}
+        self.previous_object_names = None
+        try:
+            with open(os.path.join(path_to_save_dir, YOLO_MANIFEST_FILE), "r", encoding="utf8") as manifest_file:
+                manifest = json.load(manifest_file)
+            if manifest.get("version") == YOLO_MANIFEST_VERSION:
+                self.previous = manifest.get("frames", {})
+                self.previous_object_names = manifest.get("object_names")
+        except (OSError, ValueError):
+            pass
+        self.current = {}
+        self.object_names = None
+
+    @staticmethod
+    def get_source_hash(values: list, image_size: tuple) -> str:
+        """The function hashes everything the label file of a frame is computed from
+
+        Args:
+            values (list): annotation values of the frame
+            image_size (tuple): image size (width, height)
+
+        Returns:
+            str: hex digest
+        """
+        return get_checksum(json.dumps([values, list(image_size)], sort_keys=True))
+
+    def _is_up_to_date(self, file_name: str, entry: list, verify_outputs: bool) -> bool:
+        if self.previous.get(file_name) != entry:
+            return False
+        path = os.path.join(self.path_to_save_dir, file_name + ".txt")
+        if not verify_outputs:
+            return os.path.isfile(path)
+        try:
+            with open(path, "r") as txt_file:
+                return get_checksum(txt_file.read()) == entry[1]
+        except OSError:
+            return False
+
+    def filter_changed(self, files: List[Tuple[str, str]], source_hashes: List[str],
+                       verify_outputs: bool = False) -> List[Tuple[str, str]]:
+        """The function records the files of a chunk in the manifest and keeps the ones that need to be written
+
+        Args:
+            files (List[Tuple[str, str]]): file name and content of every frame, see format_yolo_chunk
+            source_hashes (List[str]): source hash of every frame, see get_source_hash
+            verify_outputs (bool): if true the existing files are read and compared with their checksum, otherwise
+                                   only their existence is checked
+
+        Returns:
+            List[Tuple[str, str]]: files that are new or changed
+        """
+        changed = []
+        for (file_name, content), source_hash in zip(files, source_hashes):
+            entry = [source_hash, get_checksum(content)]
+            self.current[file_name] = entry
+            if not self._is_up_to_date(file_name, entry, verify_outputs):
+                changed.append((file_name, content))
+        return changed
+
+    def object_names_changed(self, labels_names: list) -> bool:
+        """The function records the names of the labels and tells whether object_names.txt needs to be written
+
+        Args:
+            labels_names (list): list of labels name
+
+        Returns:
+            bool: true if the names changed or the file is missing
+        """
+        self.object_names = get_checksum("".join(labels_names))
+        return self.object_names != self.previous_object_names or \
+            not os.path.isfile(os.path.join(self.path_to_save_dir, "object_names.txt"))
+
+    def delete_orphans(self) -> int:
+        """The function deletes the label files of the previous conversion whose frames no longer exist
+
+        Returns:
+            int: number of deleted files
+        """
+        deleted = 0
+        for file_name in self.previous:
+            if file_name in self.current:
+                continue
+            try:
+                os.remove(os.path.join(self.path_to_save_dir, file_name + ".txt"))
+                deleted += 1
+            except FileNotFoundError:
+                pass
+        return deleted
+
+    def save(self) -> bool:
+        """The function writes the manifest of the current conversion
+
+        Returns:
+            bool: true if successfully save, else false
+        """
+        path = os.path.join(self.path_to_save_dir, YOLO_MANIFEST_FILE)
+        temp_path = path + dataset_index.get_temp_suffix()
+        try:
+            with open(temp_path, "w", encoding="utf8") as manifest_file:
+                json.dump({"version": YOLO_MANIFEST_VERSION, "object_names": self.object_names,
+                           "frames": self.current}, manifest_file)
+            os.replace(temp_path, path)
+        except OSError:
+            return False
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return True
+
+
+def get_definition_by_name(base_dataset_dir: str, name: str = DEFAULT_DEFINITION_NAME) -> dict:
+    """The function gets the annotation definition with the given name, the first one if several have that name
 
     Args:
-        base_dataset_dir (str): current base dataset di
+        base_dataset_dir (str): current base dataset dir
+        name (str): name of the annotation definition, the 2D bounding boxes by default
+
+    Returns:
+        dict: annotation definition record
+
+    Raises:
+        DefinitionNotFoundError: if the dataset has no annotation definition with that name
+    """
+    for definition in AnnotationDefinitions(base_dataset_dir).table.to_dict('records'):
+        if definition["name"] == name:
+            return definition
+    raise DefinitionNotFoundError("No annotation definition named \"" + name + "\" in " + base_dataset_dir)
+
+
+def iter_captures(base_dataset_dir: str, def_id: str) -> Iterator[Tuple[str, list, Optional[tuple]]]:
+    """The function reads the captures files one after the other and yields the annotations of the given definition,
+    only one captures file is in memory at a time
+
+    Args:
+        base_dataset_dir (str): current base dataset dir
+        def_id (str): annotation definition id
+
+    Yields:
+        Tuple[str, list, Optional[tuple]]: image filename, annotation values, image size if the capture holds it
+    """
+    for captures_file in pathlib.Path(base_dataset_dir).glob(CAPTURES_FILE_PATTERN):
+        with open(captures_file, "r", encoding="utf8") as json_file:
+            captures = json.load(json_file)["captures"]
+        for capture in captures:
+            for annotation in capture.get("annotations") or []:
+                if annotation.get("annotation_definition") == def_id:
+                    yield capture["filename"], annotation["values"], get_metadata_size(capture)
+
+
+def iter_chunks(captures: Iterator[tuple], chunk_size: int) -> Iterator[List[tuple]]:
+    """The function groups the captures in lists of chunk_size captures
+
+    Args:
+        captures (Iterator[tuple]): captures, see iter_captures
+        chunk_size (int): number of captures in a chunk
+
+    Yields:
+        List[tuple]: chunk of captures
+    """
+    chunk = []
+    for capture in captures:
+        chunk.append(capture)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def format_yolo_chunk(chunk: List[tuple], image_sizes: List[tuple]) -> List[Tuple[str, str]]:
+    """The function computes the Yolo labels of a chunk of captures with NumPy, the parameters of a box are the ones
+    computed by compute_yolo_param
+
+    Args:
+        chunk (List[tuple]): captures, see iter_captures
+        image_sizes (List[tuple]): image size (width, height) of every capture
+
+    Returns:
+        List[Tuple[str, str]]: label file name (without extension) and content of every capture
+    """
+    counts = [len(capture[1]) for capture in chunk]
+    boxes = [box for capture in chunk for box in capture[1]]
+    lines = []
+    if boxes:
+        # the boxes of a chunk are read once, building an AnnotationTable for them would cost more than the conversion
+        coordinates = np.array([[box.get('x'), box.get('y'), box.get('width'), box.get('height')] for box in boxes],
+                               dtype=np.float64)
+        sizes = np.repeat(np.array(image_sizes, dtype=np.float64).reshape(-1, 2), counts, axis=0)
+        assert (sizes != 0).all(), "The width or length of the image is zero"
+        x, y, width, height = coordinates.T
+        image_width, image_height = sizes.T
+        # same operations as compute_yolo_param, on float64 they give the same values
+        params = np.stack([(x + np.floor(width / 2)) / image_width,
+                           (y + np.floor(height / 2)) / image_height,
+                           width / image_width,
+                           height / image_height], axis=1)
+        # str of python floats gives the same text as formatting the result of compute_yolo_param
+        lines = [str(box.get("label_id")) + " " + " ".join(map(str, row)) + "\n"
+                 for box, row in zip(boxes, params.tolist())]
+
+    files = []
+    start = 0
+    for capture, count in zip(chunk, counts):
+        file_name = capture[0].split("/")[1].split(".")[0]
+        files.append((file_name, "".join(lines[start:start + count])))
+        start += count
+    return files
+
+
+def iter_yolo_chunks(base_dataset_dir: str, def_id: str, chunk_size: int, size_cache: Optional[ImageSizeCache],
+                     manual_img_size: tuple = (0, 0)) -> Iterator[Tuple[List[tuple], List[tuple], List[Tuple[str, str]]]]:
+    """The function reads the captures in chunks and computes their Yolo labels
+
+    Args:
+        base_dataset_dir (str): current base dataset dir
+        def_id (str): annotation definition id
+        chunk_size (int): number of captures converted at once
+        size_cache (Optional[ImageSizeCache]): cache used to get the image sizes in auto mode, None to use
+                                               manual_img_size
+        manual_img_size (tuple): manual image size, use if size_cache is None
+
+    Yields:
+        Tuple[List[tuple], List[tuple], List[Tuple[str, str]]]: captures (see iter_captures), image sizes and label
+                                                                files (see format_yolo_chunk) of a chunk
+    """
+    for chunk in iter_chunks(iter_captures(base_dataset_dir, def_id), chunk_size):
+        if size_cache is not None:
+            image_sizes = size_cache.get_sizes([capture[0] for capture in chunk], [capture[2] for capture in chunk])
+        else:
+            image_sizes = [manual_img_size] * len(chunk)
+        yield chunk, image_sizes, format_yolo_chunk(chunk, image_sizes)
+
+
+def save_files(files: List[Tuple[str, str]], path_to_save_dir: str) -> bool:
+    """The function saves label files
+
+    Args:
+        files (List[Tuple[str, str]]): file name (without extension) and content of every file
+        path_to_save_dir (str): the path to the directory where the files will be saved
+
+    Returns:
+        bool: true if successfully save, else false
+    """
+    for file_name, content in files:
+        if not save_to_file([content], file_name, path_to_save_dir):
+            return False
+    return True
+
+
+def submit_files(executor: ThreadPoolExecutor, files: List[Tuple[str, str]], path_to_save_dir: str,
+                 num_workers: int) -> List[Future]:
+    """The function hands label files to a pool of writing threads, one task per slice of the files so that every
+    writer gets work
+
+    Args:
+        executor (ThreadPoolExecutor): the pool of writing threads
+        files (List[Tuple[str, str]]): file name (without extension) and content of every file
+        path_to_save_dir (str): the path to the directory where the files will be saved
+        num_workers (int): number of threads of the pool
+
+    Returns:
+        List[Future]: the tasks, their result is the one of save_files
+    """
+    step = max(1, -(-len(files) // max(1, num_workers)))
+    return [executor.submit(save_files, files[i:i + step], path_to_save_dir) for i in range(0, len(files), step)]
+
+
+def wait_files(pending: List[Future], num_workers: int) -> bool:
+    """The function waits for the oldest tasks of submit_files until at most 2 * num_workers are left, which bounds the
+    number of chunks waiting to be written
+
+    Args:
+        pending (List[Future]): tasks returned by submit_files, the finished ones are removed
+        num_workers (int): number of threads of the pool, 0 to wait for every task
+
+    Returns:
+        bool: false if a file could not be saved
+    """
+    while len(pending) > 2 * num_workers:
+        if not pending.pop(0).result():
+            return False
+    return True
+
+
+def convert_streaming(base_dataset_dir: str, path_to_save_dir: str, auto_mode: bool = True,
+                      manual_img_size: tuple = (0, 0), chunk_size: int = DEFAULT_CHUNK_SIZE,
+                      num_workers: int = DEFAULT_NUM_WRITERS,
+                      on_progress: Optional[Callable[[ConvertStats], None]] = None,
+                      incremental: bool = False, verify_outputs: bool = False,
+                      definition_name: str = DEFAULT_DEFINITION_NAME) -> Optional[ConvertStats]:
+    """The function generates labels in Yolo format without loading the whole dataset in memory: captures are read
+    in chunks, the labels of a chunk are computed with NumPy and the files are written by a pool of threads
+
+    Args:
+        base_dataset_dir (str): current base dataset dir
+        path_to_save_dir (str): path dir whare save yolo lables
         auto_mode (bool): if true auto get image size mode else use manual image size from manual_img_size
         manual_img_size (tuple): manual image size, use if auto_mode False
+        chunk_size (int): number of captures converted at once
+        num_workers (int): number of threads writing files
+        on_progress (Callable[[ConvertStats], None]): optional, called after every chunk
+        incremental (bool): if true only the label files of new or changed frames are written and the label files of
+                            frames that no longer exist are deleted, based on the manifest of the previous incremental
+                            conversion in path_to_save_dir
+        verify_outputs (bool): incremental only, if true the content of unchanged label files is checked as well
+        definition_name (str): name of the annotation definition to convert
 
     Returns:
-        tuple[pd.DataFrame, list]: datsset info: image filenames, labels, labels name
-    """
-
-    assert  os.path.isdir(base_dataset_dir), "Not found base dataset dir"
-
-    labels_info = []
-    # get the parameters of the unity dataset using datasetinsights
-    captures = Captures(base_dataset_dir).filter(def_id=AnnotationDefinitions(base_dataset_dir).table.to_dict('records')[0]["id"])
-    # get image sizes auto or manual
-    if auto_mode:
-        # get the size for each image in a folder
-        image_params = []
-        for fn in captures["filename"]:
-            temp = tuple()
-            temp = Image.open(os.path.join(base_dataset_dir,fn)).size
-            image_params.append(temp)
-        pd_img_sizes = pd.Series(image_params).rename("img_params")
-    else:
-        # get sizes from manual_img_size
-        image_params = []
-        for _ in range(len(captures["filename"])):
-            image_params.append(manual_img_size)
-        pd_img_sizes = pd.Series(image_params).rename("img_params")
-    captures = pd.concat([captures["filename"], captures["annotation.values"], pd_img_sizes], axis=1)
-
-    # get the names of the labels
-    annotation_def = AnnotationDefinitions(data_root=base_dataset_dir)
-    definition_dict = annotation_def.get_definition(def_id=AnnotationDefinitions(base_dataset_dir).table.to_dict('records')[0]["id"])
-    for lb in definition_dict['spec']:
-        labels_info.append(lb["label_name"])
-
-    return (captures, labels_info)
-
-def convert(ds_info: tuple[pd.DataFrame, list], path_to_save_dir:str) -> bool:
-    """The function takes input information about the dataset and generates labels in Yolo format
+        Optional[ConvertStats]: statistics of the conversion, None if it failed
+    """
+    assert os.path.isdir(base_dataset_dir), "Not found base dataset dir"
+    start_time = time.perf_counter()
+
+    definition = get_definition_by_name(base_dataset_dir, definition_name)
+    labels_names = [lb["label_name"] for lb in definition['spec']]
+    manifest = YoloManifest(path_to_save_dir) if incremental else None
+    if manifest is None or manifest.object_names_changed(labels_names):
+        if not save_to_file_labels_name(labels_names, "object_names", path_to_save_dir):
+            return None
+
+    stats = ConvertStats(incremental=incremental)
+    size_cache = ImageSizeCache(base_dataset_dir) if auto_mode else None
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        pending = []
+        for chunk, image_sizes, files in iter_yolo_chunks(base_dataset_dir, definition["id"], chunk_size, size_cache,
+                                                          manual_img_size):
+            stats.frames += len(files)
+            if manifest is not None:
+                source_hashes = [YoloManifest.get_source_hash(capture[1], size)
+                                 for capture, size in zip(chunk, image_sizes)]
+                changed = manifest.filter_changed(files, source_hashes, verify_outputs)
+                stats.unchanged += len(files) - len(changed)
+                files = changed
+            stats.written += len(files)
+            pending.extend(submit_files(executor, files, path_to_save_dir, num_workers))
+            if not wait_files(pending, max(1, num_workers)):
+                return None
+            stats.seconds = time.perf_counter() - start_time
+            if on_progress is not None:
+                on_progress(stats)
+        if not wait_files(pending, 0):
+            return None
+
+    if manifest is not None:
+        stats.deleted = manifest.delete_orphans()
+        if not manifest.save():
+            return None
+    if size_cache is not None:
+        size_cache.save()
+    stats.seconds = time.perf_counter() - start_time
+    return stats
+
+
+def _add_tar_member(tar: tarfile.TarFile, name: str, data: bytes) -> List[int]:
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mode = 0o644
+    # the data starts right after the header
+    data_offset = tar.offset + len(info.tobuf(tar.format, tar.encoding, tar.errors))
+    tar.addfile(info, io.BytesIO(data))
+    return [data_offset, len(data)]
+
+
+def write_shard(path: str, base_dataset_dir: str, samples: List[Tuple[str, str, str]]) -> dict:
+    """The function writes a tar shard holding the image and the Yolo labels of every sample, members are named
+    <key>.<image extension> and <key>.txt like in WebDataset
 
     Args:
-        df_info tuple[pd.DataFrame, list]: dataset info image filenames, labels, labels name
-        path_to_save_dir (str): path dir whare save yolo lables
+        path (str): path of the tar file
+        base_dataset_dir (str): current base dataset dir
+        samples (List[Tuple[str, str, str]]): key, image filename and label file content of every sample
 
     Returns:
-        bool: true if successfully, else false
+        dict: index of the shard, the offset in the tar file and size of the image and the labels of every sample
     """
-    pd_df = ds_info[0]
-    labels_name = ds_info[1]
+    index = {}
+    temp_path = path + dataset_index.get_temp_suffix()
+    try:
+        with tarfile.open(temp_path, "w", format=tarfile.USTAR_FORMAT) as tar:
+            for key, filename, content in samples:
+                with open(os.path.join(base_dataset_dir, filename), "rb") as image_file:
+                    image = image_file.read()
+                extension = os.path.splitext(filename)[1].lower()
+                index[key] = {
+                    "image": _add_tar_member(tar, key + extension, image),
+                    "label": _add_tar_member(tar, key + ".txt", content.encode("utf8")),
+                }
+        os.replace(temp_path, path)
+    finally:
+        # a shard that could not be written completely is not left behind
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return {"name": os.path.basename(path), "samples": len(samples), "bytes": os.path.getsize(path),
+            "index": index}
+
+
+def convert_sharded(base_dataset_dir: str, path_to_save_dir: str, auto_mode: bool = True,
+                    manual_img_size: tuple = (0, 0), samples_per_shard: int = DEFAULT_SAMPLES_PER_SHARD,
+                    num_workers: int = DEFAULT_NUM_WRITERS,
+                    on_progress: Optional[Callable[[ConvertStats], None]] = None,
+                    definition_name: str = DEFAULT_DEFINITION_NAME) -> Optional[ConvertStats]:
+    """The function packs the images and their labels in Yolo format into tar shards of samples_per_shard frames
+    (WebDataset layout) instead of writing one label file per frame. The shards are written in parallel and described
+    by SHARD_INDEX_FILE, which also holds the names of the labels and the position of every sample in its shard
 
-    if not save_to_file_labels_name(labels_name, "object_names", path_to_save_dir):
-        return False
+    Args:
+        base_dataset_dir (str): current base dataset dir
+        path_to_save_dir (str): path dir where the shards are saved
+        auto_mode (bool): if true auto get image size mode else use manual image size from manual_img_size
+        manual_img_size (tuple): manual image size, use if auto_mode False
+        samples_per_shard (int): number of frames in a shard
+        num_workers (int): number of shards written at the same time
+        on_progress (Callable[[ConvertStats], None]): optional, called every time a shard is submitted
+        definition_name (str): name of the annotation definition to convert
 
-    for _, row in pd_df.iterrows():
-        row["annotation.values"] = convent_to_yolo_format(row["annotation.values"],
-        row["img_params"])
-        file_name = row["filename"].split("/")[1].split(".")[0]
-        content = [" ".join(map(str,l))+"\n" for l in row["annotation.values"]]
-        if not save_to_file(content, file_name, path_to_save_dir):
-            return False
+    Returns:
+        Optional[ConvertStats]: statistics of the conversion, None if it failed
+    """
+    assert os.path.isdir(base_dataset_dir), "Not found base dataset dir"
+    start_time = time.perf_counter()
 
-    return True
\ No newline at end of file
+    definition = get_definition_by_name(base_dataset_dir, definition_name)
+    stats = ConvertStats()
+    size_cache = ImageSizeCache(base_dataset_dir) if auto_mode else None
+    shards = []
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+            pending = []
+            for chunk, _, files in iter_yolo_chunks(base_dataset_dir, definition["id"], samples_per_shard,
+                                                    size_cache, manual_img_size):
+                samples = [(file_name, capture[0], content) for capture, (file_name, content) in zip(chunk, files)]
+                shard_path = os.path.join(path_to_save_dir, SHARD_NAME_FORMAT.format(stats.shards))
+                pending.append(executor.submit(write_shard, shard_path, base_dataset_dir, samples))
+                # bound the number of shards held in memory
+                while len(pending) > 2 * max(1, num_workers):
+                    shards.append(pending.pop(0).result())
+                stats.frames += len(files)
+                stats.written = stats.frames
+                stats.shards += 1
+                stats.seconds = time.perf_counter() - start_time
+                if on_progress is not None:
+                    on_progress(stats)
+            shards.extend(future.result() for future in pending)
+
+        with open(os.path.join(path_to_save_dir, SHARD_INDEX_FILE), "w", encoding="utf8") as index_file:
+            json.dump({
+                "version": SHARD_INDEX_VERSION,
+                "object_names": [lb["label_name"] for lb in definition['spec']],
+                "shards": shards,
+            }, index_file)
+        # shards of a previous conversion with more frames would be mistaken for part of this one
+        shard_names = {shard["name"] for shard in shards}
+        for stale_path in pathlib.Path(path_to_save_dir).glob(SHARD_NAME_PATTERN):
+            if stale_path.name not in shard_names:
+                stale_path.unlink()
+    except OSError as e:
+        print("It is impossible to save the shards: " + str(e))
+        return None
+
+    if size_cache is not None:
+        size_cache.save()
+    stats.seconds = time.perf_counter() - start_time
+    return stats
@@ -0,0 +1,274 @@
+import abc
+import json
+import os
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+from converter import (ConvertStats, DEFAULT_CHUNK_SIZE, DEFAULT_DEFINITION_NAME, DEFAULT_NUM_WRITERS,
+                       format_yolo_chunk, get_definition_by_name, iter_captures, iter_chunks, save_to_file_labels_name,
+                       submit_files, wait_files)
+from helpers.image_size import ImageSizeCache
+
+
+class ExportWriter(abc.ABC):
+    """Base class of the writers of an export format, the engine calls begin once, write_chunk for every chunk of
+    captures in order and finish once when every chunk was written. Once begin was called the engine always calls
+    close, also when the export fails. Different writers run at the same time, a writer is only called from one
+    thread at a time
+
+    Attributes:
+        path_to_save_dir (str): the path to the directory where the files are saved
+        num_workers (int): number of threads the writer may use to write its files, writers that write from the
+            calling thread ignore it
+    """
+
+    name = ""
+
+    def __init__(self, path_to_save_dir: str, num_workers: int = DEFAULT_NUM_WRITERS):
+        self.path_to_save_dir = path_to_save_dir
+        self.num_workers = max(1, num_workers)
+
+    def begin(self, definition: dict) -> bool:
+        """The function prepares the export
+
+        Args:
+            definition (dict): annotation definition record that is exported
+
+        Returns:
+            bool: true if successfully, else false
+        """
+        return True
+
+    @abc.abstractmethod
+    def write_chunk(self, chunk: List[tuple], image_sizes: List[tuple]) -> bool:
+        """The function exports a chunk of captures
+
+        Args:
+            chunk (List[tuple]): captures, see converter.iter_captures
+            image_sizes (List[tuple]): image size (width, height) of every capture
+
+        Returns:
+            bool: true if successfully, else false
+        """
+
+    def finish(self) -> bool:
+        """The function completes the export
+
+        Returns:
+            bool: true if successfully, else false
+        """
+        return True
+
+    def close(self):
+        """The function releases what begin acquired, it is called after finish or after the export failed"""
+
+
+class YoloWriter(ExportWriter):
+    """Yolo labels, one text file per frame and object_names.txt, the same files as converter.convert. The files are
+    written by a pool of threads like in converter.convert_streaming
+
+    """
+
+    name = "yolo"
+
+    def __init__(self, path_to_save_dir: str, num_workers: int = DEFAULT_NUM_WRITERS):
+        super().__init__(path_to_save_dir, num_workers)
+        self.executor = None
+        self.pending = []
+
+    def begin(self, definition: dict) -> bool:
+        self.executor = ThreadPoolExecutor(max_workers=self.num_workers)
+        self.pending = []
+        return save_to_file_labels_name([lb["label_name"] for lb in definition['spec']], "object_names",
+                                        self.path_to_save_dir)
+
+    def write_chunk(self, chunk: List[tuple], image_sizes: List[tuple]) -> bool:
+        files = format_yolo_chunk(chunk, image_sizes)
+        self.pending.extend(submit_files(self.executor, files, self.path_to_save_dir, self.num_workers))
+        return wait_files(self.pending, self.num_workers)
+
+    def finish(self) -> bool:
+        return wait_files(self.pending, 0)
+
+    def close(self):
+        if self.executor is not None:
+            # the files already submitted are completed, a failed export leaves no thread behind
+            self.executor.shutdown()
+            self.executor = None
+        self.pending = []
+
+
+class CocoWriter(ExportWriter):
+    """COCO object detection json, written at the end in a single file
+
+    Attributes:
+        file_name (str): name of the json file
+    """
+
+    name = "coco"
+
+    def __init__(self, path_to_save_dir: str, num_workers: int = DEFAULT_NUM_WRITERS,
+                 file_name: str = "annotations.json"):
+        super().__init__(path_to_save_dir, num_workers)
+        self.file_name = file_name
+        self.images = []
+        self.annotations = []
+        self.categories = []
+
+    def begin(self, definition: dict) -> bool:
+        self.categories = [{"id": lb["label_id"], "name": lb["label_name"]} for lb in definition['spec']]
+        return True
+
+    def write_chunk(self, chunk: List[tuple], image_sizes: List[tuple]) -> bool:
+        for (filename, values, _), (width, height) in zip(chunk, image_sizes):
+            image_id = len(self.images) + 1
+            self.images.append({"id": image_id, "file_name": filename, "width": width, "height": height})
+            for box in values:
+                self.annotations.append({
+                    "id": len(self.annotations) + 1,
+                    "image_id": image_id,
+                    "category_id": box.get("label_id"),
+                    "bbox": [box.get("x"), box.get("y"), box.get("width"), box.get("height")],
+                    "area": box.get("width") * box.get("height"),
+                    "iscrowd": 0,
+                })
+        return True
+
+    def finish(self) -> bool:
+        try:
+            with open(os.path.join(self.path_to_save_dir, self.file_name), "w", encoding="utf8") as json_file:
+                json.dump({"images": self.images, "annotations": self.annotations, "categories": self.categories},
+                          json_file)
+        except OSError as e:
+            print("It is impossible to save the file: " + str(e))
+            return False
+        return True
+
+
+class VocWriter(ExportWriter):
+    """Pascal VOC xml, one file per frame"""
+
+    name = "voc"
+
+    def __init__(self, path_to_save_dir: str, num_workers: int = DEFAULT_NUM_WRITERS):
+        super().__init__(path_to_save_dir, num_workers)
+        self.label_names = {}
+
+    def begin(self, definition: dict) -> bool:
+        self.label_names = {lb["label_id"]: lb["label_name"] for lb in definition['spec']}
+        return True
+
+    def write_chunk(self, chunk: List[tuple], image_sizes: List[tuple]) -> bool:
+        for (filename, values, _), (width, height) in zip(chunk, image_sizes):
+            annotation = ET.Element("annotation")
+            ET.SubElement(annotation, "folder").text = os.path.dirname(filename)
+            ET.SubElement(annotation, "filename").text = os.path.basename(filename)
+            size = ET.SubElement(annotation, "size")
+            ET.SubElement(size, "width").text = str(width)
+            ET.SubElement(size, "height").text = str(height)
+            ET.SubElement(size, "depth").text = "3"
+            for box in values:
+                label_object = ET.SubElement(annotation, "object")
+                ET.SubElement(label_object, "name").text = str(
+                    self.label_names.get(box.get("label_id"), box.get("label_name")))
+                ET.SubElement(label_object, "pose").text = "Unspecified"
+                ET.SubElement(label_object, "truncated").text = "0"
+                ET.SubElement(label_object, "difficult").text = "0"
+                bndbox = ET.SubElement(label_object, "bndbox")
+                ET.SubElement(bndbox, "xmin").text = str(round(box.get("x")))
+                ET.SubElement(bndbox, "ymin").text = str(round(box.get("y")))
+                ET.SubElement(bndbox, "xmax").text = str(round(box.get("x") + box.get("width")))
+                ET.SubElement(bndbox, "ymax").text = str(round(box.get("y") + box.get("height")))
+            file_name = os.path.splitext(os.path.basename(filename))[0]
+            try:
+                ET.ElementTree(annotation).write(os.path.join(self.path_to_save_dir, file_name + ".xml"),
+                                                 encoding="utf-8")
+            except OSError as e:
+                print("It is impossible to save the file: " + str(e))
+                return False
+        return True
+
+
+# writer class of every format, by name
+WRITERS = {writer.name: writer for writer in (YoloWriter, CocoWriter, VocWriter)}
+
+
+def export(base_dataset_dir: str, writers: List[ExportWriter], definition_name: str = DEFAULT_DEFINITION_NAME,
+           auto_mode: bool = True, manual_img_size: tuple = (0, 0), chunk_size: int = DEFAULT_CHUNK_SIZE,
+           on_progress: Optional[Callable[[ConvertStats], None]] = None) -> Optional[ConvertStats]:
+    """The function reads the captures of the dataset once and hands every chunk of captures to all the writers,
+    which run at the same time in a pool of threads
+
+    Args:
+        base_dataset_dir (str): current base dataset dir
+        writers (List[ExportWriter]): writers of the formats to export
+        definition_name (str): name of the annotation definition to export
+        auto_mode (bool): if true auto get image size mode else use manual image size from manual_img_size
+        manual_img_size (tuple): manual image size, use if auto_mode False
+        chunk_size (int): number of captures handed to the writers at once
+        on_progress (Callable[[ConvertStats], None]): optional, called after every chunk
+
+    Returns:
+        Optional[ConvertStats]: statistics of the export, None if a writer failed
+    """
+    assert os.path.isdir(base_dataset_dir), "Not found base dataset dir"
+    start_time = time.perf_counter()
+
+    definition = get_definition_by_name(base_dataset_dir, definition_name)
+    stats = ConvertStats()
+    size_cache = ImageSizeCache(base_dataset_dir) if auto_mode else None
+    begun = []
+    try:
+        for writer in writers:
+            begun.append(writer)
+            if not writer.begin(definition):
+                return None
+
+        with ThreadPoolExecutor(max_workers=max(1, len(writers))) as executor:
+            for chunk in iter_chunks(iter_captures(base_dataset_dir, definition["id"]), chunk_size):
+                if size_cache is not None:
+                    image_sizes = size_cache.get_sizes([capture[0] for capture in chunk],
+                                                       [capture[2] for capture in chunk])
+                else:
+                    image_sizes = [manual_img_size] * len(chunk)
+                results = list(executor.map(lambda writer: writer.write_chunk(chunk, image_sizes), writers))
+                if not all(results):
+                    return None
+                stats.frames += len(chunk)
+                stats.written = stats.frames
+                stats.seconds = time.perf_counter() - start_time
+                if on_progress is not None:
+                    on_progress(stats)
+
+        # every writer completes its export, even after another one failed
+        if not all([writer.finish() for writer in writers]):
+            return None
+    finally:
+        for writer in begun:
+            writer.close()
+    if size_cache is not None:
+        size_cache.save()
+    stats.seconds = time.perf_counter() - start_time
+    return stats
+
+
+def create_writers(formats: List[str], path_to_save_dir: str,
+                   num_workers: int = DEFAULT_NUM_WRITERS) -> List[ExportWriter]:
+    """The function creates the writers of the given formats, each format is saved in a sub folder named after it
+
+    Args:
+        formats (List[str]): names of the formats, keys of WRITERS
+        path_to_save_dir (str): the path to the directory where the formats are saved
+        num_workers (int): number of threads each writer may use to write its files
+
+    Returns:
+        List[ExportWriter]: the writers
+    """
+    writers = []
+    for format_name in formats:
+        format_dir = os.path.join(path_to_save_dir, format_name)
+        os.makedirs(format_dir, exist_ok=True)
+        writers.append(WRITERS[format_name](format_dir, num_workers))
+    return writers
@@ -0,0 +1,351 @@
+from typing import Dict, List, Optional
+
+import numpy as np
+
+# --------------------------------Annotation store-----------------------------------------------------------------------
+# Compact storage of the annotation values of a definition. The values of a frame are a list of records (dicts), e.g.
+# the 2D boxes of the frame. Instead of millions of small dicts the records of all the frames are stored as one NumPy
+# array per field, and offsets[i]:offsets[i + 1] are the records of frame i (CSR layout).
+# Nested dicts are flattened into dotted field names ("translation.x", a dot or backslash inside a key is escaped with a
+# backslash) and lists of dicts (e.g. the keypoints of a figure) become a child table whose rows are the records. Numbers are stored as int64 or float64, strings as codes
+# into a list of categories, and values of any other type as object arrays.
+
+FIELD_SEPARATOR = "."
+FIELD_ESCAPE = "\\"
+
+# kinds of columns
+NUMBER = "number"
+STRING = "string"
+CHILD = "child"
+OBJECT = "object"
+
+# marks a field missing from a record (or None) while building the columns
+_MISSING = object()
+
+
+def _escape_key(key: str) -> str:
+    return key.replace(FIELD_ESCAPE, FIELD_ESCAPE + FIELD_ESCAPE).replace(FIELD_SEPARATOR, FIELD_ESCAPE + FIELD_SEPARATOR)
+
+
+def _split_name(name: str) -> List[str]:
+    """ Splits a field name into the keys of the nested dicts, see _escape_key """
+    keys = [""]
+    escaped = False
+    for character in name:
+        if escaped:
+            keys[-1] += character
+            escaped = False
+        elif character == FIELD_ESCAPE:
+            escaped = True
+        elif character == FIELD_SEPARATOR:
+            keys.append("")
+        else:
+            keys[-1] += character
+    return keys
+
+
+def _flatten_record(record: dict, prefix: str, flat: Dict[str, any]):
+    for key, value in record.items():
+        name = prefix + _escape_key(str(key))
+        if isinstance(value, dict) and len(value) > 0:
+            _flatten_record(value, name + FIELD_SEPARATOR, flat)
+        else:
+            flat[name] = value
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class AnnotationColumn:
+    """ One field of the records of an AnnotationTable
+
+    :param kind: NUMBER, STRING, CHILD or OBJECT
+    :param values: values of the records, codes into categories for STRING columns, unused for CHILD columns
+    :param valid: Optional, false for the records that do not have the field or where it is None
+    :param categories: strings of a STRING column
+    :param child: table of a CHILD column, its frames are the records of the parent table
+    :param nulls: Optional, true for the records where the field is None, the other invalid records do not have it
+    :param integers: Optional, true for the ints of a float64 NUMBER column that holds both ints and floats
+    """
+
+    def __init__(self, kind: str, values: Optional[np.ndarray] = None, valid: Optional[np.ndarray] = None,
+                 categories: Optional[List[str]] = None, child: Optional["AnnotationTable"] = None,
+                 nulls: Optional[np.ndarray] = None, integers: Optional[np.ndarray] = None):
+        self.kind = kind
+        self.values = values
+        self.valid = valid
+        self.categories = categories
+        self.child = child
+        self.nulls = nulls
+        self.integers = integers
+
+    @staticmethod
+    def from_values(values: List[any]) -> "AnnotationColumn":
+        """ Stores the values of a field, _MISSING for the records without it
+
+        :param values: value of every record
+        :type values: List[any]
+        :return: the column
+        :rtype: AnnotationColumn
+        """
+        present = [value for value in values if value is not _MISSING and value is not None]
+        valid = None
+        nulls = None
+        if len(present) < len(values):
+            valid = np.fromiter((value is not _MISSING and value is not None for value in values), dtype=bool,
+                                count=len(values))
+            # None is kept apart from a missing field so that get_records gives back the same keys
+            if any(value is None for value in values):
+                nulls = np.fromiter((value is None for value in values), dtype=bool, count=len(values))
+
+        if all(_is_number(value) for value in present):
+            is_int = [isinstance(value, int) for value in present]
+            dtype = np.int64 if all(is_int) else np.float64
+            integers = None
+            if dtype == np.float64 and any(is_int):
+                integers = np.fromiter((isinstance(value, int) and not isinstance(value, bool) for value in values),
+                                       dtype=bool, count=len(values))
+            try:
+                return AnnotationColumn(NUMBER, np.array([value if value is not _MISSING and value is not None
+                                                          else 0 for value in values], dtype=dtype), valid,
+                                        nulls=nulls, integers=integers)
+            except OverflowError:
+                pass
+        elif all(isinstance(value, str) for value in present):
+            codes = {}
+            array = np.fromiter((codes.setdefault(value, len(codes)) if isinstance(value, str) else -1
+                                 for value in values), dtype=np.int32, count=len(values))
+            return AnnotationColumn(STRING, array, valid, categories=list(codes), nulls=nulls)
+        elif all(isinstance(value, list) and all(isinstance(item, dict) for item in value) for value in present):
+            return AnnotationColumn(CHILD, valid=valid, child=AnnotationTable.from_values(
+                [value if isinstance(value, list) else [] for value in values]), nulls=nulls)
+
+        array = np.empty(len(values), dtype=object)
+        for i, value in enumerate(values):
+            # set one by one, numpy would otherwise read lists of the same length as a second dimension
+            array[i] = None if value is _MISSING else value
+        return AnnotationColumn(OBJECT, array, valid, nulls=nulls)
+
+    def get(self, start: int, end: int) -> List[any]:
+        """ Gets the values of records start to end as python objects, None where the field is missing
+
+        :param start: first record
+        :type start: int
+        :param end: record after the last one
+        :type end: int
+        :return: values of the records
+        :rtype: List[any]
+        """
+        if self.kind == CHILD:
+            values = [self.child.get_records(i) for i in range(start, end)]
+        elif self.kind == STRING:
+            values = [self.categories[code] if code >= 0 else None for code in self.values[start:end].tolist()]
+        elif self.integers is not None:
+            values = [int(value) if is_int else value
+                      for value, is_int in zip(self.values[start:end].tolist(), self.integers[start:end].tolist())]
+        else:
+            values = self.values[start:end].tolist()
+        if self.valid is not None:
+            values = [value if valid else None for value, valid in zip(values, self.valid[start:end].tolist())]
+        return values
+
+    def to_state(self) -> dict:
+        """ Gets the content of the column as NumPy arrays without objects and JSON values, see from_state
+
+        :return: the state of the column
+        :rtype: dict
+        """
+        return {
+            "kind": self.kind,
+            # values of OBJECT columns come from json files, they are stored as a list
+            "values": self.values.tolist() if self.kind == OBJECT else self.values,
+            "valid": self.valid,
+            "categories": self.categories,
+            "child": None if self.child is None else self.child.to_state(),
+            "nulls": self.nulls,
+            "integers": self.integers,
+        }
+
+    @staticmethod
+    def from_state(state: dict) -> "AnnotationColumn":
+        """ Rebuilds a column from the result of to_state
+
+        :param state: the state of the column
+        :type state: dict
+        :return: the column
+        :rtype: AnnotationColumn
+        """
+        values = state["values"]
+        if state["kind"] == OBJECT:
+            array = np.empty(len(values), dtype=object)
+            for i, value in enumerate(values):
+                array[i] = value
+            values = array
+        child = None if state["child"] is None else AnnotationTable.from_state(state["child"])
+        return AnnotationColumn(state["kind"], values, state["valid"], state["categories"], child, state["nulls"],
+                                state["integers"])
+
+    def nbytes(self) -> int:
+        size = sum(mask.nbytes for mask in (self.valid, self.nulls, self.integers) if mask is not None)
+        if self.kind == CHILD:
+            return size + self.child.nbytes()
+        size += self.values.nbytes
+        if self.kind == STRING:
+            size += sum(len(category) for category in self.categories)
+        return size
+
+
+class AnnotationTable:
+    """ Annotation values of the frames of a definition, stored column by column
+
+    :param offsets: records of frame i are offsets[i] to offsets[i + 1], length is the number of frames + 1
+    :param columns: field name -> column, in the order of the fields in the records
+    """
+
+    def __init__(self, offsets: np.ndarray, columns: Dict[str, AnnotationColumn]):
+        self.offsets = offsets
+        self.columns = columns
+
+    @staticmethod
+    def from_values(values: List[any]) -> "AnnotationTable":
+        """ Converts the annotation values of every frame into columns
+
+        :param values: list of records of every frame, anything that is not a list is stored as a frame without records
+        :type values: List[any]
+        :return: the table
+        :rtype: AnnotationTable
+        """
+        counts = np.fromiter((len(value) if isinstance(value, list) else 0 for value in values), dtype=np.int64,
+                             count=len(values))
+        offsets = np.zeros(len(values) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+
+        flat_records = []
+        names = {}
+        for value in values:
+            if not isinstance(value, list):
+                continue
+            for record in value:
+                flat = {}
+                if isinstance(record, dict):
+                    _flatten_record(record, "", flat)
+                    for name in flat:
+                        names.setdefault(name, None)
+                flat_records.append(flat)
+        columns = {name: AnnotationColumn.from_values([flat.get(name, _MISSING) for flat in flat_records])
+                   for name in names}
+        return AnnotationTable(offsets, columns)
+
+    def length(self) -> int:
+        return len(self.offsets) - 1
+
+    def get_range(self, index: int) -> range:
+        """ Gets the positions of the records of the frame in the columns
+
+        :param index: The index of the frame
+        :type index: int
+        :return: the positions
+        :rtype: range
+        """
+        return range(int(self.offsets[index]), int(self.offsets[index + 1]))
+
+    def get_counts(self) -> np.ndarray:
+        """ Gets the number of records of every frame
+
+        :return: number of records per frame
+        :rtype: np.ndarray
+        """
+        return np.diff(self.offsets)
+
+    def get_frames(self) -> np.ndarray:
+        """ Gets the frame of every record
+
+        :return: frame index per record
+        :rtype: np.ndarray
+        """
+        return np.repeat(np.arange(self.length(), dtype=np.int64), self.get_counts())
+
+    def has_column(self, name: str) -> bool:
+        return name in self.columns
+
+    def get_column(self, name: str, index: Optional[int] = None, default: any = 0) -> np.ndarray:
+        """ Gets the values of a NUMBER column, or the codes of a STRING column
+
+        :param name: field name, dotted for nested fields, with the dots and backslashes of the keys escaped
+        :type name: str
+        :param index: Optional, only the records of this frame, the records of every frame if None
+        :type index: int
+        :param default: Optional (Default: 0), value of the records without the field
+        :return: the values
+        :rtype: np.ndarray
+        """
+        column = self.columns.get(name)
+        if index is None:
+            start, end = 0, int(self.offsets[-1])
+        else:
+            start, end = int(self.offsets[index]), int(self.offsets[index + 1])
+        if column is None or column.kind not in (NUMBER, STRING):
+            return np.full(end - start, default)
+        values = column.values[start:end]
+        if column.valid is not None and not column.valid[start:end].all():
+            values = np.where(column.valid[start:end], values, default)
+        return values
+
+    def get_records(self, index: int) -> List[dict]:
+        """ Rebuilds the records of the frame as they were read from the json files, for code that needs dicts. Ints
+        stored in a column that also holds floats lose the precision of float64 past 2 ** 53
+
+        :param index: The index of the frame
+        :type index: int
+        :return: the records of the frame
+        :rtype: List[dict]
+        """
+        start, end = int(self.offsets[index]), int(self.offsets[index + 1])
+        records = [{} for _ in range(end - start)]
+        for name, column in self.columns.items():
+            keys = _split_name(name) if FIELD_ESCAPE in name else name.split(FIELD_SEPARATOR)
+            present = [True] * (end - start)
+            if column.valid is not None:
+                present = column.valid[start:end]
+                if column.nulls is not None:
+                    present = present | column.nulls[start:end]
+                present = present.tolist()
+            for record, value, has_field in zip(records, column.get(start, end), present):
+                if not has_field:
+                    # the record did not have the field
+                    continue
+                parent = record
+                for key in keys[:-1]:
+                    parent = parent.setdefault(key, {})
+                parent[keys[-1]] = value
+        return records
+
+    def to_state(self) -> dict:
+        """ Gets the content of the table as NumPy arrays without objects and JSON values, that can be stored in the
+        dataset index
+
+        :return: the state of the table
+        :rtype: dict
+        """
+        return {"offsets": self.offsets, "columns": {name: column.to_state() for name, column in self.columns.items()}}
+
+    @staticmethod
+    def from_state(state: dict) -> "AnnotationTable":
+        """ Rebuilds a table from the result of to_state
+
+        :param state: the state of the table
+        :type state: dict
+        :return: the table
+        :rtype: AnnotationTable
+        """
+        return AnnotationTable(state["offsets"], {name: AnnotationColumn.from_state(column)
+                                                  for name, column in state["columns"].items()})
+
+    def nbytes(self) -> int:
+        """ Gets the memory used by the arrays of the table
+
+        :return: number of bytes
+        :rtype: int
+        """
+        return self.offsets.nbytes + sum(column.nbytes() for column in self.columns.values())
@@ -0,0 +1,145 @@
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image, ImageDraw
+
+from Dataset import Dataset
+
+# --------------------------------Batch rendering------------------------------------------------------------------------
+# Renders annotated frames of a dataset to image files without streamlit, used by the render command of cli.py.
+# Every worker process opens the dataset once (from the dataset index) and writes the files it renders itself, so
+# that no image goes through inter-process communication. The frames go through the disk thumbnail cache when it is
+# enabled (see thumbnail_cache.configure), the one the app uses.
+
+DEFAULT_NUM_WORKERS = os.cpu_count() or 1
+# frames rendered by a worker per task when not rendering contact sheets
+FRAMES_PER_TASK = 16
+
+# dataset opened by the worker process
+_worker_dataset = None
+
+
+def select_indices(dataset_size: int, start: int = 0, end: Optional[int] = None, sample: Optional[int] = None,
+                   seed: int = 0) -> List[int]:
+    """ Selects the frames to render
+
+    :param dataset_size: number of frames of the dataset
+    :type dataset_size: int
+    :param start: Optional (Default: 0), first frame index
+    :type start: int
+    :param end: Optional, frame index after the last one, the end of the dataset if None
+    :type end: int
+    :param sample: Optional, if set this many frames are picked at random in [start, end)
+    :type sample: int
+    :param seed: Optional (Default: 0), seed of the random sampling
+    :type seed: int
+    :return: sorted frame indices
+    :rtype: List[int]
+    """
+    end = dataset_size if end is None else min(end, dataset_size)
+    indices = list(range(max(0, start), end))
+    if sample is not None and sample < len(indices):
+        indices = sorted(random.Random(seed).sample(indices, sample))
+    return indices
+
+
+def create_contact_sheet(images: List[Tuple[int, Image.Image]], num_cols: int, num_rows: int) -> Image.Image:
+    """ Lays out frames on a grid, each frame is captioned with its index
+
+    :param images: (frame index, image) of every frame, at most num_cols * num_rows
+    :type images: List[Tuple[int, PIL.Image]]
+    :param num_cols: number of columns of the grid
+    :type num_cols: int
+    :param num_rows: number of rows of the grid
+    :type num_rows: int
+    :return: the contact sheet
+    :rtype: PIL.Image
+    """
+    cell_width = max(image.width for _, image in images)
+    cell_height = max(image.height for _, image in images)
+    sheet = Image.new("RGB", (cell_width * num_cols, cell_height * num_rows), (255, 255, 255))
+    draw = ImageDraw.Draw(sheet)
+    for position, (index, image) in enumerate(images):
+        left = (position % num_cols) * cell_width
+        top = (position // num_cols) * cell_height
+        sheet.paste(image.convert("RGB"),
+                    (left + (cell_width - image.width) // 2, top + (cell_height - image.height) // 2))
+        draw.text((left + 4, top + 4), str(index), fill=(255, 255, 255), stroke_width=2, stroke_fill=(0, 0, 0))
+    return sheet
+
+
+def _init_worker(data_root: str):
+    global _worker_dataset
+    _worker_dataset = Dataset(data_root)
+
+
+def _render_task(task: Tuple[List[int], Dict[str, bool], int, str, str, Optional[Tuple[int, int, int]]]) -> int:
+    indices, labelers, max_size, output_dir, image_format, sheet = task
+    # every frame is rendered once, only the disk thumbnail cache shared with the app is worth going through
+    images = [(index, _worker_dataset.get_image_with_labelers(index, labelers, max_size=max_size,
+                                                              use_render_cache=False))
+              for index in indices]
+    extension = "." + image_format.lower()
+    if sheet is None:
+        for index, image in images:
+            image.convert("RGB").save(os.path.join(output_dir, "frame_{:06d}".format(index) + extension))
+    else:
+        sheet_number, num_cols, num_rows = sheet
+        create_contact_sheet(images, num_cols, num_rows).save(
+            os.path.join(output_dir, "sheet_{:04d}".format(sheet_number) + extension))
+    return len(images)
+
+
+def render(data_root: str, indices: List[int], labelers: Dict[str, bool], output_dir: str, max_size: int = 500,
+           image_format: str = "png", grid: Optional[Tuple[int, int]] = None,
+           num_workers: int = DEFAULT_NUM_WORKERS) -> Tuple[int, int, float]:
+    """ Renders the given frames with the given labelers to files in output_dir, either one file per frame
+    (frame_<index>.<format>) or contact sheets of grid frames (sheet_<number>.<format>)
+
+    :param data_root: Root directory of the dataset
+    :type data_root: str
+    :param indices: frames to render
+    :type indices: List[int]
+    :param labelers: Dictionary of labeler name to whether or not to display it
+    :type labelers: Dict[str, bool]
+    :param output_dir: directory where the files are written, it is created if needed
+    :type output_dir: str
+    :param max_size: Optional (Default: 500), maximum size of width and height of a frame
+    :type max_size: int
+    :param image_format: Optional (Default: png), png or jpg
+    :type image_format: str
+    :param grid: Optional, (number of columns, number of rows) of the contact sheets
+    :type grid: Tuple[int, int]
+    :param num_workers: Optional (Default: DEFAULT_NUM_WORKERS), number of processes rendering frames
+    :type num_workers: int
+    :return: (number of frames rendered, number of files written, seconds)
+    :rtype: Tuple[int, int, float]
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    start_time = time.perf_counter()
+    if grid is None:
+        tasks = [(indices[i:i + FRAMES_PER_TASK], labelers, max_size, output_dir, image_format, None)
+                 for i in range(0, len(indices), FRAMES_PER_TASK)]
+        num_files = len(indices)
+    else:
+        num_cols, num_rows = grid
+        page_size = num_cols * num_rows
+        tasks = [(indices[i:i + page_size], labelers, max_size, output_dir, image_format,
+                  (i // page_size, num_cols, num_rows))
+                 for i in range(0, len(indices), page_size)]
+        num_files = len(tasks)
+
+    num_frames = 0
+    if num_workers <= 1:
+        _init_worker(data_root)
+        for task in tasks:
+            num_frames += _render_task(task)
+    else:
+        with ProcessPoolExecutor(max_workers=min(num_workers, max(1, len(tasks))), initializer=_init_worker,
+                                 initargs=(data_root,)) as executor:
+            for rendered in executor.map(_render_task, tasks):
+                num_frames += rendered
+    return num_frames, num_files, time.perf_counter() - start_time
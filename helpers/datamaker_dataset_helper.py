@@ -1,49 +1,82 @@
-﻿from typing import Dict
+﻿import bisect
+from typing import Dict, List, Optional, Tuple
 
 from Dataset import Dataset
 
-def get_instance_by_capture_idx(
-        instances: Dict[int, Dataset], index: int) \
-        -> int:
-    """ Gets the instance in instances that contains the given capture index
 
-    :param instances: Dictionary of instances
-    :type instances: Dict[int, Tuple[AnnotationDefinitions, MetricDefinitions, Captures, int, str]]
-    :param index: Capture index that we want
-    :type index: int
+class DatamakerDataset:
+    """ Dataset that goes over multiple instances (aka. Datamaker dataset), the frames of the instances are numbered
+    one after the other following the natural ordering of the instance keys
 
-    :return: key in dictionary
-    :rtype: int
+    The start index of every instance is computed once so that finding the instance of a frame is a binary search.
     """
-    total = 0
-    keys = list(instances.keys())
-    keys.sort()
-    for key in keys:
-        total = total + instances[key].length()
-        if int(index) <= total - 1:
-            return key
-
-
-def get_dataset_length_with_instances(
-        instances: Dict[int, Dataset],
-        until_instance: int = -1) -> \
-        int:
-    """ Gets the total length of a dataset that goes over multiple instances (aka. Datamaker dataset)
-    optionally you can specify until which instance you want to count 
-    (the order is based by the natural ordering of keys)
-
-    :param instances: Dictionary of instances
-    :type instances: Dict[int, Tuple[AnnotationDefinitions, MetricDefinitions, Captures, int, str]]
-    :param until_instance: optional, will stop counting when it reaches the specified instance (non-inclusive)
-    :type until_instance: int
-    :return: length
-    :rtype: int
-    """
-    total = 0
-    keys = list(instances.keys())
-    keys.sort()
-    for key in keys:
-        if 0 <= until_instance <= key:
-            break
-        total = total + instances[key].length()
-    return total
+
+    def __init__(self, instances: Dict[int, Dataset]):
+        """
+        :param instances: Dictionary of instance number to the dataset of that instance
+        :type instances: Dict[int, Dataset]
+        """
+        self.instances = instances
+        self._compute_offsets({key: ds.length() for key, ds in instances.items()})
+
+    def _compute_offsets(self, lengths: Dict[int, int]):
+        keys = sorted(lengths.keys())
+        # offsets[i] is the index of the first frame of instance keys[i], the last entry is the total length
+        offsets = [0]
+        for key in keys:
+            offsets.append(offsets[-1] + lengths[key])
+        # replaced as a whole and read once per call, the offsets of a lazy dataset change while other threads read them
+        self._layout = (keys, offsets, dict(zip(keys, offsets)))
+
+    @property
+    def keys(self) -> List[int]:
+        return self._layout[0]
+
+    def length(self) -> int:
+        return self._layout[1][-1]
+
+    def _find(self, index: int) -> Optional[Tuple[int, int]]:
+        keys, offsets, _ = self._layout
+        index = int(index)
+        if not 0 <= index < offsets[-1]:
+            return None
+        # bisect_right skips instances without frames, which start at the same index as the next instance
+        position = bisect.bisect_right(offsets, index) - 1
+        return keys[position], index - offsets[position]
+
+    def get_instance_key(self, index: int) -> Optional[int]:
+        """ Gets the key of the instance that contains the given frame index
+
+        :param index: frame index in the whole dataset
+        :type index: int
+        :return: key of the instance, None if the index is out of range
+        :rtype: int
+        """
+        found = self._find(index)
+        return None if found is None else found[0]
+
+    def get_offset(self, instance_key: int) -> int:
+        """ Gets the frame index of the first frame of the given instance in the whole dataset
+
+        :param instance_key: key of the instance
+        :type instance_key: int
+        :return: offset of the instance
+        :rtype: int
+        """
+        return self._layout[2][instance_key]
+
+    def get_instance(self, instance_key: int) -> Dataset:
+        return self.instances[instance_key]
+
+    def locate(self, index: int) -> Optional[Tuple[Dataset, int]]:
+        """ Gets the instance that contains the given frame index and the index of the frame in that instance
+
+        :param index: frame index in the whole dataset
+        :type index: int
+        :return: (dataset of the instance, frame index in the instance), None if the index is out of range
+        :rtype: Tuple[Dataset, int]
+        """
+        found = self._find(index)
+        if found is None:
+            return None
+        return self.get_instance(found[0]), found[1]
@@ -0,0 +1,430 @@
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+from Dataset import Dataset
+import helpers.dataset_index as dataset_index
+from helpers.datamaker_dataset_helper import DatamakerDataset
+
+# --------------------------------Datamaker loader-----------------------------------------------------------------------
+# Parses the attempts of a Datamaker dataset in a process pool. The workers write the dataset index of their attempt and
+# the parsed instance is read back from it, which is much faster than sending it between processes. The instances are
+# made available in the natural order of their keys as soon as they are parsed, so that the first frames can be shown
+# while the rest is still loading.
+# In lazy mode (enabled by setting LAZY_INSTANCES_ENV to a memory budget in megabytes, cli.py does it with
+# --lazy-instances-mb) only the number of captures of every attempt is read up front and an instance is parsed when
+# one of its frames is requested.
+
+LAZY_INSTANCES_ENV = "VISUALIZER_LAZY_INSTANCES_MB"
+
+DEFAULT_NUM_WORKERS = min(8, os.cpu_count() or 1)
+
+# (instance number, path to the attempt folder)
+Attempt = Tuple[int, str]
+
+
+def _find_attempts_in(path: str, attempts: List[Attempt]):
+    for instance in [g.path for g in os.scandir(path) if g.is_dir()]:
+        if re.match(".*instance_[0-9]*", instance):
+            instance_num = int(instance[instance.rfind("instance_") + len("instance_"):])
+            for attempt in [h.path for h in os.scandir(instance) if h.is_dir()]:
+                if re.match(".*attempt_[0-9]*", attempt):
+                    attempts.append((instance_num, attempt))
+
+
+def find_attempts(path: str) -> Optional[List[Attempt]]:
+    """ Lists the attempt folders of a Datamaker dataset without parsing them
+        Assumes that the given path contains a folder structure as follows:
+        - path
+            - urn_app_params folders
+                - instance_#
+                    - attempt_#
+                        - Normal Perception dataset folder structure
+        path can also be a single urn_app_params folder
+
+    :param path: path to dataset
+    :type path: str
+    :return: attempts in the order in which they were found, None if path can not be read as a Datamaker dataset
+    :rtype: List[Attempt]
+    """
+    attempts = []
+    try:
+        for app_param in [f.path for f in os.scandir(path) if f.is_dir()]:
+            _find_attempts_in(app_param, attempts)
+    except Exception:
+        # The user may be selecting an actual app-param folder instead of a folder containing app-params, the instance
+        # number of an attempt folder can then not be parsed
+        try:
+            _find_attempts_in(path, attempts)
+        except Exception:
+            return None
+    return attempts
+
+
+def _index_attempt(attempt_path: str) -> Optional[str]:
+    # runs in a worker process: the attempt is parsed there and its dataset index written, only the revision is sent
+    # back instead of the whole Dataset
+    ds = Dataset(attempt_path)
+    return ds.revision if ds.dataset_valid else None
+
+
+def count_captures(attempt_path: str) -> int:
+    """ Counts the captures of a Perception dataset without parsing it, the count is read from the dataset index when
+    it is up to date, otherwise the top-level capture records of the captures json files are counted, which is what
+    Dataset.length() returns once the dataset is parsed
+
+    :param attempt_path: Root directory of the dataset
+    :type attempt_path: str
+    :return: number of captures
+    :rtype: int
+    """
+    signature = dataset_index.compute_signature(attempt_path)
+    manifest = dataset_index.load_manifest(attempt_path, signature)
+    if manifest is not None and "num_frames" in manifest:
+        return manifest["num_frames"]
+    count = 0
+    for relative_path, _, _ in signature:
+        if os.path.basename(relative_path).startswith("captures_"):
+            with open(os.path.join(attempt_path, relative_path), encoding="utf8") as captures_file:
+                count += len(json.load(captures_file).get("captures", []))
+    return count
+
+
+def count_attempt(attempt_path: str) -> int:
+    """ Counts the captures of an attempt like count_captures, attempts that are not valid datasets or can not be read
+    have no captures
+
+    :param attempt_path: Root directory of the dataset
+    :type attempt_path: str
+    :return: number of captures, 0 if the attempt can not be used
+    :rtype: int
+    """
+    if not Dataset.check_folder_valid(attempt_path):
+        return 0
+    try:
+        return count_captures(attempt_path)
+    except (OSError, ValueError) as e:
+        print("Could not count the captures of " + attempt_path + ": " + str(e))
+        return 0
+
+
+def _estimate_dataset_bytes(ds: Dataset) -> int:
+    if not ds.dataset_valid:
+        return 0
+    tables = list(ds.capture_index.values())
+    return int(sum(table.memory_usage(index=True, deep=True).sum() for table in tables) +
+               sum(table.nbytes() for table in ds.annotation_tables.values()))
+
+
+class LazyDatamakerDataset(DatamakerDataset):
+    """ Datamaker dataset that parses an instance the first time one of its frames is requested, and drops the least
+    recently used instances once the parsed instances take more than max_bytes
+    """
+
+    def __init__(self, attempts: Dict[int, str], lengths: Dict[int, int], max_bytes: int):
+        """
+        :param attempts: Dictionary of instance number to the attempt folder of that instance
+        :type attempts: Dict[int, str]
+        :param lengths: Dictionary of instance number to the number of captures of that instance, see count_captures
+        :type lengths: Dict[int, int]
+        :param max_bytes: memory the parsed instances are allowed to take, the instance being requested is always kept
+        :type max_bytes: int
+        """
+        self.attempts = attempts
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        # parsed instances, least recently used first
+        self.instances = OrderedDict()
+        self._sizes = {}
+        self._lengths = dict(lengths)
+        # instance key -> Future of the instances being parsed
+        self._loading = {}
+        self._lock = threading.Lock()
+        self._compute_offsets(self._lengths)
+
+    def get_instance(self, instance_key: int) -> Dataset:
+        with self._lock:
+            ds = self.instances.get(instance_key)
+            if ds is not None:
+                self.instances.move_to_end(instance_key)
+                return ds
+            # the instance is parsed outside the lock, the other threads asking for it wait for the same parse
+            loading = self._loading.get(instance_key)
+            parsing = loading is None
+            if parsing:
+                loading = self._loading[instance_key] = Future()
+        if not parsing:
+            return loading.result()
+
+        try:
+            ds = Dataset(self.attempts[instance_key])
+            size = _estimate_dataset_bytes(ds)
+        except BaseException as e:
+            with self._lock:
+                del self._loading[instance_key]
+            loading.set_exception(e)
+            raise
+
+        with self._lock:
+            del self._loading[instance_key]
+            if ds.length() != self._lengths[instance_key]:
+                # the count was wrong (e.g. an invalid attempt), the frames of the following instances move
+                print("Instance " + str(instance_key) + " has " + str(ds.length()) + " captures instead of " +
+                      str(self._lengths[instance_key]))
+                self._lengths[instance_key] = ds.length()
+                self._compute_offsets(self._lengths)
+
+            self.instances[instance_key] = ds
+            self._sizes[instance_key] = size
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes and len(self.instances) > 1:
+                evicted_key, _ = self.instances.popitem(last=False)
+                self.current_bytes -= self._sizes.pop(evicted_key)
+        loading.set_result(ds)
+        return ds
+
+
+class LazyDatamakerLoader:
+    """ Counts the captures of every attempt of a Datamaker dataset and creates a LazyDatamakerDataset, it has the
+    interface of DatamakerLoader so that both can be used the same way
+    """
+
+    def __init__(self, attempts: List[Attempt], max_bytes: int, num_workers: int = DEFAULT_NUM_WORKERS):
+        """
+        :param attempts: attempts to load, see find_attempts. When an instance has several valid attempts the last one
+                         is used
+        :type attempts: List[Attempt]
+        :param max_bytes: memory the parsed instances are allowed to take
+        :type max_bytes: int
+        :param num_workers: Optional (Default: DEFAULT_NUM_WORKERS), number of attempts counted at the same time
+        :type num_workers: int
+        """
+        self.attempts = attempts
+        self.max_bytes = max_bytes
+        self.num_workers = max(1, num_workers)
+        self._dataset = None
+
+    def start(self):
+        """ Counts the captures of the attempts, this only reads the dataset index or the captures files
+        """
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            counts = list(executor.map(count_attempt, [attempt_path for _, attempt_path in self.attempts]))
+        attempts = {}
+        lengths = {}
+        for (instance_num, attempt_path), count in zip(self.attempts, counts):
+            if count > 0:
+                attempts[instance_num] = attempt_path
+                lengths[instance_num] = count
+        if len(attempts) > 0:
+            self._dataset = LazyDatamakerDataset(attempts, lengths, self.max_bytes)
+
+    def is_done(self) -> bool:
+        return True
+
+    def progress(self) -> Tuple[int, int]:
+        return len(self.attempts), len(self.attempts)
+
+    def get_dataset(self) -> Optional[LazyDatamakerDataset]:
+        return self._dataset
+
+    def wait_for_dataset(self, on_progress: Optional[Callable[[int, int], None]] = None) \
+            -> Optional[LazyDatamakerDataset]:
+        return self._dataset
+
+
+class DatamakerLoader:
+    """ Loads the attempts of a Datamaker dataset in background processes
+    """
+
+    def __init__(self, attempts: List[Attempt], num_workers: int = DEFAULT_NUM_WORKERS):
+        """
+        :param attempts: attempts to load, see find_attempts. When an instance has several valid attempts the last one
+                         is used
+        :type attempts: List[Attempt]
+        :param num_workers: Optional (Default: DEFAULT_NUM_WORKERS), number of attempts parsed at the same time
+        :type num_workers: int
+        """
+        self.attempts = attempts
+        self.num_workers = max(1, num_workers)
+        self.keys = sorted({instance_num for instance_num, _ in attempts})
+        self._attempts_by_key = {key: [] for key in self.keys}
+        for position, (instance_num, _) in enumerate(attempts):
+            self._attempts_by_key[instance_num].append(position)
+        # revision of every attempt sent back by its worker, None for the invalid attempts
+        self._results = [None] * len(attempts)
+        # position -> instance opened from the index of the attempt, None if it could not be opened
+        self._opened = {}
+        self._open_lock = threading.Lock()
+        self._loaded = [False] * len(attempts)
+        self.num_loaded = 0
+        self._condition = threading.Condition()
+        self._executor = None
+        self._dataset = None
+        self._dataset_num_loaded = -1
+
+    def start(self):
+        """ Starts loading the attempts, the attempts of the first instances are submitted first
+        """
+        self._executor = ProcessPoolExecutor(max_workers=min(self.num_workers, max(1, len(self.attempts))))
+        for key in self.keys:
+            for position in self._attempts_by_key[key]:
+                future = self._executor.submit(_index_attempt, self.attempts[position][1])
+                future.add_done_callback(lambda done, done_position=position: self._finish(done_position, done))
+        # the pool shuts itself down once every attempt is loaded
+        self._executor.shutdown(wait=False)
+
+    def _finish(self, position: int, future: Future):
+        # runs on the thread of the process pool that collects the results of every worker, the instance is opened
+        # later by get_dataset so that this thread is never blocked
+        try:
+            result = future.result()
+        except Exception as e:
+            print("Could not load " + self.attempts[position][1] + ": " + str(e))
+            result = None
+        with self._condition:
+            self._results[position] = result
+            self._loaded[position] = True
+            self.num_loaded += 1
+            self._condition.notify_all()
+
+    def is_done(self) -> bool:
+        return self.num_loaded == len(self.attempts)
+
+    def progress(self) -> Tuple[int, int]:
+        """ Gets how many attempts are loaded
+
+        :return: (number of loaded attempts, number of attempts)
+        :rtype: Tuple[int, int]
+        """
+        return self.num_loaded, len(self.attempts)
+
+    def _get_ready_positions(self) -> List[Tuple[int, int]]:
+        # only the instances before the first one that is still loading are used, so that the frame indices of the
+        # dataset do not change when more instances are loaded
+        positions = []
+        for key in self.keys:
+            key_positions = self._attempts_by_key[key]
+            if not all(self._loaded[position] for position in key_positions):
+                break
+            positions += [(key, position) for position in key_positions if self._results[position] is not None]
+        return positions
+
+    def _open(self, position: int) -> Optional[Dataset]:
+        with self._open_lock:
+            if position not in self._opened:
+                attempt_path = self.attempts[position][1]
+                try:
+                    # read from the index the worker wrote, the attempt is parsed again only if the index could not be
+                    # written (e.g. a read-only dataset folder)
+                    ds = Dataset(attempt_path)
+                    self._opened[position] = ds if ds.dataset_valid else None
+                except Exception as e:
+                    print("Could not load " + attempt_path + ": " + str(e))
+                    self._opened[position] = None
+            return self._opened[position]
+
+    def get_dataset(self) -> Optional[DatamakerDataset]:
+        """ Gets the dataset made of the instances loaded so far
+
+        :return: the dataset, None if no instance is ready yet
+        :rtype: DatamakerDataset
+        """
+        with self._condition:
+            num_loaded = self.num_loaded
+            if self._dataset_num_loaded == num_loaded:
+                return self._dataset
+            positions = self._get_ready_positions()
+        # the instances are opened on the calling thread, without holding the lock the workers report to
+        instances = {}
+        for key, position in positions:
+            ds = self._open(position)
+            if ds is not None:
+                # the last valid attempt of an instance is used
+                instances[key] = ds
+        dataset = DatamakerDataset(instances) if len(instances) > 0 else None
+        with self._condition:
+            if self._dataset_num_loaded < num_loaded:
+                self._dataset = dataset
+                self._dataset_num_loaded = num_loaded
+            return self._dataset
+
+    def wait_for_dataset(self, on_progress: Optional[Callable[[int, int], None]] = None) -> Optional[DatamakerDataset]:
+        """ Waits until the first instance is ready, or every attempt is loaded if none of them is valid
+
+        :param on_progress: Optional, called with (number of loaded attempts, number of attempts) every time an attempt
+                            is loaded, from the calling thread
+        :type on_progress: Callable[[int, int], None]
+        :return: see get_dataset
+        :rtype: DatamakerDataset
+        """
+        while True:
+            with self._condition:
+                num_loaded = self.num_loaded
+            if on_progress is not None:
+                on_progress(num_loaded, len(self.attempts))
+            dataset = self.get_dataset()
+            if dataset is not None or self.is_done():
+                return dataset
+            with self._condition:
+                self._condition.wait_for(lambda: self.num_loaded != num_loaded)
+
+
+# Loaders shared by every streamlit rerun of the process, keyed by dataset path
+_loaders = {}
+_loaders_lock = threading.Lock()
+
+
+def get_lazy_max_bytes() -> Optional[int]:
+    """ Gets the memory budget of lazy mode configured by LAZY_INSTANCES_ENV
+
+    :return: memory budget in bytes, None if lazy mode is disabled
+    :rtype: int
+    """
+    max_mb = os.environ.get(LAZY_INSTANCES_ENV)
+    if not max_mb or int(max_mb) <= 0:
+        return None
+    return int(max_mb) * 1024 * 1024
+
+
+def get_loader(path: str, num_workers: int = DEFAULT_NUM_WORKERS):
+    """ Gets the loader of the Datamaker dataset at path, starting it if the dataset was not loaded yet, if its
+    attempt folders changed or if lazy mode was turned on or off
+
+    :param path: path to dataset
+    :type path: str
+    :param num_workers: Optional (Default: DEFAULT_NUM_WORKERS), number of attempts loaded at the same time
+    :type num_workers: int
+    :return: the loader, a LazyDatamakerLoader in lazy mode, None if path is not a Datamaker dataset
+    :rtype: DatamakerLoader
+    """
+    attempts = find_attempts(path)
+    if not attempts:
+        return None
+    lazy_max_bytes = get_lazy_max_bytes()
+    key = os.path.abspath(path)
+    with _loaders_lock:
+        loader = _loaders.get(key)
+        if loader is None or loader.attempts != attempts or getattr(loader, "max_bytes", None) != lazy_max_bytes:
+            if lazy_max_bytes is not None:
+                loader = LazyDatamakerLoader(attempts, lazy_max_bytes, num_workers)
+            else:
+                loader = DatamakerLoader(attempts, num_workers)
+            loader.start()
+            _loaders[key] = loader
+    return loader
+
+
+def get_started_loader(path: str) -> Optional[DatamakerLoader]:
+    """ Gets the loader last started by get_loader for the dataset at path, without looking for new attempts
+
+    :param path: path to dataset
+    :type path: str
+    :return: the loader, None if the dataset was never loaded
+    :rtype: DatamakerLoader
+    """
+    with _loaders_lock:
+        return _loaders.get(os.path.abspath(path))
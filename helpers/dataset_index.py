@@ -0,0 +1,332 @@
+import hashlib
+import json
+import os
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+# --------------------------------Dataset index--------------------------------------------------------------------------
+# The parsed definition, captures and annotations tables of a Perception dataset are stored next to the dataset in
+# INDEX_DIR_NAME so that later opens do not need to parse every json file again. The index is keyed by the size and
+# modification time of every source json file and is rebuilt as soon as any of them changes.
+# Other data derived from the dataset (e.g. where each capture record is stored) is stored next to the tables as
+# "extras", which are tagged with the revision they were computed from and ignored once the dataset changes.
+# Nothing is pickled, opening the index of a dataset never runs code from the dataset folder: the tables and every extra
+# are .npz files of plain NumPy arrays (loaded with allow_pickle=False) holding JSON_KEY, the JSON of the stored value in
+# which every array is replaced by a reference to its entry in the file.
+
+INDEX_DIR_NAME = ".visualizer_index"
+INDEX_VERSION = 4
+
+MANIFEST_FILE = "manifest.json"
+TABLES_FILE = "tables.npz"
+EXTRA_PREFIX = "extra_"
+EXTRA_EXTENSION = ".npz"
+# files of the previous versions of the index, deleted when the index is written
+LEGACY_EXTENSION = ".pkl"
+
+# entry of a .npz file holding the JSON of the stored value, encoded in UTF-8
+JSON_KEY = "__json__"
+# markers of the values JSON can not represent directly
+ARRAY_TAG = "__array__"
+TUPLE_TAG = "__tuple__"
+DICT_TAG = "__dict__"
+
+SOURCE_PREFIXES = ("annotation_definitions", "metric_definitions", "captures_", "metrics_")
+
+# number of datasets whose extras are kept in memory by get_extra, for every extra name
+EXTRA_CACHE_SIZE = 4
+# extra name -> (data root, revision, use_index) -> value, oldest first
+_extra_cache = {}
+_extra_cache_lock = threading.Lock()
+
+
+def get_index_dir(data_root: str) -> str:
+    """ Gets the directory where the index of the given dataset is stored
+
+    :param data_root: Root directory of the dataset
+    :type data_root: str
+    :return: path to the index directory
+    :rtype: str
+    """
+    return os.path.join(data_root, INDEX_DIR_NAME)
+
+
+def compute_signature(data_root: str) -> List[Tuple[str, int, int]]:
+    """ Lists every json file the dataset tables are read from together with its size and modification time
+
+    Only the "Dataset*" folders are scanned, the image folders can contain hundreds of thousands of files.
+
+    :param data_root: Root directory of the dataset
+    :type data_root: str
+    :return: sorted list of (path relative to data_root, size, mtime in nanoseconds)
+    :rtype: List[Tuple[str, int, int]]
+    """
+    signature = []
+    for child in os.scandir(data_root):
+        if not child.is_dir() or not child.name.startswith("Dataset"):
+            continue
+        for directory, _, files in os.walk(child.path):
+            for name in files:
+                if not name.endswith(".json") or not name.startswith(SOURCE_PREFIXES):
+                    continue
+                path = os.path.join(directory, name)
+                stat = os.stat(path)
+                relative_path = os.path.relpath(path, data_root).replace("\\", "/")
+                signature.append((relative_path, stat.st_size, stat.st_mtime_ns))
+    signature.sort()
+    return signature
+
+
+def _read_manifest(data_root: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(get_index_dir(data_root), MANIFEST_FILE), "r", encoding="utf8") as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return None
+
+
+def get_temp_suffix() -> str:
+    """ Gets the suffix of the temporary files written before replacing a file, unique to the calling thread: the
+    streamlit sessions are threads of the same process and can write the same file at the same time
+
+    :return: the suffix
+    :rtype: str
+    """
+    return ".tmp" + str(os.getpid()) + "_" + str(threading.get_ident())
+
+
+def _write_atomic(path: str, write):
+    temp_path = path + get_temp_suffix()
+    try:
+        write(temp_path)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def _encode(value: any, arrays: Dict[str, np.ndarray]) -> any:
+    if isinstance(value, np.ndarray):
+        if value.dtype.hasobject:
+            raise TypeError("object arrays can not be stored in the dataset index")
+        name = "a" + str(len(arrays))
+        arrays[name] = value
+        return {ARRAY_TAG: name}
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, tuple):
+        return {TUPLE_TAG: [_encode(item, arrays) for item in value]}
+    if isinstance(value, list):
+        return [_encode(item, arrays) for item in value]
+    if isinstance(value, dict):
+        if all(isinstance(key, str) for key in value):
+            return {key: _encode(item, arrays) for key, item in value.items()}
+        # keys that are not strings (label ids, tuples) are kept as (key, value) pairs
+        return {DICT_TAG: [[_encode(key, arrays), _encode(item, arrays)] for key, item in value.items()]}
+    return value
+
+
+def _write_npz(path: str, value: any):
+    """ Writes a value made of JSON values, tuples, dicts with any keys and NumPy arrays to a .npz file """
+    arrays = {}
+    encoded = json.dumps(_encode(value, arrays))
+    arrays[JSON_KEY] = np.frombuffer(encoded.encode("utf8"), dtype=np.uint8)
+    # np.savez adds .npz to paths that do not end with it, the temporary files are written through a file object
+    with open(path, "wb") as npz_file:
+        np.savez(npz_file, **arrays)
+
+
+def _read_npz(path: str) -> any:
+    """ Reads a value written by _write_npz """
+    with np.load(path, allow_pickle=False) as npz:
+        def decode(value: dict):
+            if len(value) == 1:
+                if ARRAY_TAG in value:
+                    return npz[value[ARRAY_TAG]]
+                if TUPLE_TAG in value:
+                    return tuple(value[TUPLE_TAG])
+                if DICT_TAG in value:
+                    return dict(value[DICT_TAG])
+            return value
+
+        return json.loads(npz[JSON_KEY].tobytes().decode("utf8"), object_hook=decode)
+
+
+def _remove_legacy(index_dir: str):
+    # pickled files of older indexes are never read, they would run arbitrary code when loaded
+    for name in os.listdir(index_dir):
+        if name.endswith(LEGACY_EXTENSION):
+            os.remove(os.path.join(index_dir, name))
+
+
+def load_manifest(data_root: str, signature: Optional[List[Tuple[str, int, int]]] = None) -> Optional[dict]:
+    """ Reads the manifest of the dataset index if it is still up to date with the source json files
+
+    :param data_root: Root directory of the dataset
+    :type data_root: str
+    :param signature: Optional, signature of the dataset if it was already computed
+    :type signature: List[Tuple[str, int, int]]
+    :return: the manifest, None if there is no index or it is out of date
+    :rtype: dict
+    """
+    manifest = _read_manifest(data_root)
+    if manifest is None or manifest.get("version") != INDEX_VERSION:
+        return None
+    if signature is None:
+        signature = compute_signature(data_root)
+    if [tuple(entry) for entry in manifest.get("signature", [])] != signature:
+        return None
+    return manifest
+
+
+def get_revision(signature: List[Tuple[str, int, int]]) -> str:
+    """ Gets a short identifier of the content of the dataset json files that changes whenever any of them changes
+
+    :param signature: signature of the dataset, see compute_signature
+    :type signature: List[Tuple[str, int, int]]
+    :return: hex digest of the signature
+    :rtype: str
+    """
+    return hashlib.sha1(json.dumps(signature).encode("utf8")).hexdigest()
+
+
+def load_tables(data_root: str, signature: Optional[List[Tuple[str, int, int]]] = None) -> Optional[Dict[str, any]]:
+    """ Loads the tables of the dataset from its index
+
+    :param data_root: Root directory of the dataset
+    :type data_root: str
+    :param signature: Optional, signature of the dataset if it was already computed
+    :type signature: List[Tuple[str, int, int]]
+    :return: Dictionary of table name to table, None if there is no usable index
+    :rtype: Dict[str, any]
+    """
+    if load_manifest(data_root, signature) is None:
+        return None
+    try:
+        return _read_npz(os.path.join(get_index_dir(data_root), TABLES_FILE))
+    except Exception:
+        # a partially written or incompatible index is rebuilt like a missing one
+        return None
+
+
+def save_tables(data_root: str, tables: Dict[str, any], signature: List[Tuple[str, int, int]], **info) -> bool:
+    """ Writes the tables of the dataset to its index, replacing any previous index
+
+    :param data_root: Root directory of the dataset
+    :type data_root: str
+    :param tables: Dictionary of table name to table, made of JSON values, tuples, dicts and NumPy arrays
+    :type tables: Dict[str, any]
+    :param signature: signature of the source json files the tables were read from, computed before reading them
+    :type signature: List[Tuple[str, int, int]]
+    :param info: extra values stored in the manifest (e.g. num_frames) that can be read without loading the tables
+    :return: true if the index was written, false if the dataset folder is not writable
+    :rtype: bool
+    """
+    index_dir = get_index_dir(data_root)
+    try:
+        os.makedirs(index_dir, exist_ok=True)
+        # remove the manifest first so that a crash in the middle never leaves a manifest describing other tables
+        manifest_path = os.path.join(index_dir, MANIFEST_FILE)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+
+        def write_manifest(path):
+            with open(path, "w", encoding="utf8") as manifest_file:
+                json.dump(dict(info, version=INDEX_VERSION, signature=signature), manifest_file)
+
+        tables_path = os.path.join(index_dir, TABLES_FILE)
+        _write_atomic(tables_path, lambda path: _write_npz(path, tables))
+        _write_atomic(manifest_path, write_manifest)
+        _remove_legacy(index_dir)
+    except (OSError, TypeError) as e:
+        # TypeError: the value holds something that can not be stored without pickle
+        print("Could not write the dataset index: " + str(e))
+        return False
+    return True
+
+
+def _get_extra_path(data_root: str, name: str) -> str:
+    return os.path.join(get_index_dir(data_root), EXTRA_PREFIX + name + EXTRA_EXTENSION)
+
+
+def load_extra(data_root: str, name: str, revision: str) -> Optional[any]:
+    """ Loads data derived from the dataset that was stored in its index with save_extra
+
+    :param data_root: Root directory of the dataset
+    :type data_root: str
+    :param name: name the data was saved under
+    :type name: str
+    :param revision: current revision of the dataset, see get_revision
+    :type revision: str
+    :return: the stored data, None if it was never saved or was computed from another revision of the dataset
+    """
+    try:
+        extra = _read_npz(_get_extra_path(data_root, name))
+    except Exception:
+        return None
+    if not isinstance(extra, dict) or extra.get("version") != INDEX_VERSION or extra.get("revision") != revision:
+        return None
+    return extra.get("value")
+
+
+def save_extra(data_root: str, name: str, value: any, revision: str) -> bool:
+    """ Stores data derived from the dataset in its index, replacing what was previously saved under the same name
+
+    :param data_root: Root directory of the dataset
+    :type data_root: str
+    :param name: name to save the data under
+    :type name: str
+    :param value: the data, made of JSON values, tuples, dicts with any hashable keys and NumPy arrays
+    :param revision: revision of the dataset the data was computed from, see get_revision
+    :type revision: str
+    :return: true if the data was written, false if the dataset folder is not writable
+    :rtype: bool
+    """
+    extra_path = _get_extra_path(data_root, name)
+    try:
+        os.makedirs(get_index_dir(data_root), exist_ok=True)
+        _write_atomic(extra_path, lambda path: _write_npz(path, {"version": INDEX_VERSION, "revision": revision,
+                                                                 "value": value}))
+    except (OSError, TypeError) as e:
+        # TypeError: the value holds something that can not be stored without pickle
+        print("Could not write the dataset index: " + str(e))
+        return False
+    return True
+
+
+def get_extra(data_root: str, name: str, revision: str, build: Callable[[], any], use_index: bool = True) -> any:
+    """ Gets data derived from the dataset from its index, building it and storing it in the index if needed. The data
+    of the last EXTRA_CACHE_SIZE datasets is also kept in memory, streamlit creates a new Dataset on every rerun
+
+    :param data_root: Root directory of the dataset
+    :type data_root: str
+    :param name: name the data is saved under
+    :type name: str
+    :param revision: current revision of the dataset, see get_revision
+    :type revision: str
+    :param build: computes the data, see save_extra for what it can hold
+    :type build: Callable[[], any]
+    :param use_index: Optional (Default: True), if false the data is neither read from nor written to the index
+    :type use_index: bool
+    :return: the data
+    """
+    key = (os.path.abspath(data_root), revision, use_index)
+    with _extra_cache_lock:
+        value = _extra_cache.get(name, {}).get(key)
+    if value is not None:
+        return value
+
+    value = load_extra(data_root, name, revision) if use_index else None
+    if value is None:
+        value = build()
+        if use_index:
+            save_extra(data_root, name, value, revision)
+    with _extra_cache_lock:
+        cache = _extra_cache.setdefault(name, {})
+        cache.pop(key, None)
+        if len(cache) >= EXTRA_CACHE_SIZE:
+            cache.pop(next(iter(cache)))
+        cache[key] = value
+    return value
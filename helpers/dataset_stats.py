@@ -0,0 +1,200 @@
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from helpers.annotation_store import AnnotationTable
+import helpers.dataset_index as dataset_index
+
+# --------------------------------Dataset statistics---------------------------------------------------------------------
+# Class counts, bounding box size distributions, objects per frame and keypoint visibility of a whole dataset. The
+# annotation values are flattened once into NumPy arrays and every statistic is computed on the arrays, the result is
+# small and stored in the dataset index so that showing the statistics again does not need to open the dataset.
+# The histograms use fixed bins so that the statistics of the instances of a Datamaker dataset can be summed.
+
+STATISTICS_EXTRA = "statistics"
+
+BOUNDING_BOX_NAME = "bounding box"
+KEYPOINTS_NAME = "keypoints"
+
+# bin edges of the bounding box area histogram in pixels, from 1 pixel to 8192x8192
+AREA_BIN_EDGES = np.geomspace(1, 2 ** 26, 53)
+# bin edges of the bounding box aspect ratio (width / height) histogram, ratios outside are counted in the last bins
+ASPECT_BIN_EDGES = np.geomspace(1 / 16, 16, 33)
+
+# keypoint states of the Perception keypoint labeler
+KEYPOINT_STATES = ("absent", "occluded", "visible")
+
+
+def _compute_bounding_box_statistics(table: AnnotationTable, label_names: Dict[int, str]) -> dict:
+    objects_per_frame = table.get_counts()
+    label_ids = table.get_column("label_id", default=-1).astype(np.int64)
+    widths = table.get_column("width").astype(np.float64)
+    heights = table.get_column("height").astype(np.float64)
+
+    areas = widths * heights
+    with np.errstate(divide="ignore", invalid="ignore"):
+        aspects = widths / heights
+    aspects = aspects[np.isfinite(aspects) & (aspects > 0)]
+
+    unique_ids, first_boxes, inverse, counts = np.unique(label_ids, return_index=True, return_inverse=True,
+                                                         return_counts=True)
+    area_sums = np.bincount(inverse, weights=areas, minlength=len(unique_ids))
+    class_counts = {}
+    class_area_sums = {}
+    for label_id, position, count, area_sum in zip(unique_ids.tolist(), first_boxes.tolist(), counts.tolist(),
+                                                   area_sums.tolist()):
+        # boxes of an unknown label are counted under the label name stored in the box, or the label id
+        name = label_names.get(label_id)
+        if name is None and table.has_column("label_name"):
+            name = table.columns["label_name"].get(position, position + 1)[0]
+        name = str(label_id) if name is None else name
+        class_counts[name] = class_counts.get(name, 0) + count
+        class_area_sums[name] = class_area_sums.get(name, 0.0) + area_sum
+
+    return {
+        "num_frames": table.length(),
+        "num_objects": len(label_ids),
+        "class_counts": class_counts,
+        "class_area_sums": class_area_sums,
+        "objects_per_frame": np.bincount(objects_per_frame, minlength=1),
+        "area_histogram": np.histogram(np.clip(areas, AREA_BIN_EDGES[0], AREA_BIN_EDGES[-1]), AREA_BIN_EDGES)[0],
+        "aspect_histogram": np.histogram(np.clip(aspects, ASPECT_BIN_EDGES[0], ASPECT_BIN_EDGES[-1]),
+                                         ASPECT_BIN_EDGES)[0],
+    }
+
+
+def _compute_keypoint_statistics(table: AnnotationTable, templates: Optional[List[dict]]) -> Dict[str, dict]:
+    keypoint_labels = {}
+    template_names = {}
+    for template in templates or []:
+        keypoint_labels[template["template_id"]] = {keypoint["index"]: keypoint["label"]
+                                                    for keypoint in template.get("key_points", [])}
+        template_names[template["template_id"]] = template.get("template_name", template["template_id"])
+
+    # one row per figure, the keypoints of the figures are the rows of the child table
+    template_column = table.columns.get("template_guid")
+    template_codes = table.get_column("template_guid", default=-1)
+    keypoints_column = table.columns.get("keypoints")
+    if keypoints_column is not None and keypoints_column.child is not None:
+        keypoints_table = keypoints_column.child
+        keypoint_figures = keypoints_table.get_frames()
+        all_indices = keypoints_table.get_column("index").astype(np.int64)
+        all_states = keypoints_table.get_column("state").astype(np.int64)
+    else:
+        keypoint_figures = all_indices = all_states = np.zeros(0, dtype=np.int64)
+
+    statistics = {}
+    for code in np.unique(template_codes).tolist():
+        template_id = template_column.categories[code] if code >= 0 and template_column is not None else None
+        is_template_figure = template_codes == code
+        is_template_keypoint = is_template_figure[keypoint_figures]
+        indices = all_indices[is_template_keypoint]
+        states = all_states[is_template_keypoint]
+        labels = keypoint_labels.get(template_id, {})
+        num_keypoints = max([index + 1 for index in labels] + [int(indices.max()) + 1 if len(indices) else 0])
+        # number of keypoints in every state, one row per keypoint index
+        state_counts = np.bincount(indices * len(KEYPOINT_STATES) + np.clip(states, 0, len(KEYPOINT_STATES) - 1),
+                                   minlength=num_keypoints * len(KEYPOINT_STATES))
+        statistics[template_names.get(template_id, str(template_id))] = {
+            "num_figures": int(is_template_figure.sum()),
+            "labels": [labels.get(index, str(index)) for index in range(num_keypoints)],
+            "state_counts": state_counts.reshape(num_keypoints, len(KEYPOINT_STATES)),
+        }
+    return statistics
+
+
+def compute_statistics(ds) -> dict:
+    """ Computes the statistics of the bounding box and keypoint annotations of the dataset
+
+    :param ds: a valid dataset
+    :type ds: Dataset
+    :return: Dictionary with "num_frames", and when the dataset has those annotations "bounding box" (class counts,
+             area, aspect ratio and objects per frame histograms) and "keypoints" (number of keypoints in every
+             KEYPOINT_STATES per template and keypoint)
+    :rtype: dict
+    """
+    statistics = {"num_frames": ds.length()}
+    bounding_boxes = ds.get_annotation_table(ds.get_annotation_id(BOUNDING_BOX_NAME))
+    if bounding_boxes is not None:
+        statistics[BOUNDING_BOX_NAME] = _compute_bounding_box_statistics(bounding_boxes,
+                                                                         ds.get_label_mappings(BOUNDING_BOX_NAME))
+    keypoints = ds.get_annotation_table(ds.get_annotation_id(KEYPOINTS_NAME))
+    if keypoints is not None:
+        statistics[KEYPOINTS_NAME] = _compute_keypoint_statistics(keypoints, ds.get_annotation_spec(KEYPOINTS_NAME))
+    return statistics
+
+
+def _add_arrays(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    # objects per frame and keypoint arrays have different lengths in different instances
+    shape = tuple(max(size_a, size_b) for size_a, size_b in zip(a.shape, b.shape))
+    total = np.zeros(shape, dtype=np.result_type(a, b))
+    total[tuple(slice(0, size) for size in a.shape)] += a
+    total[tuple(slice(0, size) for size in b.shape)] += b
+    return total
+
+
+def _add_counts(a: Dict[str, float], b: Dict[str, float]) -> Dict[str, float]:
+    total = dict(a)
+    for name, value in b.items():
+        total[name] = total.get(name, 0) + value
+    return total
+
+
+def merge_statistics(statistics_list: List[dict]) -> dict:
+    """ Sums the statistics of several datasets, e.g. the instances of a Datamaker dataset
+
+    :param statistics_list: statistics returned by compute_statistics
+    :type statistics_list: List[dict]
+    :return: statistics of all the datasets together
+    :rtype: dict
+    """
+    merged = {"num_frames": 0}
+    for statistics in statistics_list:
+        merged["num_frames"] += statistics["num_frames"]
+        boxes = statistics.get(BOUNDING_BOX_NAME)
+        if boxes is not None:
+            total = merged.get(BOUNDING_BOX_NAME)
+            if total is None:
+                merged[BOUNDING_BOX_NAME] = dict(boxes)
+            else:
+                merged[BOUNDING_BOX_NAME] = {
+                    key: _add_counts(total[key], value) if isinstance(value, dict) else
+                    _add_arrays(total[key], value) if isinstance(value, np.ndarray) else total[key] + value
+                    for key, value in boxes.items()
+                }
+        for template_name, keypoints in statistics.get(KEYPOINTS_NAME, {}).items():
+            templates = merged.setdefault(KEYPOINTS_NAME, {})
+            total = templates.get(template_name)
+            if total is None:
+                templates[template_name] = dict(keypoints)
+            else:
+                state_counts = _add_arrays(total["state_counts"], keypoints["state_counts"])
+                labels = max(total["labels"], keypoints["labels"], key=len)
+                templates[template_name] = {"num_figures": total["num_figures"] + keypoints["num_figures"],
+                                            "labels": labels, "state_counts": state_counts}
+    return merged
+
+
+def load_statistics(data_root: str) -> Optional[dict]:
+    """ Reads the statistics of the dataset from its index without opening the dataset
+
+    :param data_root: Root directory of the dataset
+    :type data_root: str
+    :return: the statistics, None if they were never computed for the current revision of the dataset
+    :rtype: dict
+    """
+    revision = dataset_index.get_revision(dataset_index.compute_signature(data_root))
+    return dataset_index.load_extra(data_root, STATISTICS_EXTRA, revision)
+
+
+def get_statistics(ds) -> dict:
+    """ Gets the statistics of the dataset from its index, computing and storing them if needed, see
+    dataset_index.get_extra
+
+    :param ds: a valid dataset
+    :type ds: Dataset
+    :return: see compute_statistics
+    :rtype: dict
+    """
+    return dataset_index.get_extra(ds.data_root, STATISTICS_EXTRA, ds.revision, lambda: compute_statistics(ds),
+                                   ds.use_index)
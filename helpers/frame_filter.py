@@ -0,0 +1,153 @@
+from typing import List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+import helpers.dataset_index as dataset_index
+
+# --------------------------------Frame filter---------------------------------------------------------------------------
+# Selects the frames whose bounding boxes match a filter. The boxes of the dataset are flattened once into columns (the
+# frame, label id and area of every box) that are stored in the dataset index, a filter is then a few vectorized NumPy
+# operations over the columns instead of a pass over every annotation record.
+
+FRAME_COLUMNS_EXTRA = "frame_columns"
+
+BOUNDING_BOX_NAME = "bounding box"
+
+
+class FrameFilter(NamedTuple):
+    """ A box matches when its label is one of classes (any label if classes is empty) and its area in pixels is
+    within [min_area, max_area], a frame matches when its number of matching boxes is within [min_boxes, max_boxes],
+    None bounds are not checked
+    """
+    classes: Tuple[str, ...] = ()
+    min_area: Optional[float] = None
+    max_area: Optional[float] = None
+    min_boxes: int = 1
+    max_boxes: Optional[int] = None
+
+
+def build_frame_columns(ds) -> dict:
+    """ Flattens the bounding boxes of the dataset into columns
+
+    :param ds: a valid dataset
+    :type ds: Dataset
+    :return: Dictionary with "num_frames", "label_names" (label id -> label name) and one entry per box in
+             "box_frame" (frame index), "box_label" (label id) and "box_area" (area in pixels)
+    :rtype: dict
+    """
+    columns = {
+        "num_frames": ds.length(),
+        "label_names": dict(ds.get_label_mappings(BOUNDING_BOX_NAME)),
+        "box_frame": np.zeros(0, dtype=np.int64),
+        "box_label": np.zeros(0, dtype=np.int64),
+        "box_area": np.zeros(0, dtype=np.float64),
+    }
+    table = ds.get_annotation_table(ds.get_annotation_id(BOUNDING_BOX_NAME))
+    if table is None:
+        return columns
+
+    # the frame index of a box is the row of its capture in the sorted captures, like when the boxes are drawn
+    columns["box_frame"] = table.get_frames()
+    columns["box_label"] = table.get_column("label_id", default=-1).astype(np.int64)
+    columns["box_area"] = (table.get_column("width").astype(np.float64) *
+                           table.get_column("height").astype(np.float64))
+    # labels missing from the annotation definition are named after their first box
+    unique_labels, first_boxes = np.unique(columns["box_label"], return_index=True)
+    for label_id, position in zip(unique_labels.tolist(), first_boxes.tolist()):
+        if label_id not in columns["label_names"] and table.has_column("label_name"):
+            label_name = table.columns["label_name"].get(position, position + 1)[0]
+            if label_name is not None:
+                columns["label_names"][label_id] = label_name
+    return columns
+
+
+def load_frame_columns(data_root: str) -> Optional[dict]:
+    """ Reads the columns of the dataset from its index without opening the dataset
+
+    :param data_root: Root directory of the dataset
+    :type data_root: str
+    :return: see build_frame_columns, None if they were never built for the current revision of the dataset
+    :rtype: dict
+    """
+    revision = dataset_index.get_revision(dataset_index.compute_signature(data_root))
+    return dataset_index.load_extra(data_root, FRAME_COLUMNS_EXTRA, revision)
+
+
+def get_frame_columns(ds) -> dict:
+    """ Gets the columns of the dataset from its index, building and storing them if needed, see
+    dataset_index.get_extra
+
+    :param ds: a valid dataset
+    :type ds: Dataset
+    :return: see build_frame_columns
+    :rtype: dict
+    """
+    return dataset_index.get_extra(ds.data_root, FRAME_COLUMNS_EXTRA, ds.revision, lambda: build_frame_columns(ds),
+                                   ds.use_index)
+
+
+def concatenate_columns(columns_list: List[dict], offsets: List[int], num_frames: int) -> dict:
+    """ Joins the columns of several datasets, e.g. the instances of a Datamaker dataset
+
+    :param columns_list: columns of every dataset, see build_frame_columns
+    :type columns_list: List[dict]
+    :param offsets: index of the first frame of every dataset in the joined dataset
+    :type offsets: List[int]
+    :param num_frames: number of frames of the joined dataset
+    :type num_frames: int
+    :return: columns of the joined dataset
+    :rtype: dict
+    """
+    label_names = {}
+    for columns in columns_list:
+        label_names.update(columns["label_names"])
+    return {
+        "num_frames": num_frames,
+        "label_names": label_names,
+        "box_frame": np.concatenate([np.zeros(0, dtype=np.int64)] + [
+            columns["box_frame"] + offset for columns, offset in zip(columns_list, offsets)]),
+        "box_label": np.concatenate([np.zeros(0, dtype=np.int64)] + [
+            columns["box_label"] for columns in columns_list]),
+        "box_area": np.concatenate([np.zeros(0, dtype=np.float64)] + [
+            columns["box_area"] for columns in columns_list]),
+    }
+
+
+def get_class_names(columns: dict) -> List[str]:
+    """ Gets the names of the labels of the boxes, for the classes of a FrameFilter
+
+    :param columns: see build_frame_columns
+    :type columns: dict
+    :return: sorted label names
+    :rtype: List[str]
+    """
+    return sorted(set(str(name) for name in columns["label_names"].values()))
+
+
+def filter_frames(columns: dict, frame_filter: FrameFilter) -> np.ndarray:
+    """ Selects the frames that match the filter
+
+    :param columns: see build_frame_columns
+    :type columns: dict
+    :param frame_filter: the filter
+    :type frame_filter: FrameFilter
+    :return: sorted indices of the matching frames
+    :rtype: np.ndarray
+    """
+    matching = np.ones(len(columns["box_frame"]), dtype=bool)
+    if len(frame_filter.classes) > 0:
+        class_names = set(frame_filter.classes)
+        label_ids = [label_id for label_id, name in columns["label_names"].items() if str(name) in class_names]
+        matching &= np.isin(columns["box_label"], label_ids)
+    if frame_filter.min_area is not None:
+        matching &= columns["box_area"] >= frame_filter.min_area
+    if frame_filter.max_area is not None:
+        matching &= columns["box_area"] <= frame_filter.max_area
+
+    counts = np.bincount(columns["box_frame"][matching], minlength=columns["num_frames"])[:columns["num_frames"]]
+    selected = np.ones(columns["num_frames"], dtype=bool)
+    if frame_filter.min_boxes is not None:
+        selected &= counts >= frame_filter.min_boxes
+    if frame_filter.max_boxes is not None:
+        selected &= counts <= frame_filter.max_boxes
+    return np.flatnonzero(selected)
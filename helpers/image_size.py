@@ -0,0 +1,201 @@
+import os
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from PIL import Image
+
+import helpers.dataset_index as dataset_index
+
+# --------------------------------Image size probe-----------------------------------------------------------------------
+# Reads the size of PNG and JPEG images from their first bytes instead of opening them with PIL, and caches the sizes
+# in the dataset index so that converting a dataset again does not touch the images at all.
+
+IMAGE_SIZES_EXTRA = "image_sizes"
+# the cached sizes are checked against the size and modification time of every image, not against the json files
+IMAGE_SIZES_REVISION = "file_stat"
+
+DEFAULT_NUM_WORKERS = min(16, (os.cpu_count() or 1) * 2)
+MIN_IMAGES_PER_WORKER = 64
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+JPEG_SOI = b"\xff\xd8"
+# start of frame markers, the other markers between 0xC0 and 0xCF (DHT, JPG and DAC) do not hold the size
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+# markers without a length field
+JPEG_STANDALONE_MARKERS = {0x01, 0xD0, 0xD1, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7, 0xD8}
+
+# keys of capture or sensor records that can hold the image size, in order of preference
+METADATA_SIZE_KEYS = ("dimension", "resolution")
+
+
+def _read_png_size(image_file) -> Optional[Tuple[int, int]]:
+    # signature, then the IHDR chunk: length, type, width, height
+    header = image_file.read(24)
+    if len(header) < 24 or header[:8] != PNG_SIGNATURE or header[12:16] != b"IHDR":
+        return None
+    return struct.unpack(">II", header[16:24])
+
+
+def _read_jpeg_size(image_file) -> Optional[Tuple[int, int]]:
+    image_file.seek(2)
+    while True:
+        # every marker starts with 0xFF and can be preceded by 0xFF fill bytes
+        if image_file.read(1) != b"\xff":
+            return None
+        marker = image_file.read(1)
+        while marker == b"\xff":
+            marker = image_file.read(1)
+        if not marker:
+            return None
+        marker = marker[0]
+        if marker in JPEG_STANDALONE_MARKERS:
+            continue
+        if marker == 0xD9 or marker == 0xDA:
+            # end of image or start of scan before any frame header
+            return None
+        length_bytes = image_file.read(2)
+        if len(length_bytes) < 2:
+            return None
+        length = struct.unpack(">H", length_bytes)[0]
+        if marker in JPEG_SOF_MARKERS:
+            frame_header = image_file.read(5)
+            if len(frame_header) < 5:
+                return None
+            height, width = struct.unpack(">HH", frame_header[1:5])
+            return width, height
+        image_file.seek(length - 2, os.SEEK_CUR)
+
+
+def probe_image_size(path: str) -> Tuple[int, int]:
+    """ Reads the size of an image from its header, PNG and JPEG headers are parsed directly, other formats are
+    opened with PIL
+
+    :param path: path to the image
+    :type path: str
+    :return: (width, height)
+    :rtype: Tuple[int, int]
+    """
+    with open(path, "rb") as image_file:
+        signature = image_file.read(8)
+        image_file.seek(0)
+        size = None
+        if signature == PNG_SIGNATURE:
+            size = _read_png_size(image_file)
+        elif signature[:2] == JPEG_SOI:
+            size = _read_jpeg_size(image_file)
+        if size is not None:
+            return size
+        image_file.seek(0)
+        with Image.open(image_file) as image:
+            return image.size
+
+
+def get_metadata_size(capture: dict) -> Optional[Tuple[int, int]]:
+    """ Gets the image size stored in a capture record or in its sensor, when the simulation recorded it
+
+    :param capture: capture record
+    :type capture: dict
+    :return: (width, height), None if the record does not hold the size
+    :rtype: Tuple[int, int]
+    """
+    for record in (capture, capture.get("sensor") or {}):
+        if not isinstance(record, dict):
+            continue
+        for key in METADATA_SIZE_KEYS:
+            value = record.get(key)
+            if isinstance(value, (list, tuple)) and len(value) >= 2:
+                try:
+                    width, height = int(value[0]), int(value[1])
+                except (TypeError, ValueError):
+                    continue
+                if width > 0 and height > 0:
+                    return width, height
+    return None
+
+
+class ImageSizeCache:
+    """ Sizes of the images of a dataset, read from the dataset index or probed and written back to it by save()
+    """
+
+    def __init__(self, data_root: str, num_workers: int = DEFAULT_NUM_WORKERS):
+        """
+        :param data_root: Root directory of the dataset
+        :type data_root: str
+        :param num_workers: Optional (Default: DEFAULT_NUM_WORKERS), number of images probed at the same time
+        :type num_workers: int
+        """
+        self.data_root = data_root
+        self.num_workers = max(1, num_workers)
+        # path relative to data_root -> (file size, mtime in nanoseconds, width, height)
+        self.entries = dataset_index.load_extra(data_root, IMAGE_SIZES_EXTRA, IMAGE_SIZES_REVISION) or {}
+        self.modified = False
+        self._lock = threading.Lock()
+
+    def _get_size(self, filename: str) -> Tuple[int, int]:
+        path = os.path.join(self.data_root, filename)
+        stat = os.stat(path)
+        entry = self.entries.get(filename)
+        if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return entry[2], entry[3]
+        width, height = probe_image_size(path)
+        with self._lock:
+            self.entries[filename] = (stat.st_size, stat.st_mtime_ns, width, height)
+            self.modified = True
+        return width, height
+
+    def _get_size_batch(self, filenames: List[str]) -> List[Tuple[int, int]]:
+        return [self._get_size(filename) for filename in filenames]
+
+    def get_sizes(self, filenames: List[str],
+                  metadata_sizes: Optional[List[Optional[Tuple[int, int]]]] = None) -> List[Tuple[int, int]]:
+        """ Gets the size of every image, from the metadata when it is known, otherwise from the cache or by probing
+        the images in a pool of threads. A size recorded in the metadata is only used once the header of one of the
+        images it is recorded for agrees with it, the images are probed otherwise
+
+        :param filenames: paths of the images relative to data_root
+        :type filenames: List[str]
+        :param metadata_sizes: Optional, size of every image read from its capture record, see get_metadata_size
+        :type metadata_sizes: List[Optional[Tuple[int, int]]]
+        :return: (width, height) of every image
+        :rtype: List[Tuple[int, int]]
+        """
+        if metadata_sizes is None:
+            metadata_sizes = [None] * len(filenames)
+        # recorded size -> whether it matches the image header, checked on the first image of every recorded size
+        # (usually one per sensor) so that images rescaled after the capture get the size of their file
+        matches = {}
+        for filename, size in zip(filenames, metadata_sizes):
+            if size is not None and size not in matches:
+                matches[size] = self._get_size(filename) == tuple(size)
+        sizes = [size if size is not None and matches[size] else None for size in metadata_sizes]
+        missing = [i for i, size in enumerate(sizes) if size is None]
+        if len(missing) > 0:
+            missing_filenames = [filenames[i] for i in missing]
+            if self.num_workers == 1 or len(missing) < MIN_IMAGES_PER_WORKER * 2:
+                probed = self._get_size_batch(missing_filenames)
+            else:
+                # one slice of images per worker, a task per image costs more than probing a cached file
+                num_slices = min(self.num_workers, len(missing) // MIN_IMAGES_PER_WORKER)
+                step = -(-len(missing) // num_slices)
+                with ThreadPoolExecutor(max_workers=num_slices) as executor:
+                    slices = executor.map(self._get_size_batch,
+                                          [missing_filenames[i:i + step] for i in range(0, len(missing), step)])
+                    probed = [size for sizes_slice in slices for size in sizes_slice]
+            for i, size in zip(missing, probed):
+                sizes[i] = size
+        return sizes
+
+    def save(self) -> bool:
+        """ Writes the probed sizes to the dataset index
+
+        :return: true if the sizes were written or nothing was probed, false if the dataset folder is not writable
+        :rtype: bool
+        """
+        if not self.modified:
+            return True
+        with self._lock:
+            entries = dict(self.entries)
+            self.modified = False
+        return dataset_index.save_extra(self.data_root, IMAGE_SIZES_EXTRA, entries, IMAGE_SIZES_REVISION)
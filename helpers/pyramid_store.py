@@ -0,0 +1,362 @@
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+import helpers.dataset_index as dataset_index
+
+# --------------------------------Pyramid store--------------------------------------------------------------------------
+# Optional preprocessed copies of the segmentation masks (and optionally of the RGB captures) of a dataset at every 2x
+# downsampled resolution, built by the pyramid command of cli.py. Every level is a single .npy file holding that level
+# of every frame, the renderer memory maps it and reads the smallest level that is big enough instead of decoding the
+# full size PNG.
+# Masks are downsampled by taking every other pixel so that the label colors are kept, RGB captures by averaging.
+# An image is only read from the store while its size and modification time are the ones it was built from.
+
+PYRAMID_DIR_NAME = "pyramid"
+MANIFEST_FILE = "manifest.json"
+PYRAMID_VERSION = 1
+
+# kind of images -> whether they are label maps
+SEMANTIC_SEGMENTATION = "semantic_segmentation"
+INSTANCE_SEGMENTATION = "instance_segmentation"
+RGB = "rgb"
+LABEL_MAP_KINDS = {SEMANTIC_SEGMENTATION: True, INSTANCE_SEGMENTATION: True, RGB: False}
+
+# levels bigger than this are not stored, which is enough for the grid thumbnails, bigger thumbnails and the zoom view
+# keep decoding the PNG files. Every level stores 4 bytes per pixel of every frame uncompressed: about 0.7 MB per frame
+# for a 1920x1080 mask with this default, 2.7 MB per frame with a maximum size of 1024
+DEFAULT_MAX_SIZE = 512
+# levels are stored down to the first one that fits in this size
+DEFAULT_MIN_SIZE = 64
+DEFAULT_NUM_WORKERS = os.cpu_count() or 1
+
+# kind directory -> (manifest modification time, PyramidStore)
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_pyramid_dir(data_root: str, kind: str) -> str:
+    """ Gets the directory where the pyramid of the given kind of images is stored
+
+    :param data_root: Root directory of the dataset
+    :type data_root: str
+    :param kind: SEMANTIC_SEGMENTATION, INSTANCE_SEGMENTATION or RGB
+    :type kind: str
+    :return: path to the directory
+    :rtype: str
+    """
+    return os.path.join(dataset_index.get_index_dir(data_root), PYRAMID_DIR_NAME, kind)
+
+
+def get_manifest_path(data_root: str, kind: str) -> str:
+    """ Gets the path to the manifest of the pyramid of the given kind of images, it is replaced last when the pyramid
+    is rebuilt
+
+    :param data_root: Root directory of the dataset
+    :type data_root: str
+    :param kind: SEMANTIC_SEGMENTATION, INSTANCE_SEGMENTATION or RGB
+    :type kind: str
+    :return: path to the manifest
+    :rtype: str
+    """
+    return os.path.join(get_pyramid_dir(data_root, kind), MANIFEST_FILE)
+
+
+def get_level_sizes(width: int, height: int, max_size: int = DEFAULT_MAX_SIZE,
+                    min_size: int = DEFAULT_MIN_SIZE) -> List[Tuple[int, int, int]]:
+    """ Lists the levels stored for images of the given size
+
+    :param width: width of the full size images
+    :type width: int
+    :param height: height of the full size images
+    :type height: int
+    :param max_size: Optional (Default: DEFAULT_MAX_SIZE), levels wider or taller than this are not stored
+    :type max_size: int
+    :param min_size: Optional (Default: DEFAULT_MIN_SIZE), the smallest level is the first one that fits in it
+    :type min_size: int
+    :return: (level, width, height) of every stored level, level k is the full size divided by 2^k
+    :rtype: List[Tuple[int, int, int]]
+    """
+    levels = []
+    level = 0
+    while True:
+        if max(width, height) <= max_size:
+            levels.append((level, width, height))
+        if max(width, height) <= min_size or (width == 1 and height == 1):
+            return levels
+        # same size as taking every other pixel
+        width, height = (width + 1) // 2, (height + 1) // 2
+        level += 1
+
+
+def _downsample(pixels: np.ndarray, label_map: bool) -> np.ndarray:
+    if label_map:
+        return pixels[::2, ::2]
+    # mean of every 2x2 block, the last row and column are repeated for odd sizes
+    height, width = pixels.shape[:2]
+    padded = np.pad(pixels, ((0, height % 2), (0, width % 2), (0, 0)), mode="edge").astype(np.uint16)
+    blocks = padded[0::2, 0::2] + padded[1::2, 0::2] + padded[0::2, 1::2] + padded[1::2, 1::2]
+    return ((blocks + 2) >> 2).astype(np.uint8)
+
+
+def _read_pixels(path: str, label_map: bool) -> np.ndarray:
+    with Image.open(path) as image:
+        return np.asarray(image.convert("RGBA" if label_map else "RGB"))
+
+
+def _file_stat(path: str) -> List[int]:
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def build_pyramid(data_root: str, kind: str, relative_paths: List[str], max_size: int = DEFAULT_MAX_SIZE,
+                  min_size: int = DEFAULT_MIN_SIZE, num_workers: int = DEFAULT_NUM_WORKERS,
+                  on_progress: Optional[Callable[[int, int], None]] = None) -> int:
+    """ Builds the pyramid of the given images, replacing the previous pyramid of that kind
+
+    The size of the first image is the size of every level, images of another size are left out and keep being read
+    from their files.
+
+    :param data_root: Root directory of the dataset
+    :type data_root: str
+    :param kind: one of LABEL_MAP_KINDS
+    :type kind: str
+    :param relative_paths: paths of the images relative to data_root
+    :type relative_paths: List[str]
+    :param max_size: Optional (Default: DEFAULT_MAX_SIZE), see get_level_sizes
+    :type max_size: int
+    :param min_size: Optional (Default: DEFAULT_MIN_SIZE), see get_level_sizes
+    :type min_size: int
+    :param num_workers: Optional (Default: DEFAULT_NUM_WORKERS), number of images decoded at the same time
+    :type num_workers: int
+    :param on_progress: Optional, called with (number of images done, number of images) from the calling thread
+    :type on_progress: Callable[[int, int], None]
+    :return: number of images stored
+    :rtype: int
+    """
+    label_map = LABEL_MAP_KINDS[kind]
+    relative_paths = list(dict.fromkeys(relative_paths))
+    if len(relative_paths) == 0:
+        return 0
+    first = _read_pixels(os.path.join(data_root, relative_paths[0]), label_map)
+    full_height, full_width, channels = first.shape
+    levels = get_level_sizes(full_width, full_height, max_size, min_size)
+
+    pyramid_dir = get_pyramid_dir(data_root, kind)
+    os.makedirs(pyramid_dir, exist_ok=True)
+    # Running viewers keep the previous levels memory mapped, they are never rewritten in place: the new levels are
+    # written to temporary files that replace them once complete. The manifest is removed first so that no reader opens
+    # a mix of old and new levels, and written last
+    manifest_path = get_manifest_path(data_root, kind)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    level_paths = [os.path.join(pyramid_dir, "level_{}.npy".format(level)) for level, _, _ in levels]
+    temp_suffix = dataset_index.get_temp_suffix()
+    arrays = [np.lib.format.open_memmap(path + temp_suffix, mode="w+", dtype=np.uint8,
+                                        shape=(len(relative_paths), height, width, channels))
+              for path, (_, width, height) in zip(level_paths, levels)]
+
+    def store(position: int) -> Optional[List[int]]:
+        path = os.path.join(data_root, relative_paths[position])
+        stat = _file_stat(path)
+        pixels = first if position == 0 else _read_pixels(path, label_map)
+        if pixels.shape != first.shape:
+            return None
+        level = 0
+        for (stored_level, _, _), array in zip(levels, arrays):
+            while level < stored_level:
+                pixels = _downsample(pixels, label_map)
+                level += 1
+            array[position] = pixels
+        return stat
+
+    files = {}
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+            for position, stat in enumerate(executor.map(store, range(len(relative_paths)))):
+                if stat is not None:
+                    files[relative_paths[position]] = [position] + stat
+                if on_progress is not None:
+                    on_progress(position + 1, len(relative_paths))
+        for array in arrays:
+            array.flush()
+        # drops the memory maps of the temporary files
+        arrays.clear()
+        for path in level_paths:
+            os.replace(path + temp_suffix, path)
+    finally:
+        for path in level_paths:
+            if os.path.exists(path + temp_suffix):
+                os.remove(path + temp_suffix)
+
+    manifest = {
+        "version": PYRAMID_VERSION,
+        "full_size": [full_width, full_height],
+        "levels": [list(level) for level in levels],
+        # relative path -> [position in the levels, file size, mtime in nanoseconds]
+        "files": files,
+    }
+    temp_path = manifest_path + temp_suffix
+    with open(temp_path, "w", encoding="utf8") as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(temp_path, manifest_path)
+
+    # levels of a previous build that are no longer stored, readers that still map them keep their data
+    for name in os.listdir(pyramid_dir):
+        if name.startswith("level_") and name.endswith(".npy") and os.path.join(pyramid_dir, name) not in level_paths:
+            os.remove(os.path.join(pyramid_dir, name))
+    return len(files)
+
+
+class PyramidStore:
+    """ Read access to a pyramid built by build_pyramid, the levels are memory mapped
+    """
+
+    def __init__(self, pyramid_dir: str, manifest: dict, label_map: bool):
+        """
+        :param pyramid_dir: directory of the pyramid, see get_pyramid_dir
+        :type pyramid_dir: str
+        :param manifest: content of its manifest
+        :type manifest: dict
+        :param label_map: whether the images are label maps
+        :type label_map: bool
+        """
+        self.pyramid_dir = pyramid_dir
+        self.full_size = tuple(manifest["full_size"])
+        self.files = manifest["files"]
+        self.label_map = label_map
+        # (width, height, memory mapped level) from the smallest level to the biggest
+        self.levels = [(width, height, np.load(os.path.join(pyramid_dir, "level_{}.npy".format(level)), mmap_mode="r"))
+                       for level, width, height in sorted(manifest["levels"], key=lambda entry: -entry[0])]
+
+    def get_pixels(self, data_root: str, relative_path: str, min_width: int, min_height: int) -> Optional[np.ndarray]:
+        """ Reads the smallest level of an image that is at least min_width x min_height
+
+        :param data_root: Root directory of the dataset
+        :type data_root: str
+        :param relative_path: path of the image relative to data_root
+        :type relative_path: str
+        :param min_width: width needed
+        :type min_width: int
+        :param min_height: height needed
+        :type min_height: int
+        :return: the pixels, None if the image is not stored, changed since it was stored or no level is big enough
+        :rtype: np.ndarray
+        """
+        entry = self.files.get(relative_path)
+        if entry is None:
+            return None
+        try:
+            if _file_stat(os.path.join(data_root, relative_path)) != entry[1:]:
+                return None
+        except OSError:
+            return None
+        for width, height, array in self.levels:
+            if width >= min_width and height >= min_height:
+                return array[entry[0]]
+        return None
+
+
+def get_store(data_root: str, kind: str) -> Optional[PyramidStore]:
+    """ Gets the pyramid of the given kind of images of the dataset, reopened when it is rebuilt
+
+    :param data_root: Root directory of the dataset
+    :type data_root: str
+    :param kind: one of LABEL_MAP_KINDS
+    :type kind: str
+    :return: the pyramid, None if it was not built
+    :rtype: PyramidStore
+    """
+    pyramid_dir = get_pyramid_dir(os.path.abspath(data_root), kind)
+    manifest_path = get_manifest_path(os.path.abspath(data_root), kind)
+    try:
+        mtime = os.stat(manifest_path).st_mtime_ns
+    except OSError:
+        return None
+    with _stores_lock:
+        cached = _stores.get(pyramid_dir)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        try:
+            with open(manifest_path, "r", encoding="utf8") as manifest_file:
+                manifest = json.load(manifest_file)
+            if manifest.get("version") != PYRAMID_VERSION:
+                return None
+            store = PyramidStore(pyramid_dir, manifest, LABEL_MAP_KINDS[kind])
+        except (OSError, ValueError, KeyError):
+            return None
+        _stores[pyramid_dir] = (mtime, store)
+        return store
+
+
+def load_label_map(data_root: str, kind: str, relative_path: str, size: Tuple[int, int]) -> Optional[Image.Image]:
+    """ Reads a segmentation mask from the pyramid at the given size, resized with nearest neighbour sampling
+
+    :param data_root: Root directory of the dataset
+    :type data_root: str
+    :param kind: SEMANTIC_SEGMENTATION or INSTANCE_SEGMENTATION
+    :type kind: str
+    :param relative_path: path of the mask relative to data_root
+    :type relative_path: str
+    :param size: (width, height) of the mask to return
+    :type size: Tuple[int, int]
+    :return: RGBA mask, None if the mask has to be read from its file
+    :rtype: PIL.Image
+    """
+    store = get_store(data_root, kind)
+    if store is None:
+        return None
+    pixels = store.get_pixels(data_root, relative_path, size[0], size[1])
+    if pixels is None:
+        return None
+    image = Image.fromarray(np.asarray(pixels), "RGBA")
+    if image.size != tuple(size):
+        image = image.resize(tuple(size), Image.NEAREST)
+    return image
+
+
+def load_thumbnail(data_root: str, relative_path: str, max_size: int) -> Optional[Tuple[Image.Image, Tuple[int, int]]]:
+    """ Reads an RGB capture from the pyramid, shrunk to fit in max_size x max_size like PIL's thumbnail
+
+    :param data_root: Root directory of the dataset
+    :type data_root: str
+    :param relative_path: path of the capture relative to data_root
+    :type relative_path: str
+    :param max_size: maximum width and height
+    :type max_size: int
+    :return: (the capture, (width, height) of the full size capture), None if it has to be read from its file
+    :rtype: Tuple[PIL.Image, Tuple[int, int]]
+    """
+    store = get_store(data_root, RGB)
+    if store is None:
+        return None
+    full_width, full_height = store.full_size
+    scale = min(1.0, max_size / full_width, max_size / full_height)
+    pixels = store.get_pixels(data_root, relative_path, int(full_width * scale), int(full_height * scale))
+    if pixels is None:
+        return None
+    image = Image.fromarray(np.asarray(pixels), "RGB")
+    image.thumbnail((max_size, max_size))
+    return image, (full_width, full_height)
+
+
+def get_pyramid_sources(ds) -> Dict[str, List[str]]:
+    """ Lists the images of the dataset that can be stored in pyramids
+
+    :param ds: a valid dataset
+    :type ds: Dataset
+    :return: kind -> paths of the images relative to the dataset root, kinds without images are left out
+    :rtype: Dict[str, List[str]]
+    """
+    sources = {RGB: ds.get_captures(ds.annotation_records[0]["id"])["filename"].tolist()}
+    for name, kind in (("semantic segmentation", SEMANTIC_SEGMENTATION),
+                       ("instance segmentation", INSTANCE_SEGMENTATION)):
+        definition_id = ds.get_annotation_id(name)
+        if definition_id in ds.capture_index:
+            sources[kind] = ds.get_captures(definition_id)["annotation.filename"].tolist()
+    return sources
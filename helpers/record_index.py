@@ -0,0 +1,92 @@
+import json
+import os
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+import helpers.dataset_index as dataset_index
+
+# --------------------------------Record index---------------------------------------------------------------------------
+# Locations of the raw capture and metric records in the dataset json files, so that showing the metadata of a frame
+# reads a single captures file and the metrics files of that frame instead of every captures and metrics file.
+# The locations are computed once per revision of the dataset and stored in the dataset index.
+
+RECORD_LOCATIONS_EXTRA = "record_locations"
+
+# (path of the json file relative to the dataset root, position of the record in the file)
+RecordLocation = Tuple[str, int]
+
+
+def _read_records(data_root: str, relative_path: str, key: str) -> List[dict]:
+    with open(os.path.join(data_root, relative_path), "r", encoding="utf8") as json_file:
+        return json.load(json_file)[key]
+
+
+@lru_cache(maxsize=8)
+def _read_records_cached(data_root: str, relative_path: str, key: str, revision: str) -> List[dict]:
+    # the revision is part of the cache key so that a modified file is read again
+    return _read_records(data_root, relative_path, key)
+
+
+def build_record_locations(data_root: str, source_files: Tuple[str, ...]) -> Dict[str, dict]:
+    """ Reads every captures and metrics file of the dataset once and records where each record is stored
+
+    :param data_root: Root directory of the dataset
+    :type data_root: str
+    :param source_files: paths of the dataset json files relative to data_root, see dataset_index.compute_signature
+    :type source_files: Tuple[str, ...]
+    :return: Dictionary with "captures", capture id -> RecordLocation, and "metrics", (sequence_id, step) -> list of
+             RecordLocation in file order
+    :rtype: Dict[str, dict]
+    """
+    captures = {}
+    metrics = {}
+    for relative_path in sorted(source_files):
+        name = os.path.basename(relative_path)
+        if name.startswith("captures_"):
+            for position, record in enumerate(_read_records(data_root, relative_path, "captures")):
+                captures[record["id"]] = (relative_path, position)
+        elif name.startswith("metrics_"):
+            for position, record in enumerate(_read_records(data_root, relative_path, "metrics")):
+                metrics.setdefault((record["sequence_id"], record["step"]), []).append((relative_path, position))
+    return {"captures": captures, "metrics": metrics}
+
+
+def get_record_locations(data_root: str, revision: str, source_files: Tuple[str, ...],
+                         use_index: bool = True) -> Dict[str, dict]:
+    """ Gets the record locations of the dataset from its index, building and storing them if needed, see
+    dataset_index.get_extra
+
+    :param data_root: Root directory of the dataset
+    :type data_root: str
+    :param revision: revision of the dataset, see dataset_index.get_revision
+    :type revision: str
+    :param source_files: paths of the dataset json files relative to data_root
+    :type source_files: Tuple[str, ...]
+    :param use_index: Optional (Default: True), if false the locations are neither read from nor written to the index
+    :type use_index: bool
+    :return: see build_record_locations
+    :rtype: Dict[str, dict]
+    """
+    return dataset_index.get_extra(data_root, RECORD_LOCATIONS_EXTRA, revision,
+                                   lambda: build_record_locations(data_root, source_files), use_index)
+
+
+def read_record(data_root: str, location: RecordLocation, key: str, revision: str) -> Optional[dict]:
+    """ Reads a single raw record of the dataset json files
+
+    :param data_root: Root directory of the dataset
+    :type data_root: str
+    :param location: where the record is stored
+    :type location: RecordLocation
+    :param key: "captures" or "metrics"
+    :type key: str
+    :param revision: revision of the dataset, see dataset_index.get_revision
+    :type revision: str
+    :return: the record as stored in the json file, None if the file can not be read anymore
+    :rtype: dict
+    """
+    relative_path, position = location
+    try:
+        return _read_records_cached(data_root, relative_path, key, revision)[position]
+    except (OSError, ValueError, KeyError, IndexError):
+        return None
@@ -0,0 +1,109 @@
+import threading
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional
+
+from PIL import Image
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+
+def image_nbytes(image: Image) -> int:
+    """ Estimates the memory used by the pixels of an image
+
+    :param image: the PIL image
+    :type image: PIL.Image
+    :return: size in bytes
+    :rtype: int
+    """
+    return image.width * image.height * len(image.getbands())
+
+
+class RenderCache:
+    """ Least recently used cache of rendered images bounded by the total size of the cached images
+
+    The cache is shared between threads, cached images are returned as is and must not be modified by the caller.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES):
+        """
+        :param max_bytes: Optional (Default: DEFAULT_MAX_BYTES), once the cached images take more than this, the least
+                          recently used ones are evicted
+        :type max_bytes: int
+        """
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Image]:
+        """ Gets the image cached under key and marks it as the most recently used
+
+        :param key: cache key
+        :type key: Hashable
+        :return: the cached image, None if it is not in the cache
+        :rtype: PIL.Image
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, image: Image):
+        """ Caches image under key, evicting the least recently used images if the cache is full
+
+        :param key: cache key
+        :type key: Hashable
+        :param image: the rendered image
+        :type image: PIL.Image
+        """
+        size = image_nbytes(image)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.current_bytes -= previous[1]
+            self._entries[key] = (image, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+
+    def clear(self):
+        """ Removes every image from the cache and resets the counters
+        """
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def stats(self) -> Dict[str, int]:
+        """ Gets the counters of the cache
+
+        :return: Dictionary with the number of hits, misses, cached images and cached bytes
+        :rtype: Dict[str, int]
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+            }
+
+
+# Cache shared by every Dataset of the process, so that it survives streamlit reruns which create new Dataset objects
+render_cache = RenderCache()
@@ -0,0 +1,148 @@
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait
+from typing import Dict, Hashable, Iterator, List, Tuple
+
+from PIL import Image
+
+from Dataset import Dataset
+from helpers.render_cache import render_cache
+
+# A render job is (slot, dataset, frame index in the dataset, labelers_to_use, max_size), the slot is handed back with
+# the image so that the caller knows which container to fill
+RenderJob = Tuple[int, Dataset, int, Dict[str, bool], int]
+
+# A prefetch job is (dataset, frame index in the dataset, labelers_to_use, max_size)
+PrefetchJob = Tuple[Dataset, int, Dict[str, bool], int]
+
+DEFAULT_NUM_WORKERS = min(8, os.cpu_count() or 1)
+DEFAULT_NUM_PREFETCH_WORKERS = 2
+
+
+class Prefetcher:
+    """ Renders frames the user is likely to look at next in background threads, the frames end up in the render cache
+    so that displaying them later is a cache hit
+    """
+
+    def __init__(self, num_workers: int = DEFAULT_NUM_PREFETCH_WORKERS):
+        """
+        :param num_workers: Optional (Default: DEFAULT_NUM_PREFETCH_WORKERS), number of frames prefetched at the same
+                            time, kept low so that prefetching does not slow down the page being displayed
+        :type num_workers: int
+        """
+        self._executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="prefetch")
+        self._pending = {}
+        # reentrant because cancelling a future runs its done callback, which takes the lock, right away
+        self._lock = threading.RLock()
+
+    def schedule(self, jobs: List[PrefetchJob]):
+        """ Replaces the frames to prefetch, frames of a previous schedule that did not start yet and are not part of
+        jobs are cancelled
+
+        :param jobs: frames to prefetch, in order of priority
+        :type jobs: List[PrefetchJob]
+        """
+        wanted = {}
+        for job in jobs:
+            ds, index, labelers, max_size = job
+            wanted.setdefault(ds.get_render_cache_key(index, labelers, max_size), job)
+
+        with self._lock:
+            for key, future in list(self._pending.items()):
+                if key not in wanted and future.cancel():
+                    self._pending.pop(key, None)
+            for key, job in wanted.items():
+                if key in self._pending or key in render_cache:
+                    continue
+                future = self._executor.submit(Prefetcher._prefetch, job)
+                self._pending[key] = future
+                future.add_done_callback(lambda done, done_key=key: self._discard(done_key, done))
+
+    def cancel(self):
+        """ Cancels every frame that did not start rendering yet
+        """
+        self.schedule([])
+
+    def wait(self, key: Hashable):
+        """ Makes sure that the frame with the given render cache key is not being prefetched, the frame is either
+        cancelled if it did not start yet or waited for if it is rendering, so that it is never rendered twice
+
+        :param key: render cache key of the frame, see Dataset.get_render_cache_key
+        :type key: Hashable
+        """
+        with self._lock:
+            future = self._pending.get(key)
+        if future is not None and not future.cancel():
+            wait([future])
+
+    def _discard(self, key: Hashable, future: Future):
+        with self._lock:
+            if self._pending.get(key) is future:
+                del self._pending[key]
+
+    @staticmethod
+    def _prefetch(job: PrefetchJob):
+        ds, index, labelers, max_size = job
+        try:
+            ds.get_image_with_labelers(index, labelers, max_size=max_size)
+        except Exception:
+            # a frame that fails to render raises again when it is displayed, where the error can be shown
+            pass
+
+
+# Prefetcher shared by every streamlit rerun of the process
+prefetcher = Prefetcher()
+
+
+def _render(job: RenderJob) -> Image:
+    _, ds, index, labelers, max_size = job
+    prefetcher.wait(ds.get_render_cache_key(index, labelers, max_size))
+    return ds.get_image_with_labelers(index, labelers, max_size=max_size)
+
+
+def render_frame(ds: Dataset, index: int, labelers: Dict[str, bool], max_size: int) -> Image:
+    """ Renders a single frame, waiting for the prefetcher instead of rendering the frame a second time if it is being
+    prefetched
+
+    :param ds: Dataset of the frame
+    :type ds: Dataset
+    :param index: frame index in the dataset
+    :type index: int
+    :param labelers: Dictionary of labeler name to whether or not to display it
+    :type labelers: Dict[str, bool]
+    :param max_size: maximum size of width and height of the rendered image
+    :type max_size: int
+    :return: The image with the labelers
+    :rtype: PIL.Image
+    """
+    return _render((0, ds, index, labelers, max_size))
+
+
+def render_frames(jobs: List[RenderJob], num_workers: int = DEFAULT_NUM_WORKERS) -> Iterator[Tuple[int, Image]]:
+    """ Renders the given frames and yields them as soon as each one is done
+
+    Frames are rendered in a thread pool, image decoding, resizing and most of the drawing happen in Pillow which
+    releases the GIL, so the frames of a page are rendered in parallel.
+
+    :param jobs: frames to render, see RenderJob
+    :type jobs: List[RenderJob]
+    :param num_workers: Optional (Default: DEFAULT_NUM_WORKERS), number of frames rendered at the same time,
+                        1 renders the frames one after another in order
+    :type num_workers: int
+    :return: iterator of (slot, image) in the order in which the frames finished
+    :rtype: Iterator[Tuple[int, PIL.Image]]
+    """
+    if num_workers <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            yield job[0], _render(job)
+        return
+
+    with ThreadPoolExecutor(max_workers=min(num_workers, len(jobs))) as executor:
+        futures = {executor.submit(_render, job): job[0] for job in jobs}
+        try:
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        finally:
+            # the page is abandoned (e.g. streamlit stopped the script), do not render the rest of it
+            for future in futures:
+                future.cancel()
@@ -0,0 +1,209 @@
+import hashlib
+import os
+import threading
+from typing import FrozenSet, List, Optional
+
+from PIL import Image
+
+# --------------------------------Thumbnail cache------------------------------------------------------------------------
+# Optional on-disk cache of rendered frames shared by every streamlit session and the command line tools. It is
+# enabled by setting THUMBNAIL_CACHE_DIR_ENV to a directory (cli.py does it with --thumbnail-cache).
+
+THUMBNAIL_CACHE_DIR_ENV = "VISUALIZER_THUMBNAIL_CACHE"
+THUMBNAIL_CACHE_SIZE_ENV = "VISUALIZER_THUMBNAIL_CACHE_MB"
+
+DEFAULT_MAX_MB = 2048
+# the largest grid resolution, see get_resolution_from_num_cols in preview.py. Zoomed frames are not cached on disk
+DEFAULT_MAX_RESOLUTION = 1000
+
+FORMAT_EXTENSIONS = {"JPEG": ".jpg", "WEBP": ".webp", "PNG": ".png"}
+
+
+class DiskThumbnailCache:
+    """ Cache of rendered frames stored as image files, evicting the least recently used files once the files take
+    more than max_bytes
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = DEFAULT_MAX_MB * 1024 * 1024, image_format: str = "JPEG",
+                 quality: int = 90, max_resolution: int = DEFAULT_MAX_RESOLUTION):
+        """
+        :param cache_dir: directory where the thumbnails are stored, it is created if needed
+        :type cache_dir: str
+        :param max_bytes: Optional (Default: 2 GB), size the thumbnails are allowed to take on disk
+        :type max_bytes: int
+        :param image_format: Optional (Default: JPEG), one of FORMAT_EXTENSIONS
+        :type image_format: str
+        :param quality: Optional (Default: 90), JPEG/WebP quality
+        :type quality: int
+        :param max_resolution: Optional (Default: DEFAULT_MAX_RESOLUTION), frames rendered with a bigger max_size are
+                               not cached
+        :type max_resolution: int
+        """
+        assert image_format in FORMAT_EXTENSIONS, "Unsupported thumbnail format: " + str(image_format)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.image_format = image_format
+        self.extension = FORMAT_EXTENSIONS[image_format]
+        self.quality = quality
+        self.max_resolution = max_resolution
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.current_bytes = self._scan_size()
+
+    def _scan_size(self) -> int:
+        total = 0
+        for directory, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith(self.extension):
+                    total += os.path.getsize(os.path.join(directory, name))
+        return total
+
+    def accepts(self, max_size: int) -> bool:
+        """ Whether frames rendered with the given max_size are cached
+
+        :param max_size: max_size passed to get_image_with_labelers
+        :type max_size: int
+        :rtype: bool
+        """
+        return max_size <= self.max_resolution
+
+    @staticmethod
+    def make_key(source_filenames: List[str], revision: str, labelers: FrozenSet[str], max_size: int) -> str:
+        """ Creates the key of a rendered frame from everything its pixels depend on
+
+        :param source_filenames: paths to the files the frame is rendered from (the RGB capture, the masks, the
+                                 manifests of the pyramids), their size and modification time are part of the key
+        :type source_filenames: List[str]
+        :param revision: revision of the dataset json files, see dataset_index.get_revision
+        :type revision: str
+        :param labelers: names of the labelers drawn on the frame
+        :type labelers: FrozenSet[str]
+        :param max_size: max_size the frame was rendered with
+        :type max_size: int
+        :return: hex digest used as file name
+        :rtype: str
+        """
+        content = []
+        for source_filename in source_filenames:
+            try:
+                stat = os.stat(source_filename)
+                content += [os.path.abspath(source_filename), str(stat.st_size), str(stat.st_mtime_ns)]
+            except FileNotFoundError:
+                # e.g. a pyramid that was not built, the key changes once it is
+                content += [os.path.abspath(source_filename), "missing"]
+        content = "|".join(content + [str(revision), ",".join(sorted(labelers)), str(max_size)])
+        return hashlib.sha1(content.encode("utf8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + self.extension)
+
+    def get(self, key: str) -> Optional[Image.Image]:
+        """ Reads the thumbnail cached under key and marks it as the most recently used
+
+        :param key: key created by make_key
+        :type key: str
+        :return: the thumbnail, None if it is not cached
+        :rtype: PIL.Image
+        """
+        path = self._path(key)
+        try:
+            image = Image.open(path)
+            # load() reads the whole file and closes it
+            image.load()
+            # the modification time is the "last used" time of the least recently used eviction
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return image
+
+    def put(self, key: str, image: Image.Image):
+        """ Writes image to the cache under key, then evicts the least recently used thumbnails if the cache is full
+
+        :param key: key created by make_key
+        :type key: str
+        :param image: the rendered frame
+        :type image: PIL.Image
+        """
+        path = self._path(key)
+        temp_path = path + ".tmp" + str(os.getpid()) + "_" + str(threading.get_ident())
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if self.image_format == "PNG":
+                image.save(temp_path, format="PNG")
+            else:
+                image.convert("RGB").save(temp_path, format=self.image_format, quality=self.quality)
+            size = os.path.getsize(temp_path)
+            os.replace(temp_path, path)
+        except OSError as e:
+            print("Could not write thumbnail: " + str(e))
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+        with self._lock:
+            self.current_bytes += size
+            if self.current_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # other processes write to the same directory, so the real size is measured before deleting anything
+        entries = []
+        for directory, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith(self.extension):
+                    path = os.path.join(directory, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime_ns, stat.st_size, path))
+        total = sum(entry[1] for entry in entries)
+        # free a bit more than needed so that eviction does not run again on the next write
+        target = int(self.max_bytes * 0.9)
+        entries.sort()
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        self.current_bytes = total
+
+
+def from_environment() -> Optional[DiskThumbnailCache]:
+    """ Creates the thumbnail cache configured by the THUMBNAIL_CACHE_DIR_ENV and THUMBNAIL_CACHE_SIZE_ENV environment
+    variables
+
+    :return: the cache, None if THUMBNAIL_CACHE_DIR_ENV is not set
+    :rtype: DiskThumbnailCache
+    """
+    cache_dir = os.environ.get(THUMBNAIL_CACHE_DIR_ENV)
+    if not cache_dir:
+        return None
+    max_mb = int(os.environ.get(THUMBNAIL_CACHE_SIZE_ENV, DEFAULT_MAX_MB))
+    try:
+        return DiskThumbnailCache(cache_dir, max_bytes=max_mb * 1024 * 1024)
+    except OSError as e:
+        print("Could not open the thumbnail cache: " + str(e))
+        return None
+
+
+thumbnail_cache = from_environment()
+
+
+def configure(cache_dir: Optional[str], max_mb: int = DEFAULT_MAX_MB):
+    """ Enables (or disables when cache_dir is None) the thumbnail cache of this process and of the processes it starts
+
+    :param cache_dir: directory where the thumbnails are stored
+    :type cache_dir: str
+    :param max_mb: Optional (Default: DEFAULT_MAX_MB), size the thumbnails are allowed to take on disk in megabytes
+    :type max_mb: int
+    """
+    global thumbnail_cache
+    if cache_dir:
+        os.environ[THUMBNAIL_CACHE_DIR_ENV] = cache_dir
+        os.environ[THUMBNAIL_CACHE_SIZE_ENV] = str(max_mb)
+    else:
+        os.environ.pop(THUMBNAIL_CACHE_DIR_ENV, None)
+    thumbnail_cache = from_environment()
@@ -0,0 +1,130 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+import helpers.datamaker_loader as datamaker_loader
+import helpers.dataset_stats as dataset_stats
+from Dataset import Dataset
+
+
+def get_dataset_statistics(data_root: str):
+    """ Gets the statistics of a Perception dataset or of the loaded instances of a Datamaker dataset
+
+    :param data_root: Root directory of the dataset
+    :type data_root: str
+    :return: (statistics, description of what they cover), statistics are None if the folder is not a valid dataset
+    :rtype: Tuple[dict, str]
+    """
+    loader = datamaker_loader.get_loader(data_root)
+    if loader is not None:
+        instances = loader.wait_for_dataset()
+        if instances is None:
+            return None, ""
+        instance_statistics = []
+        for key in instances.keys:
+            statistics = None
+            if isinstance(instances, datamaker_loader.LazyDatamakerDataset):
+                # do not parse an instance that is not in memory when its statistics are in its index
+                statistics = dataset_stats.load_statistics(instances.attempts[key])
+            if statistics is None:
+                statistics = dataset_stats.get_statistics(instances.get_instance(key))
+            instance_statistics.append(statistics)
+        statistics = dataset_stats.merge_statistics(instance_statistics)
+        num_loaded, num_attempts = loader.progress()
+        return statistics, f"{num_loaded} of {num_attempts} Datamaker instances"
+
+    # the statistics are read from the dataset index without opening the dataset when they are up to date
+    statistics = dataset_stats.load_statistics(data_root)
+    if statistics is None:
+        ds = Dataset(data_root)
+        if not ds.dataset_valid:
+            return None, ""
+        with st.spinner("Computing the statistics of the dataset..."):
+            statistics = dataset_stats.get_statistics(ds)
+    return statistics, "Perception dataset"
+
+
+def format_bin_edges(edges: np.ndarray, precision: int) -> list:
+    return [f"{low:.{precision}f} - {high:.{precision}f}" for low, high in zip(edges[:-1], edges[1:])]
+
+
+def display_bounding_box_statistics(boxes: dict):
+    st.markdown("## Bounding boxes")
+    st.write(f"{boxes['num_objects']} objects in {boxes['num_frames']} frames")
+
+    st.markdown("### Objects per class")
+    class_counts = pd.DataFrame({
+        "objects": pd.Series(boxes["class_counts"]),
+        "mean area (pixels)": pd.Series({name: boxes["class_area_sums"][name] / count
+                                         for name, count in boxes["class_counts"].items() if count > 0}),
+    }).sort_values("objects", ascending=False)
+    st.bar_chart(class_counts["objects"])
+    st.dataframe(class_counts)
+
+    st.markdown("### Objects per frame")
+    st.bar_chart(pd.DataFrame({"frames": boxes["objects_per_frame"]}))
+
+    col1, col2 = st.columns(2)
+    with col1:
+        st.markdown("### Box area (pixels)")
+        areas = boxes["area_histogram"]
+        used = np.flatnonzero(areas)
+        if len(used) > 0:
+            bins = slice(used[0], used[-1] + 1)
+            st.bar_chart(pd.DataFrame({"boxes": areas[bins]},
+                                      index=format_bin_edges(dataset_stats.AREA_BIN_EDGES, 0)[bins]))
+    with col2:
+        st.markdown("### Box aspect ratio (width / height)")
+        aspects = boxes["aspect_histogram"]
+        used = np.flatnonzero(aspects)
+        if len(used) > 0:
+            bins = slice(used[0], used[-1] + 1)
+            st.bar_chart(pd.DataFrame({"boxes": aspects[bins]},
+                                      index=format_bin_edges(dataset_stats.ASPECT_BIN_EDGES, 2)[bins]))
+
+
+def display_keypoint_statistics(templates: dict):
+    st.markdown("## Keypoints")
+    for template_name, keypoints in templates.items():
+        st.markdown(f"### {template_name} ({keypoints['num_figures']} figures)")
+        state_counts = keypoints["state_counts"]
+        totals = np.maximum(state_counts.sum(axis=1, keepdims=True), 1)
+        rates = pd.DataFrame(state_counts / totals, index=keypoints["labels"],
+                             columns=list(dataset_stats.KEYPOINT_STATES))
+        st.bar_chart(rates)
+        st.dataframe(rates.style.format("{:.1%}"))
+
+
+def statistics_page(data_root: str):
+    """ Adds streamlit components to the app to display the statistics of the dataset
+
+    :param data_root: Root directory of the dataset
+    :type data_root: str
+    """
+    st.markdown("# Dataset statistics")
+    if data_root is None or not os.path.isdir(data_root):
+        st.markdown("Open a dataset on the main page first.")
+        return
+    data_root = os.path.abspath(data_root)
+    st.write("### Dir: " + data_root)
+
+    statistics, description = get_dataset_statistics(data_root)
+    if statistics is None:
+        st.warning("The provided Dataset folder \"" + data_root + "\" is not considered valid")
+        return
+    st.write(f"{statistics['num_frames']} frames ({description})")
+
+    if dataset_stats.BOUNDING_BOX_NAME in statistics:
+        display_bounding_box_statistics(statistics[dataset_stats.BOUNDING_BOX_NAME])
+    if dataset_stats.KEYPOINTS_NAME in statistics:
+        display_keypoint_statistics(statistics[dataset_stats.KEYPOINTS_NAME])
+    if dataset_stats.BOUNDING_BOX_NAME not in statistics and dataset_stats.KEYPOINTS_NAME not in statistics:
+        st.write("The dataset has no bounding box or keypoint annotations.")
+
+
+st.set_page_config(layout="wide")
+# the main page keeps the selected dataset in the session, the command line dataset is used until one is opened
+statistics_page(st.session_state.get("curr_dir", sys.argv[1] if len(sys.argv) > 1 else None))
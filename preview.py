@@ -1,7 +1,5 @@
-import re
-import json
 import argparse
-from typing import List, Tuple, Optional, Dict
+from typing import Callable, List, Tuple, Optional, Dict
 
 import streamlit as st
 import streamlit.components.v1 as components
@@ -11,9 +9,13 @@ from tkinter import filedialog
 
 import helpers.custom_components_setup as cc
 import helpers.datamaker_dataset_helper as datamaker
+import helpers.datamaker_loader as datamaker_loader
+import helpers.frame_filter as frame_filter
+import helpers.render_pool as render_pool
+from helpers.render_cache import render_cache
 
-from Dataset import Dataset
-from converter import convert, prepare_ds_info, os, AnnotationDefinitions, MetricDefinitions, Captures, Image
+from Dataset import Dataset, INSTANCE_CONTOURS, INSTANCE_PSEUDO_COLORS
+from converter import convert_sharded, convert_streaming, os, AnnotationDefinitions, MetricDefinitions, Captures, Image
 
 # Set up tkinter
 root = tk.Tk()
@@ -22,6 +24,13 @@ root.withdraw()
 # Make folder picker dialog appear on top of other windows
 root.wm_attributes('-topmost', 1)
 
+# maximum size of the frame displayed in zoom view
+ZOOM_RESOLUTION = 2000
+# number of frames before and after the zoomed frame that are prefetched
+ZOOM_PREFETCH_DISTANCE = 2
+# outputs of the Yolo conversion
+YOLO_OUTPUTS = ["Label files", "Tar shards"]
+
 def get_img_size(base_dataset_dir: str) -> tuple:
     """Get img size from first img in datset
 
@@ -37,7 +46,7 @@ def get_img_size(base_dataset_dir: str) -> tuple:
     img_path = os.path.join(img_dir, os.listdir(img_dir)[0])
     return Image.open(img_path).size
 
-def datamaker_dataset(path: str) -> Optional[Dict[int, Dataset]]:
+def datamaker_dataset(path: str) -> Optional[datamaker.DatamakerDataset]:
     """ Reads the given path as a datamaker dataset
         Assumes that the given path contains a folder structure as follows:
         - path
@@ -45,39 +54,60 @@ def datamaker_dataset(path: str) -> Optional[Dict[int, Dataset]]:
                 - instance_#
                     - attempt_#
                         - Normal Perception dataset folder structure
+        The attempts are loaded in background processes, this returns as soon as the first instance is loaded and the
+        other instances are added on the following reruns
         :param path: path to dataset
         :type path: str
-        :return: Dictionary containing an entry for every instance, the key is the instance number, 
-                each entry is a tuple as follows: (AnnotationDefinition, MetricDefiniton, Captures, number of captures, 
-                absolute path to instance)
-        :rtype: Dict[int, (AnnotationDefinitions, MetricDefinitions, Captures, int, str)]
+        :return: Dataset going over the instances loaded so far, instances are keyed by instance number
+        :rtype: datamaker.DatamakerDataset
     """
-    instances = {}
-    try:
-        for app_param in [f.path for f in os.scandir(path) if f.is_dir()]:            
-            read_datamaker_instance_output(app_param, instances)
-    except Exception:
-        #The user may be selecting an actual app-param folder instead of a folder containing app-params. This can happen if the user is on the mac and there is only one app-param folder in the downloaded dataset.
-        try:            
-            read_datamaker_instance_output(path, instances)
-        except Exception:
-            return None
-
-    if len(instances) > 0:
-        return instances
-    else:
+    loader = datamaker_loader.get_loader(path)
+    if loader is None:
         return None
 
+    progress_placeholder = st.empty()
+
+    def show_progress(num_loaded, num_attempts):
+        progress_placeholder.progress(num_loaded / num_attempts)
+
+    instances = loader.wait_for_dataset(show_progress if not loader.is_done() else None)
+    progress_placeholder.empty()
+    return instances
+
+
+def display_loading_progress(loader: Optional[datamaker_loader.DatamakerLoader]):
+    """ Shows how many attempts of a datamaker dataset are loaded while they are loading in the background
+    :param loader: loader of the dataset
+    :type loader: datamaker_loader.DatamakerLoader
+    """
+    if loader is None or loader.is_done():
+        return
+    num_loaded, num_attempts = loader.progress()
+    st.sidebar.markdown(f"### Loading instances: {num_loaded}/{num_attempts} attempts")
+    st.sidebar.progress(num_loaded / num_attempts)
+    if st.sidebar.button("Show loaded instances"):
+        st.experimental_rerun()
+
+
+def datamaker_frame_columns(instances: datamaker.DatamakerDataset) -> dict:
+    """ Gets the frame filter columns of every instance of a datamaker dataset, joined in frame order
+    :param instances: Datamaker dataset
+    :type instances: datamaker.DatamakerDataset
+    :return: see frame_filter.build_frame_columns
+    :rtype: dict
+    """
+    columns_list = []
+    for key in instances.keys:
+        columns = None
+        if isinstance(instances, datamaker_loader.LazyDatamakerDataset):
+            # do not parse an instance that is not in memory when its columns are in its index
+            columns = frame_filter.load_frame_columns(instances.attempts[key])
+        if columns is None:
+            columns = frame_filter.get_frame_columns(instances.get_instance(key))
+        columns_list.append(columns)
+    return frame_filter.concatenate_columns(columns_list, [instances.get_offset(key) for key in instances.keys],
+                                            instances.length())
 
-def read_datamaker_instance_output(path, instances):
-    for instance in [g.path for g in os.scandir(path) if g.is_dir()]:
-            if re.match(".*instance_[0-9]*", instance):
-                instance_num = int(instance[instance.rfind("instance_") + len("instance_"):])
-                for attempt in [h.path for h in os.scandir(instance) if h.is_dir()]:
-                    if re.match(".*attempt_[0-9]*", attempt):
-                        ds = Dataset(attempt)
-                        if ds.dataset_valid:
-                            instances[instance_num] = ds
 
 def create_session_state_data(attribute_values: Dict[str, any]):
     """ Takes a dictionary of attributes to values to create the streamlit session_state object. 
@@ -144,6 +174,11 @@ def create_sidebar_labeler_menu(available_labelers: List[str]) -> Dict[str, bool
         st.session_state.semantic_existed_last_time = False
     else:
         st.session_state.semantic_existed_last_time = False
+    if labelers.get('instance segmentation', False):
+        # high contrast colors instead of the colors of the masks, close instance ids often have close mask colors
+        labelers[INSTANCE_PSEUDO_COLORS] = st.sidebar.checkbox("Pseudo Colors", key="instance_pseudo_colors")
+        if labelers[INSTANCE_PSEUDO_COLORS]:
+            labelers[INSTANCE_CONTOURS] = st.sidebar.checkbox("Instance Contours", key="instance_contours")
     if st.session_state.previous_labelers != labelers:
         st.session_state.labelers_changed = True
     else:
@@ -185,6 +220,75 @@ def display_labels_config():
     st.sidebar.number_input('Image height', step=1,
     disabled=st.session_state.auto_mode, key="in_h")
 
+    st.sidebar.radio('Output', YOLO_OUTPUTS, key="yolo_output",
+                     help="One label file per frame, or tar shards holding the images and their labels")
+
+    st.sidebar.checkbox('Incremental', key="incremental_convert",
+                        disabled=st.session_state.yolo_output != YOLO_OUTPUTS[0],
+                        help="Only write the labels of new or changed frames and delete the labels of removed frames")
+
+def display_filter_config(class_names: List[str]) -> Optional[frame_filter.FrameFilter]:
+    """Creates a sidebar display for the frame filter
+    :param class_names: names of the bounding box labels of the dataset
+    :type class_names: List[str]
+    :return: the filter, None if filtering is turned off
+    :rtype: frame_filter.FrameFilter
+    """
+    st.sidebar.markdown("# Filter")
+    if not st.sidebar.checkbox("Filter frames", key="filter_enabled",
+                               help="Only show the frames with a number of matching bounding boxes in the range"):
+        return None
+    classes = st.sidebar.multiselect("Classes", class_names, key="filter_classes",
+                                     help="Boxes of any of these classes match, boxes of any class if empty")
+    min_area = st.sidebar.number_input("Minimum box area (pixels)", min_value=0.0, step=100.0,
+                                       key="filter_min_area")
+    max_area = st.sidebar.number_input("Maximum box area (pixels), 0 for no limit", min_value=0.0, step=100.0,
+                                       key="filter_max_area")
+    min_boxes = st.sidebar.number_input("Minimum matching boxes", min_value=0, step=1, key="filter_min_boxes")
+    max_boxes = st.sidebar.number_input("Maximum matching boxes, -1 for no limit", min_value=-1, step=1,
+                                        key="filter_max_boxes")
+    return frame_filter.FrameFilter(classes=tuple(classes),
+                                    min_area=min_area if min_area > 0 else None,
+                                    max_area=max_area if max_area > 0 else None,
+                                    min_boxes=int(min_boxes),
+                                    max_boxes=int(max_boxes) if max_boxes >= 0 else None)
+
+
+def get_filtered_frames(get_columns: Callable[[], dict]) -> Optional[List[int]]:
+    """ Shows the filter controls and selects the frames that match the filter, the grid and zoom views go back to
+    the first matching frame whenever the filter changes
+    :param get_columns: Function that gets the frame filter columns of the dataset, only called when filtering
+    :type get_columns: Callable[[], dict]
+    :return: indices of the matching frames, None if filtering is turned off
+    :rtype: List[int]
+    """
+    columns = get_columns() if st.session_state.filter_enabled else None
+    current_filter = display_filter_config(frame_filter.get_class_names(columns) if columns is not None else [])
+
+    if current_filter != st.session_state.previous_filter:
+        st.session_state.previous_filter = current_filter
+        st.session_state.start_at = 0
+        st.session_state.zoom_image = -1
+        st.session_state.just_opened_grid = True
+    if current_filter is None:
+        return None
+
+    frames = frame_filter.filter_frames(columns, current_filter)
+    st.sidebar.markdown(f"### Matching frames: {len(frames)}")
+    return frames.tolist()
+
+
+def display_render_config():
+    """Creates a sidebar display for the rendering options
+    """
+    st.sidebar.markdown("# Rendering")
+    st.sidebar.number_input('Render workers', min_value=1, max_value=64, step=1, key="render_workers",
+                            help="Number of frames of a page that are rendered at the same time")
+    cache_stats = render_cache.stats()
+    st.sidebar.markdown(f"### Render cache: {cache_stats['entries']} frames, "
+                        f"{cache_stats['bytes'] / (1024 * 1024):.1f} MB "
+                        f"({cache_stats['hits']} hits / {cache_stats['misses']} misses)")
+
 def preview_dataset(base_dataset_dir: str):
     """
     Adds streamlit components to the app to construct the dataset preview.
@@ -203,6 +307,8 @@ def preview_dataset(base_dataset_dir: str):
         'src_yolo_dir': os.path.join(base_dataset_dir , "YoloSrc"),
 
         'auto_mode': True,
+        'incremental_convert': False,
+        'yolo_output': YOLO_OUTPUTS[0],
         'width': width,
         'height': height,
         'in_w': width,
@@ -218,6 +324,16 @@ def preview_dataset(base_dataset_dir: str):
 
         'previous_labelers': {},
         'labelers_changed': False,
+
+        'render_workers': render_pool.DEFAULT_NUM_WORKERS,
+
+        'filter_enabled': False,
+        'filter_classes': [],
+        'filter_min_area': 0.0,
+        'filter_max_area': 0.0,
+        'filter_min_boxes': 1,
+        'filter_max_boxes': -1,
+        'previous_filter': None,
     })    
 
     # Gets the latest selected directory
@@ -235,13 +351,21 @@ def preview_dataset(base_dataset_dir: str):
         if not os.path.isdir(path_to_save_dir):
             os.mkdir(path_to_save_dir)
 
-        # prepare dataset info
-        dataset_info = prepare_ds_info(base_dataset_dir, auto_mode=st.session_state.auto_mode,
-        manual_img_size=(st.session_state.in_w, st.session_state.in_h))
+        progress_text = st.sidebar.empty()
         # try convert
-        assert convert(dataset_info, path_to_save_dir), "Failed convert!"
+        if st.session_state.yolo_output == YOLO_OUTPUTS[0]:
+            stats = convert_streaming(base_dataset_dir, path_to_save_dir, auto_mode=st.session_state.auto_mode,
+                                      manual_img_size=(st.session_state.in_w, st.session_state.in_h),
+                                      on_progress=lambda progress: progress_text.write(str(progress)),
+                                      incremental=st.session_state.incremental_convert)
+        else:
+            stats = convert_sharded(base_dataset_dir, path_to_save_dir, auto_mode=st.session_state.auto_mode,
+                                    manual_img_size=(st.session_state.in_w, st.session_state.in_h),
+                                    on_progress=lambda progress: progress_text.write(str(progress)))
+        progress_text.empty()
+        assert stats is not None, "Failed convert!"
 
-        st.success('Метки успешно сохранены в '+str(st.session_state.src_yolo_dir)+"!")
+        st.success('Метки успешно сохранены в '+str(st.session_state.src_yolo_dir)+"! ("+str(stats)+")")
 
     if base_dataset_dir is None:
         st.markdown("# Please open a dataset folder:")
@@ -283,17 +407,19 @@ def preview_dataset(base_dataset_dir: str):
 
             display_number_frames(ds.length())
             display_labels_config()
+            display_render_config()
+            frames = get_filtered_frames(lambda: frame_filter.get_frame_columns(ds))
 
             available_labelers = ds.get_available_labelers()
             labelers = create_sidebar_labeler_menu(available_labelers)
 
             # zoom_image is negative if the application isn't in zoom mode
             index = int(st.session_state.zoom_image)
-            if index >= 0:
-                zoom(index, 0, ds, labelers)
+            if index >= 0 and (frames is None or index < len(frames)):
+                zoom(index, 0, ds, labelers, frames)
             else:
                 num_rows = 5
-                grid_view(num_rows, ds, labelers)
+                grid_view(num_rows, ds, labelers, frames)
 
         # if it is a datamaker dataset
         else:
@@ -302,39 +428,45 @@ def preview_dataset(base_dataset_dir: str):
                 st.sidebar.write("### Dir: "+folder_name+"/")
                 st.sidebar.markdown(f"### Image size: ({st.session_state.width}, {st.session_state.height})")
 
-            display_number_frames(datamaker.get_dataset_length_with_instances(instances))
+            display_number_frames(instances.length())
+            display_loading_progress(datamaker_loader.get_started_loader(data_root))
             display_labels_config()
+            display_render_config()
+            frames = get_filtered_frames(lambda: datamaker_frame_columns(instances))
 
             # zoom_image is negative if the application isn't in zoom mode
             index = int(st.session_state.zoom_image)            
-            if index >= 0:
-                instance_key = datamaker.get_instance_by_capture_idx(instances, index)
+            if index >= 0 and (frames is None or index < len(frames)):
+                instance_key = instances.get_instance_key(index if frames is None else frames[index])
                 
                 if (instance_key is None):
+                    # back to the first frame, with a filter that is the first matching frame
+                    st.session_state.zoom_image = 0
                     index = 0
-                    instance_key = datamaker.get_instance_by_capture_idx(instances, index)
+                    instance_key = instances.get_instance_key(index if frames is None else frames[index])
 
-                offset = datamaker.get_dataset_length_with_instances(instances, instance_key)
-                ds = instances[instance_key]
-                ann_def = ds.ann_def                                                      
-                available_labelers = [a["name"] for a in ann_def.table.to_dict('records')]
+                offset = instances.get_offset(instance_key)
+                ds = instances.get_instance(instance_key)
+                available_labelers = ds.get_available_labelers()
                 labelers = create_sidebar_labeler_menu(available_labelers)
-                zoom(index, offset, ds, labelers)
+                zoom(index, offset, ds, labelers, frames)
             else:
                 index = st.session_state.start_at                
                 num_rows = 5
-                instance_key = datamaker.get_instance_by_capture_idx(instances, index)                           
+                if frames is not None and len(frames) > 0:
+                    # the labelers are taken from the instance of the first matching frame of the page
+                    index = frames[min(int(index), len(frames) - 1)]
+                instance_key = instances.get_instance_key(index)                           
                 
                 if (instance_key is None):
                     st.session_state.start_at = 0
                     index = 0
-                    instance_key = datamaker.get_instance_by_capture_idx(instances, index)
+                    instance_key = instances.get_instance_key(index)
 
-                ds = instances[instance_key]
-                ann_def = ds.ann_def                                
-                available_labelers = [a["name"] for a in ann_def.table.to_dict('records')]
+                ds = instances.get_instance(instance_key)
+                available_labelers = ds.get_available_labelers()
                 labelers = create_sidebar_labeler_menu(available_labelers)
-                grid_view_instances(num_rows, instances, labelers)
+                grid_view_instances(num_rows, instances, labelers, frames)
     else:
         st.markdown("# Please select a valid dataset folder:")
         if st.button("Select dataset folder"):
@@ -413,7 +545,7 @@ def create_grid_containers(num_rows: int, num_cols: int, start_at: int, dataset_
     return containers
 
 
-def grid_view(num_rows: int, ds: Dataset, labelers: Dict[str, bool]):
+def grid_view(num_rows: int, ds: Dataset, labelers: Dict[str, bool], frames: Optional[List[int]] = None):
     """ Creates the grid view streamlit components
     :param num_rows: Number of rows
     :type num_rows: int
@@ -422,16 +554,47 @@ def grid_view(num_rows: int, ds: Dataset, labelers: Dict[str, bool]):
     :param labelers: Dictionary containing keys for the name of every labeler available in the given dataset
                      and the corresponding value is a boolean representing whether or not to display it
     :type labelers: Dict[str, bool]
+    :param frames: Optional, indices of the frames to page through (the frames matching the filter), every frame if
+                   None. The grid positions then index this list
+    :type frames: List[int]
     """
-    dataset_size = ds.length()
+    dataset_size = ds.length() if frames is None else len(frames)
+    if dataset_size == 0:
+        st.markdown("# No frame matches the filter")
+        return
 
     num_cols, start_at = create_grid_view_controls(num_rows, dataset_size)
 
     containers = create_grid_containers(num_rows, num_cols, start_at, dataset_size)
 
-    for i in range(start_at, min(start_at + (num_cols * num_rows), dataset_size)):
-        image = ds.get_image_with_labelers(i, labelers, max_size=get_resolution_from_num_cols(num_cols))
-        containers[i - start_at].image(image, caption=str(i), use_column_width=True)
+    def get_frame(i):
+        return i if frames is None else frames[i]
+
+    # anything still queued from the previous page is stale if the user jumped elsewhere
+    render_pool.prefetcher.cancel()
+    jobs = [(i, ds, get_frame(i), labelers, get_resolution_from_num_cols(num_cols))
+            for i in range(start_at, min(start_at + (num_cols * num_rows), dataset_size))]
+    for i, image in render_pool.render_frames(jobs, int(st.session_state.render_workers)):
+        containers[i - start_at].image(image, caption=str(get_frame(i)), use_column_width=True)
+
+    prefetch_grid_pages(start_at, num_cols * num_rows, dataset_size,
+                        lambda i: (ds, get_frame(i), labelers, get_resolution_from_num_cols(num_cols)))
+
+
+def prefetch_grid_pages(start_at: int, page_size: int, dataset_size: int, get_job: Callable[[int], tuple]):
+    """ Prefetches the next and the previous grid pages in the background
+    :param start_at: Index at which the current page starts
+    :type start_at: int
+    :param page_size: Number of frames in a page
+    :type page_size: int
+    :param dataset_size: Size of the dataset
+    :type dataset_size: int
+    :param get_job: Function that gets the prefetch job (dataset, index in the dataset, labelers, max_size) of a frame
+    :type get_job: Callable[[int], tuple]
+    """
+    next_page = range(start_at + page_size, min(start_at + 2 * page_size, dataset_size))
+    previous_page = range(max(start_at - page_size, 0), start_at)
+    render_pool.prefetcher.schedule([get_job(i) for i in list(next_page) + list(previous_page)])
 
 
 def get_resolution_from_num_cols(num_cols):
@@ -443,36 +606,50 @@ def get_resolution_from_num_cols(num_cols):
 
 def grid_view_instances(
         num_rows: int,
-        instances: Dict[int, Tuple[AnnotationDefinitions, MetricDefinitions, Captures, int, str]],
-        labelers: Dict[str, bool]):
+        instances: datamaker.DatamakerDataset,
+        labelers: Dict[str, bool],
+        frames: Optional[List[int]] = None):
     """ Creates the grid view streamlit components when using a Datamaker dataset
     :param num_rows: Number of rows
     :type num_rows: int
-    :param instances: Dictionary of instances
-    :type instances: Dict[int, Tuple[AnnotationDefinitions, MetricDefinitions, Captures, int, str]]
+    :param instances: Datamaker dataset
+    :type instances: datamaker.DatamakerDataset
     :param labelers: Dictionary containing keys for the name of every labeler available in the given dataset
                      and the corresponding value is a boolean representing whether or not to display it
     :type labelers: Dict[str, bool]
+    :param frames: Optional, indices of the frames to page through (the frames matching the filter), every frame if
+                   None. The grid positions then index this list
+    :type frames: List[int]
     """
-    dataset_size = datamaker.get_dataset_length_with_instances(instances)
+    dataset_size = instances.length() if frames is None else len(frames)
+    if dataset_size == 0:
+        st.markdown("# No frame matches the filter")
+        return
     num_cols, start_at = create_grid_view_controls(num_rows, dataset_size)
 
     containers = create_grid_containers(num_rows, num_cols, start_at, dataset_size)
 
-    for i in range(start_at, min(start_at + (num_cols * num_rows), dataset_size)):
-        instance_key = datamaker.get_instance_by_capture_idx(instances, i)
-        ds = instances[instance_key]
-        ann_def = ds.ann_def        
-        cap = ds.cap
-        data_root = ds.data_root                
-        image = ds.get_image_with_labelers(i - datamaker.get_dataset_length_with_instances(instances, instance_key), labelers, max_size=(6 - num_cols) * 150)
-        containers[i - start_at].image(image, caption=str(i), use_column_width=True)
+    def get_frame(i):
+        return i if frames is None else frames[i]
+
+    def get_job(i):
+        ds, local_index = instances.locate(get_frame(i))
+        return ds, local_index, labelers, (6 - num_cols) * 150
+
+    # anything still queued from the previous page is stale if the user jumped elsewhere
+    render_pool.prefetcher.cancel()
+    jobs = [(i,) + get_job(i) for i in range(start_at, min(start_at + (num_cols * num_rows), dataset_size))]
+    for i, image in render_pool.render_frames(jobs, int(st.session_state.render_workers)):
+        containers[i - start_at].image(image, caption=str(get_frame(i)), use_column_width=True)
+
+    prefetch_grid_pages(start_at, num_cols * num_rows, dataset_size, get_job)
 
 
 def zoom(index: int,
          offset: int,
          ds: Dataset,
-         labelers: Dict[str, bool]):
+         labelers: Dict[str, bool],
+         frames: Optional[List[int]] = None):
     """ Creates streamlit components for Zoom in view
     :param index: Index of the image
     :type index: int
@@ -484,8 +661,12 @@ def zoom(index: int,
     :param labelers: Dictionary containing keys for the name of every labeler available in the given dataset
                      and the corresponding value is a boolean representing whether or not to display it
     :type labelers: Dict[str, bool]
+    :param frames: Optional, indices of the frames to page through (the frames matching the filter), every frame if
+                   None. index is then a position in this list
+    :type frames: List[int]
     """
     dataset_size = ds.length()
+    num_positions = dataset_size + offset if frames is None else len(frames)
 
     st.session_state.start_at = index
     st.session_state.zoom_image = index
@@ -497,7 +678,7 @@ def zoom(index: int,
 
     header = st.columns([2 / 3, 1 / 3])
     with header[0]:
-        new_index = cc.item_selector_zoom(index, dataset_size + offset)
+        new_index = cc.item_selector_zoom(index, num_positions)
         if not new_index == index and not st.session_state.just_opened_zoom and not st.session_state.labelers_changed:
             st.session_state.zoom_image = new_index
             st.session_state.start_at = index
@@ -509,49 +690,38 @@ def zoom(index: int,
 
     components.html("""<hr style="height:2px;border:none;color:#AAA;background-color:#AAA;" /> """, height=30)
 
-    index = index - offset
-    image = ds.get_image_with_labelers(index, labelers, max_size=2000)
+    def get_local_index(position):
+        return (position if frames is None else frames[position]) - offset
+
+    position = index
+    index = get_local_index(position)
+    render_pool.prefetcher.cancel()
+    image = render_pool.render_frame(ds, index, labelers, ZOOM_RESOLUTION)
 
     st.image(image, use_column_width=True)
+
+    # prefetch the neighbouring frames while the user looks at this one
+    neighbours = []
+    for distance in range(1, ZOOM_PREFETCH_DISTANCE + 1):
+        neighbours.extend(get_local_index(i) for i in (position + distance, position - distance)
+                          if 0 <= i < num_positions)
+    render_pool.prefetcher.schedule([(ds, i, labelers, ZOOM_RESOLUTION) for i in neighbours if 0 <= i < dataset_size])
+
     layout = st.columns(2)
     layout[0].title("Captures Metadata")
 
-    captures_dir = None
-    for directory in os.walk(ds.data_root):
-        name = str(directory[0]).replace('\\', '/').split('/')[-1]
-        if name.startswith("Dataset") and \
-                "." not in name[1:] and \
-                os.path.abspath(ds.data_root) != os.path.abspath(directory[0]):
-            captures_dir = os.path.abspath(directory[0])
-            break
-
-    path_to_captures = os.path.join(os.path.abspath(captures_dir), "captures_000.json")
-    json_file = json.load(open(path_to_captures, "r", encoding="utf8"))
-    num_captures_per_file = len(json_file["captures"])
-
-    file_num = index // num_captures_per_file
-    postfix = ('000' + str(file_num))
-    postfix = postfix[len(postfix) - 3:]
-    path_to_captures = os.path.join(os.path.abspath(captures_dir), "captures_" + postfix + ".json")
     with layout[0]:
-        json_file = json.load(open(path_to_captures, "r", encoding="utf8"))
-        capture = json_file['captures'][index % num_captures_per_file]
-        st.write(capture)
+        capture_metadata = ds.get_capture_metadata(index)
+        if capture_metadata is not None:
+            st.write(capture_metadata)
 
     layout[1].title("Metrics Metadata")
-    metrics = []
-    for i in os.listdir(captures_dir):
-        path_to_metrics = os.path.join(captures_dir, i)
-        if os.path.isfile(path_to_metrics) and 'metrics_' in i and 'definitions' not in i:
-            json_file = json.load(open(path_to_metrics, encoding="utf8"))
-            metrics.extend(json_file['metrics'])
     with layout[1]:
-        for metric in metrics:
-            if metric['sequence_id'] == capture['sequence_id'] and metric['step'] == capture['step']:
-                for metric_def in ds.get_metrics_records():
-                    if metric_def['id'] == metric['metric_definition']:
-                        st.markdown("## " + metric_def['name'])
-                st.write(metric)
+        for metric in ds.get_metrics_metadata(index):
+            metric_name = ds.get_metric_name(metric['metric_definition'])
+            if metric_name is not None:
+                st.markdown("## " + metric_name)
+            st.write(metric)
 
 
 def preview_app(args):
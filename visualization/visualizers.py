@@ -1,27 +1,103 @@
 ﻿from pathlib import Path
+import sys
+from typing import List
 import numpy as np
 import PIL
 
 from datasetinsights.datasets.unity_perception import AnnotationDefinitions
 from datasetinsights.datasets.unity_perception.captures import Captures
-from datasetinsights.datasets.synthetic import read_bounding_box_2d, read_bounding_box_3d
-from datasetinsights.stats.visualization.plots import plot_bboxes, plot_bboxes3d, plot_keypoints
+from datasetinsights.datasets.synthetic import read_bounding_box_3d
+from datasetinsights.io.bbox import BBox2D
+from datasetinsights.stats.visualization.bbox2d_plot import add_single_bbox_on_image
+from datasetinsights.stats.visualization.bbox3d_plot import add_single_bbox3d_on_image
+from datasetinsights.stats.visualization.plots import FONT_SCALE, LINE_WIDTH_SCALE, plot_bboxes, plot_bboxes3d, \
+    plot_keypoints
 
 from PIL.Image import Image
 
+# opacity of the segmentation label maps drawn over the captures
+SEGMENTATION_ALPHA = 0.6
+# color channels of an RGBA pixel read as a single uint32
+_RGB_MASK = 0x00FFFFFF if sys.byteorder == "little" else 0xFFFFFF00
+
+# number of colors of the instance segmentation pseudo colors, color 0 is the transparent background
+INSTANCE_PALETTE_SIZE = 256
+# color of the instance contours
+INSTANCE_CONTOUR_COLOR = (255, 255, 255)
+
+# default width of the joints drawn by plot_keypoints and of the lines drawn by plot_bboxes3d at full resolution
+KEYPOINT_VISUAL_WIDTH = 6
+BOX_3D_LINE_WIDTH = 2
+
+
+def read_bounding_boxes_2d(annotations, index, label_mappings=None, scale=1.0):
+    """
+    Reads the 2D bounding boxes of the capture at index from the columns of the annotation table, like
+    read_bounding_box_2d does from the annotation records.
+
+    :param annotations: annotation table of the bounding box definition
+    :type AnnotationTable:
+    :param index: index of the capture in annotations
+    :type int:
+    :param label_mappings: label_id -> label_name, boxes of other labels are skipped
+    :type Dict[int, str]:
+    :param scale: the boxes are scaled by it
+    :type float:
+    :return: the boxes
+    :rtype: List[BBox2D]
+    """
+    label_ids = annotations.get_column("label_id", index)
+    coordinates = np.stack([annotations.get_column(name, index).astype(np.float64)
+                            for name in ("x", "y", "width", "height")], axis=1)
+    if scale != 1.0:
+        coordinates = coordinates * scale
+    return [BBox2D(label=label_id, x=x, y=y, w=w, h=h)
+            for label_id, (x, y, w, h) in zip(label_ids.tolist(), coordinates.tolist())
+            if not label_mappings or label_id in label_mappings]
+
 
 def draw_image_with_boxes(
     image,
     index,
-    catalog,
+    annotations,
     label_mappings,
+    scale=1.0,
+    full_height=None,
 ):
-    cap = catalog.iloc[index]
-    ann = cap["annotation.values"]
+    """
+    Draws the 2D bounding boxes of the capture at index on the image.
+
+    :param image: the PIL image
+    :type PIL:
+    :param index: index of the capture in annotations
+    :type int:
+    :param annotations: annotation table of the bounding box definition
+    :type AnnotationTable:
+    :param label_mappings: label_id -> label_name
+    :type Dict[int, str]:
+    :param scale: size of image relative to the capture the boxes were annotated on, the boxes are scaled by it
+    :type float:
+    :param full_height: height of the original capture, used to size the lines and labels the same way as when drawing
+                        at full resolution. Defaults to the height of image divided by scale
+    :type int:
+    """
     capture = image
     image = capture.convert("RGB")  # Remove alpha channel
-    bboxes = read_bounding_box_2d(ann, label_mappings)
-    return plot_bboxes(image, bboxes, label_mappings)
+    if scale == 1.0:
+        bboxes = read_bounding_boxes_2d(annotations, index, label_mappings)
+        return plot_bboxes(image, bboxes, label_mappings)
+
+    if full_height is None:
+        full_height = image.height / scale
+    bboxes = read_bounding_boxes_2d(annotations, index, label_mappings, scale)
+    # same sizes plot_bboxes would use at full resolution, scaled down with the image
+    font_size = max(1, int((full_height // FONT_SCALE) * scale))
+    box_line_width = max(1, int((full_height // LINE_WIDTH_SCALE) * scale))
+    np_image = np.array(image)
+    for box in bboxes:
+        label = label_mappings[box.label] if label_mappings is not None else box.label
+        add_single_bbox_on_image(np_image, box, label, None, font_size=font_size, box_line_width=box_line_width)
+    return PIL.Image.fromarray(np_image)
 
 
 def draw_image_with_segmentation(
@@ -44,18 +120,194 @@ def draw_image_with_segmentation(
     :param description: Image description
     :type str:
     """
-    # image_draw = ImageDraw(segmentation)
-    rgba = np.array(segmentation.copy().convert("RGBA"))
-    r, g, b, a = rgba.T
-    black_areas = (r == 0) & (b == 0) & (g == 0) & (a == 255)
-    other_areas = (r != 0) | (b != 0) | (g != 0)
-    rgba[..., 0:4][black_areas.T] = (0, 0, 0, 0)
-    rgba[..., -1][other_areas.T] = int(0.6 * 255)
+    return composite_segmentations(image, [segmentation])
+
+
+def composite_segmentations(
+    image: Image,
+    segmentations: List[Image],
+    alpha: float = SEGMENTATION_ALPHA,
+) -> Image:
+    """
+    Blends one or more segmentation label maps into the image with NumPy, in preallocated buffers.
+
+    Black pixels of a label map are left transparent, every other pixel is blended over the image with the given alpha,
+    with the same rounding as PIL's paste. The label maps are blended in order, later ones on top.
+
+    :param image: the PIL image
+    :type PIL:
+    :param segmentations: Segmentation images, of the same size as image
+    :type List[PIL]:
+    :param alpha: opacity of the label maps
+    :type float:
+    :return: RGB image with the label maps blended in
+    :rtype: PIL
+    """
+    # Pixels are kept as RGBA so that a whole pixel can be read as one uint32, which lets the black test and the
+    # final selection work on 2D arrays instead of broadcasting a mask over the channels
+    out = np.array(image.convert("RGBA"))
+    height, width, _ = out.shape
+    out_pixels = out.view(np.uint32)[..., 0]
+    weight = int(alpha * 255)
+
+    # uint16 is enough for 255 * 255 + 128 + 255, the buffers are reused for every label map
+    blend = np.empty(out.shape, dtype=np.uint16)
+    tmp = np.empty(out.shape, dtype=np.uint16)
+    blended = np.empty(out.shape, dtype=np.uint8)
+    blended_pixels = blended.view(np.uint32)[..., 0]
+    for segmentation in segmentations:
+        labels = _label_map_array(segmentation, height, width)
+        mask = (labels.view(np.uint32)[..., 0] & np.uint32(_RGB_MASK)) != 0
+
+        # same rounding as PIL's paste with a mask
+        np.multiply(labels, weight, out=blend, dtype=np.uint16)
+        np.multiply(out, 255 - weight, out=tmp, dtype=np.uint16)
+        blend += tmp
+        blend += 128
+        np.right_shift(blend, 8, out=tmp)
+        blend += tmp
+        blend >>= 8
+        np.copyto(blended, blend, casting="unsafe")
+        np.copyto(out_pixels, blended_pixels, where=mask)
+
+    return PIL.Image.fromarray(out, "RGBA").convert("RGB")
+
+
+def _label_map_array(segmentation: Image, height: int, width: int) -> np.ndarray:
+    """ Gets the pixels of a label map as a C contiguous RGBA array of the given size """
+    if segmentation.mode != "RGBA":
+        segmentation = segmentation.convert("RGBA")
+    labels = np.asarray(segmentation)
+    if labels.shape[:2] != (height, width):
+        # label maps of another size are placed in the top left corner, like PIL's paste
+        placed = np.zeros((height, width, 4), dtype=np.uint8)
+        placed[:labels.shape[0], :labels.shape[1]] = labels[:height, :width]
+        labels = placed
+    return np.ascontiguousarray(labels)
+
+
+def make_instance_palette(size: int = INSTANCE_PALETTE_SIZE) -> np.ndarray:
+    """
+    Creates the colors of the instance segmentation pseudo colors. Consecutive colors are far apart: the hues are
+    spaced by the golden ratio and the saturation and brightness cycle through three levels.
+
+    :param size: number of colors
+    :type int:
+    :return: RGBA colors, color 0 is transparent black and the others are opaque and never black
+    :rtype: np.ndarray
+    """
+    k = np.arange(size - 1)
+    hue = (k * 0.6180339887498949) % 1.0 * 6
+    saturation = np.array([0.95, 0.6, 1.0])[k % 3]
+    value = np.array([1.0, 1.0, 0.75])[k % 3]
+    # HSV to RGB for every color at once
+    sector = np.floor(hue).astype(np.int64) % 6
+    fraction = hue - np.floor(hue)
+    p = value * (1 - saturation)
+    q = value * (1 - saturation * fraction)
+    t = value * (1 - saturation * (1 - fraction))
+    channels = np.array([[value, t, p], [q, value, p], [p, value, t], [p, q, value], [t, p, value], [value, p, q]])
+    rgb = channels[sector, :, k].reshape(-1, 3)
+
+    palette = np.zeros((size, 4), dtype=np.uint8)
+    palette[1:, :3] = np.round(rgb * 255)
+    palette[1:, 3] = 255
+    return palette
+
+
+def get_color_keys(pixels: np.ndarray) -> np.ndarray:
+    """ Reads every RGBA pixel as the 24 bit integer r | g << 8 | b << 16, the keys of an instance color lookup table """
+    return np.ascontiguousarray(pixels).view("<u4")[..., 0] & np.uint32(0xFFFFFF)
+
+
+def make_instance_lut(instance_ids: np.ndarray, instance_colors: np.ndarray,
+                      palette_size: int = INSTANCE_PALETTE_SIZE) -> np.ndarray:
+    """
+    Creates the lookup table from the 256 x 256 x 256 colors of an instance segmentation mask to the colors of
+    make_instance_palette. The instances are given consecutive colors in the order of their ids so that instances next
+    to each other in the dataset get colors that are far apart. Any other color gets a color that only depends on
+    it, black stays transparent.
+
+    :param instance_ids: id of every instance of the dataset
+    :type np.ndarray:
+    :param instance_colors: RGB color of every instance in the masks, (number of instances, 3)
+    :type np.ndarray:
+    :param palette_size: number of colors of the palette
+    :type int:
+    :return: palette index of every 24 bit color key, see get_color_keys
+    :rtype: np.ndarray
+    """
+    # multiplicative hashing of the keys, the high bits are spread over every color but the background
+    lut = np.arange(1 << 24, dtype=np.uint32)
+    lut *= np.uint32(2654435761)
+    lut >>= np.uint32(16)
+    lut %= np.uint32(palette_size - 1)
+    lut += np.uint32(1)
+    lut = lut.astype(np.uint8 if palette_size <= 256 else np.uint16)
+
+    colors = np.asarray(instance_colors, dtype=np.int64).reshape(-1, 3) & 0xFF
+    keys = colors[:, 0] | colors[:, 1] << 8 | colors[:, 2] << 16
+    keys, first = np.unique(keys, return_index=True)
+    order = np.argsort(np.asarray(instance_ids)[first], kind="stable")
+    lut[keys[order]] = np.arange(len(keys)) % (palette_size - 1) + 1
+    lut[0] = 0
+    return lut
+
+
+def pseudo_color_instances(segmentation: Image, lut: np.ndarray, palette: np.ndarray, contours: bool = False):
+    """
+    Recolors an instance segmentation mask with two lookups, one in the instance color lookup table and one in the
+    palette, without going through the instances one by one.
+
+    :param segmentation: Instance segmentation mask
+    :type PIL:
+    :param lut: see make_instance_lut
+    :type np.ndarray:
+    :param palette: see make_instance_palette
+    :type np.ndarray:
+    :param contours: if true the outlines of the instances are also returned
+    :type bool:
+    :return: (the recolored RGBA mask, black where nothing is drawn, to be blended by composite_segmentations,
+             outlines of the instances for draw_instance_contours or None)
+    :rtype: Tuple[PIL, np.ndarray]
+    """
+    if segmentation.mode != "RGBA":
+        segmentation = segmentation.convert("RGBA")
+    keys = get_color_keys(np.asarray(segmentation))
+    colored = PIL.Image.fromarray(np.take(palette, np.take(lut, keys), axis=0), "RGBA")
+    if not contours:
+        return colored, None
+
+    # a pixel is on an outline when the pixel on its right or below it belongs to another instance
+    edges = np.zeros(keys.shape, dtype=bool)
+    np.not_equal(keys[:, 1:], keys[:, :-1], out=edges[:, :-1])
+    edges[:-1] |= keys[1:] != keys[:-1]
+    return colored, edges
+
+
+def draw_instance_contours(image: Image, edges: np.ndarray, color=INSTANCE_CONTOUR_COLOR) -> Image:
+    """
+    Draws the outlines returned by pseudo_color_instances over the image, opaque.
 
-    foreground = PIL.Image.fromarray(rgba)
-    image = image.copy()
-    image.paste(foreground, (0, 0), foreground)
-    return image
+    :param image: the PIL image
+    :type PIL:
+    :param edges: true for the pixels of the outlines, of the size of image
+    :type np.ndarray:
+    :param color: RGB color of the outlines
+    :type Tuple[int, int, int]:
+    :return: RGB image with the outlines
+    :rtype: PIL
+    """
+    # pixels are written as whole uint32, much faster than a boolean index over the channels
+    out = np.array(image.convert("RGBA"))
+    pixel = np.array(tuple(color) + (255,), dtype=np.uint8).view(np.uint32)[0]
+    if edges.shape != out.shape[:2]:
+        # outlines of a mask of another size are placed in the top left corner, like composite_segmentations
+        placed = np.zeros(out.shape[:2], dtype=bool)
+        placed[:edges.shape[0], :edges.shape[1]] = edges[:out.shape[0], :out.shape[1]]
+        edges = placed
+    np.copyto(out.view(np.uint32)[..., 0], pixel, where=edges)
+    return PIL.Image.fromarray(out, "RGBA").convert("RGB")
 
 
 def find_metadata_annotation_index(dataset, name):
@@ -65,19 +317,65 @@ def find_metadata_annotation_index(dataset, name):
 
 
 def draw_image_with_keypoints(
-    image, annotations, templates
+    image, annotations, templates, scale=1.0
 ):
-    return plot_keypoints(image, annotations, templates)
+    """
+    Draws keypoints on the image, in place.
+
+    :param image: the PIL image
+    :type PIL:
+    :param annotations: keypoint annotation values of the capture
+    :type list:
+    :param templates: keypoint templates of the keypoint definition
+    :type list:
+    :param scale: size of image relative to the capture the keypoints were annotated on, the keypoints and the width
+                  of the joints are scaled by it
+    :type float:
+    """
+    if scale == 1.0:
+        return plot_keypoints(image, annotations, templates)
+
+    annotations = [
+        dict(figure, keypoints=[dict(k, x=k["x"] * scale, y=k["y"] * scale) for k in figure["keypoints"]])
+        for figure in annotations
+    ]
+    visual_width = max(1, round(KEYPOINT_VISUAL_WIDTH * scale))
+    return plot_keypoints(image, annotations, templates, visual_width=visual_width)
 
 
 #TODO Implement colors
-def draw_image_with_box_3d(image, sensor, values, colors):
+def draw_image_with_box_3d(image, sensor, values, colors, scale=1.0):
+    """
+    Draws the 3D bounding boxes of a capture on the image.
+
+    :param image: the PIL image
+    :type PIL:
+    :param sensor: sensor of the capture, its projection is used to place the boxes on the image
+    :type dict:
+    :param values: 3D bounding box annotation values of the capture
+    :type list:
+    :param colors: colors of the boxes, defaults to green when None
+    :type list:
+    :param scale: size of image relative to the capture, only the line width is scaled by it since the camera projection
+                  already places the boxes relative to the image size
+    :type float:
+    """
     if 'camera_intrinsic' in sensor:
         projection = np.array(sensor["camera_intrinsic"])
     else:
         projection = np.array([[1, 0, 0], [0, 1, 0], [0, 0, 1]])
 
     boxes = read_bounding_box_3d(values)
-    img_with_boxes = plot_bboxes3d(image, boxes, projection, None,
-                                   orthographic=(sensor["projection"] == "orthographic"))
-    return img_with_boxes
+    orthographic = (sensor["projection"] == "orthographic")
+    if scale == 1.0:
+        img_with_boxes = plot_bboxes3d(image, boxes, projection, None,
+                                       orthographic=orthographic)
+        return img_with_boxes
+
+    box_line_width = max(1, round(BOX_3D_LINE_WIDTH * scale))
+    np_image = np.array(image)
+    for i, box in enumerate(boxes):
+        color = colors[i] if colors else None
+        add_single_bbox3d_on_image(np_image, box, projection, color, box_line_width=box_line_width,
+                                   orthographic=orthographic)
+    return PIL.Image.fromarray(np_image)